@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+#
+# Generates synthetic workspaces for benchmarking ws.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Each generated project is its own git repository with a trivial CMake
+# project in it. The projects form a DAG arranged in layers, where each project
+# depends on a few projects of the layer above it. Some projects can be given
+# a submodule or dirty files, since both make checksums more expensive, and
+# the projects can be split across several manifests in an included directory.
+# Rather than real build tools, the root gets stub cmake and ninja scripts that
+# do nothing, so that building measures ws alone; put the stub directory first
+# in the PATH when running ws on a generated root.
+
+import argparse
+import concurrent.futures
+import os
+import random
+import subprocess
+import sys
+
+
+_SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+_TOP_DIR = os.path.realpath(os.path.join(_SCRIPT_DIR, os.pardir))
+_WS = os.path.join(_TOP_DIR, 'bin', 'ws')
+
+# The directory inside a generated root holding the stub build tools.
+STUB_DIR = 'stub-bin'
+
+# The directory inside a generated root holding the repositories used as
+# submodules.
+_SUBMODULE_DIR = 'submodules'
+
+# The directory inside a generated root holding the included manifests.
+_MANIFEST_DIR = 'manifests'
+
+_GIT = ('git',
+        '-c', 'user.name=ws benchmark',
+        '-c', 'user.email=ws-benchmark@localhost',
+        '-c', 'commit.gpgsign=false',
+        '-c', 'init.defaultBranch=master',
+        '-c', 'protocol.file.allow=always')
+
+_STUBS = {
+    'cmake': '#!/bin/sh\nexit 0\n',
+    # ws expects the install directory to exist once a project is built.
+    'ninja': ('#!/bin/sh\n'
+              'if [ "$1" = "-C" ]; then mkdir -p "$2/install"; fi\n'
+              'exit 0\n')
+}
+
+
+def project_name(i):
+    '''Returns the name of the i-th generated project.'''
+    return 'proj%05d' % i
+
+
+def make_dag(num_projects, depth, fanout, rng):
+    '''Returns a dictionary mapping each project name to its list of
+    dependencies. The projects are split into the given number of layers, and
+    each project depends on up to fanout projects of the previous layer.'''
+    depth = max(1, min(depth, num_projects))
+    layers = [[] for _ in range(depth)]
+    for i in range(num_projects):
+        layers[i * depth // num_projects].append(project_name(i))
+
+    deps = {}
+    for layer, projects in enumerate(layers):
+        for proj in projects:
+            if layer == 0:
+                deps[proj] = []
+            else:
+                above = layers[layer - 1]
+                deps[proj] = sorted(rng.sample(above, min(fanout, len(above))))
+    return deps
+
+
+def _git(path, *args):
+    '''Runs git in the given repository.'''
+    subprocess.check_call(_GIT + args,
+                          cwd=path,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+
+
+def _make_repo(path, name):
+    '''Creates a git repository with a trivial CMake project in it.'''
+    os.makedirs(path)
+    with open(os.path.join(path, 'CMakeLists.txt'), 'w') as f:
+        f.write('project(%s C)\nadd_library(%s %s.c)\n' % (name, name, name))
+    with open(os.path.join(path, '%s.c' % name), 'w') as f:
+        f.write('int %s(void) { return 0; }\n' % name)
+    _git(path, 'init', '-q')
+    _git(path, 'add', '.')
+    _git(path, 'commit', '-q', '-m', 'Initial commit')
+
+
+def _make_project(root, proj, submodule, dirty):
+    '''Creates the repository of a project, optionally with a submodule and a
+    dirty file.'''
+    path = os.path.join(root, proj)
+    _make_repo(path, proj)
+    if submodule:
+        sub = os.path.join(root, _SUBMODULE_DIR, proj)
+        _make_repo(sub, '%s_sub' % proj)
+        _git(path, 'submodule', 'add', '-q', sub, 'sub')
+        _git(path, 'commit', '-q', '-m', 'Add submodule')
+    if dirty:
+        with open(os.path.join(path, '%s.c' % proj), 'a') as f:
+            f.write('/* local change */\n')
+
+
+def _write_manifest(path, deps, projects):
+    '''Writes a manifest for the given projects.'''
+    with open(path, 'w') as f:
+        f.write('projects:\n')
+        for proj in projects:
+            f.write('    %s:\n' % proj)
+            f.write('        build: cmake\n')
+            if len(deps[proj]) > 0:
+                f.write('        deps:\n')
+                for dep in deps[proj]:
+                    f.write('            - %s\n' % dep)
+
+
+def write_manifests(root, deps, num_manifests):
+    '''Writes the manifest for the given DAG, returning its path. If
+    num_manifests is positive, the projects are instead split across that
+    many manifests in a directory included by the top-level one.'''
+    manifest = os.path.join(root, 'ws.yaml')
+    projects = sorted(deps)
+    if num_manifests <= 0:
+        _write_manifest(manifest, deps, projects)
+        return manifest
+
+    manifest_dir = os.path.join(root, _MANIFEST_DIR)
+    os.makedirs(manifest_dir)
+    for i in range(num_manifests):
+        _write_manifest(os.path.join(manifest_dir, 'part%03d.yaml' % i),
+                        deps,
+                        projects[i::num_manifests])
+    with open(manifest, 'w') as f:
+        f.write('include:\n    - %s\n' % _MANIFEST_DIR)
+    return manifest
+
+
+def write_stubs(root):
+    '''Writes the stub build tools, returning the directory holding them.'''
+    stub_dir = os.path.join(root, STUB_DIR)
+    os.makedirs(stub_dir)
+    for tool, script in _STUBS.items():
+        path = os.path.join(stub_dir, tool)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return stub_dir
+
+
+def get_env(root):
+    '''Returns the environment in which to run ws on the given generated
+    root.'''
+    env = os.environ.copy()
+    env['PYTHONPATH'] = _TOP_DIR
+    env['PATH'] = '%s:%s' % (os.path.join(root, STUB_DIR), env['PATH'])
+    env.pop('WSROOT', None)
+    return env
+
+
+def generate(root,
+             num_projects,
+             depth=4,
+             fanout=2,
+             submodules=0,
+             dirty=0,
+             manifests=0,
+             seed=0):
+    '''Generates a ws root with the given number of projects in the given
+    (existing, empty) directory, and creates a workspace in it. submodules and
+    dirty give how many projects get a submodule and a dirty file.'''
+    rng = random.Random(seed)
+    deps = make_dag(num_projects, depth, fanout, rng)
+    projects = sorted(deps)
+    with_submodule = set(rng.sample(projects, min(submodules, num_projects)))
+    with_dirty = set(rng.sample(projects, min(dirty, num_projects)))
+
+    workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(_make_project,
+                               root,
+                               proj,
+                               proj in with_submodule,
+                               proj in with_dirty)
+                   for proj in projects]
+        for future in futures:
+            future.result()
+
+    manifest = write_manifests(root, deps, manifests)
+    write_stubs(root)
+    subprocess.check_call((sys.executable, _WS, 'init', '-s', 'fs', '-m',
+                           manifest),
+                          cwd=root,
+                          env=get_env(root),
+                          stdout=subprocess.DEVNULL)
+
+
+def main():
+    '''Entrypoint.'''
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic ws root')
+    parser.add_argument(
+        'root',
+        help='Empty or nonexistent directory in which to generate the root')
+    parser.add_argument(
+        '-p', '--projects',
+        action='store',
+        type=int,
+        default=100,
+        help='Number of projects')
+    parser.add_argument(
+        '--depth',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of layers in the dependency graph')
+    parser.add_argument(
+        '--fanout',
+        action='store',
+        type=int,
+        default=2,
+        help='Number of dependencies of each project outside the first layer')
+    parser.add_argument(
+        '--submodules',
+        action='store',
+        type=int,
+        default=0,
+        help='Number of projects with a submodule')
+    parser.add_argument(
+        '--dirty',
+        action='store',
+        type=int,
+        default=0,
+        help='Number of projects with uncommitted changes')
+    parser.add_argument(
+        '--manifests',
+        action='store',
+        type=int,
+        default=0,
+        help=('Split the projects across this many manifests in an included '
+              'directory'))
+    parser.add_argument(
+        '--seed',
+        action='store',
+        type=int,
+        default=0,
+        help='Seed for the random dependency graph')
+    args = parser.parse_args()
+    # Submodule URLs are written into other repositories, so they must not
+    # depend on the directory we ran from.
+    args.root = os.path.abspath(args.root)
+
+    os.makedirs(args.root, exist_ok=True)
+    if len(os.listdir(args.root)) > 0:
+        print('%s is not empty' % args.root)
+        return 1
+    generate(args.root,
+             args.projects,
+             args.depth,
+             args.fanout,
+             args.submodules,
+             args.dirty,
+             args.manifests,
+             args.seed)
+    print('generated %d projects in %s; put %s first in PATH before building'
+          % (args.projects, args.root, os.path.join(args.root, STUB_DIR)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
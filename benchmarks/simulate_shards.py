@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+#
+# Simulates a build split across several machines.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Generates a synthetic root (see generate.py), partitions it with "ws plan
+# --partition", and then builds each shard with "ws build --shard" in its own
+# workspace and process, standing in for a CI machine. Each node starts once
+# the shards it needs have finished, imports their bundles, and exports its
+# own. Finally, a fresh workspace, whose plan should say that nothing was built
+# before, imports every bundle and should then have nothing left to build. The
+# script checks that every project was built by exactly one node, and exits
+# non-zero if anything went wrong.
+#
+# Since the nodes are workspaces of the same root, their install trees live at
+# different paths; this doesn't matter for the stub build tools, but real
+# machines should use the same root and workspace paths.
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import (
+    generate,
+    get_env
+)
+
+_SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+_TOP_DIR = os.path.realpath(os.path.join(_SCRIPT_DIR, os.pardir))
+_WS = os.path.join(_TOP_DIR, 'bin', 'ws')
+sys.path.insert(0, _TOP_DIR)
+
+from wst.conf import (  # noqa: E402
+    get_state,
+    get_ws_dir
+)
+
+
+def ws(root, *args, log=None):
+    '''Runs ws on the given root, returning its exit status. Output goes to
+    the given log file, if any.'''
+    if log is None:
+        out = subprocess.DEVNULL
+    else:
+        out = open(log, 'w')
+    try:
+        return subprocess.call((sys.executable, _WS) + args,
+                               cwd=root,
+                               env=get_env(root),
+                               stdout=out,
+                               stderr=subprocess.STDOUT)
+    finally:
+        if log is not None:
+            out.close()
+
+
+def ws_json(root, *args):
+    '''Runs ws on the given root, returning its output parsed as JSON.'''
+    out = subprocess.check_output((sys.executable, _WS) + args,
+                                  cwd=root,
+                                  env=get_env(root),
+                                  stderr=subprocess.DEVNULL)
+    return json.loads(out.decode('utf-8'))
+
+
+def bundle_path(root, shard):
+    '''Returns the path of the bundle exported by the given shard.'''
+    return os.path.join(root, 'shard%d.tar.gz' % shard)
+
+
+def run_node(root, shard, partition, plan_path):
+    '''Builds a shard in its own workspace, returning its exit status and how
+    long it took.'''
+    args = ['-w', 'node%d' % shard,
+            'build',
+            '--shard', '%d/%d' % (shard, partition['partitions']),
+            '--partition', plan_path,
+            '--export-bundle', bundle_path(root, shard)]
+    for need in partition['shards'][shard - 1]['needs']:
+        args.extend(('--import-bundle', bundle_path(root, need)))
+    start = time.perf_counter()
+    status = ws(root, *args, log=os.path.join(root, 'node%d.log' % shard))
+    return status, time.perf_counter() - start
+
+
+def run_nodes(root, partition, plan_path):
+    '''Runs every shard as soon as the shards it needs are done, returning the
+    set of shards that succeeded.'''
+    shards = dict((s['shard'], s) for s in partition['shards'])
+    pending = set(shards)
+    running = {}
+    succeeded = set()
+    workers = len(shards)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        while True:
+            for shard in sorted(pending):
+                if set(shards[shard]['needs']) <= succeeded:
+                    pending.remove(shard)
+                    future = pool.submit(run_node,
+                                         root,
+                                         shard,
+                                         partition,
+                                         plan_path)
+                    running[future] = shard
+            if len(running) == 0:
+                break
+            finished, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                shard = running.pop(future)
+                status, elapsed = future.result()
+                print('node %d: %d projects in %.2fs%s'
+                      % (shard,
+                         len(shards[shard]['projects']),
+                         elapsed,
+                         '' if status == 0 else ' (failed; see node%d.log)'
+                         % shard))
+                if status == 0:
+                    succeeded.add(shard)
+    for shard in sorted(pending):
+        print('node %d: never started' % shard)
+    return succeeded
+
+
+def get_builds(root, name):
+    '''Returns how many times each project was built in the given
+    workspace.'''
+    ws_dir = get_ws_dir(os.path.join(root, '.ws'), name)
+    history = get_state(ws_dir).get_history()
+    return collections.Counter(proj for proj, phase, _, _, _, _ in history
+                               if phase == 'build')
+
+
+def simulate(root, num_projects, nodes, depth, fanout):
+    '''Runs the simulation in the given empty directory, returning 0 if it
+    went as expected.'''
+    generate(root, num_projects, depth, fanout)
+    plan_path = os.path.join(root, 'plan.json')
+    if ws(root, 'plan', '--partition', str(nodes), '-o', plan_path) != 0:
+        print('ws plan failed')
+        return 1
+    with open(plan_path, 'r') as f:
+        partition = json.load(f)
+
+    manifest = os.path.join(root, 'ws.yaml')
+    names = ['node%d' % s for s in range(1, nodes + 1)] + ['verify']
+    for name in names:
+        if ws(root, 'init', '-s', 'fs', '-m', manifest, name) != 0:
+            print('cannot create workspace %s' % name)
+            return 1
+
+    # Nothing has been built in a fresh workspace, which is the only reason
+    # its plan should give.
+    plan = ws_json(root, '-w', 'verify', 'plan', '--json')
+    reasons = set(p['reason'] for p in plan['projects'])
+    if reasons != {'not built before'}:
+        print('fresh workspace plan gives reasons %s'
+              % ', '.join(sorted(reasons)))
+        return 1
+
+    start = time.perf_counter()
+    succeeded = run_nodes(root, partition, plan_path)
+    print('all nodes: %.2fs' % (time.perf_counter() - start))
+    if len(succeeded) != nodes:
+        return 1
+
+    status = 0
+    builds = collections.Counter()
+    for shard in range(1, nodes + 1):
+        builds.update(get_builds(root, 'node%d' % shard))
+    projects = [proj for s in partition['shards'] for proj in s['projects']]
+    twice = sorted(proj for proj, count in builds.items() if count > 1)
+    missing = sorted(proj for proj in projects if proj not in builds)
+    if len(twice) > 0:
+        print('built more than once: %s' % ', '.join(twice))
+        status = 1
+    if len(missing) > 0:
+        print('never built: %s' % ', '.join(missing))
+        status = 1
+
+    # Importing every bundle should leave nothing to build.
+    args = ['-w', 'verify', 'build']
+    for shard in range(1, nodes + 1):
+        args.extend(('--import-bundle', bundle_path(root, shard)))
+    if ws(root, *args, log=os.path.join(root, 'verify.log')) != 0:
+        print('importing every bundle failed; see verify.log')
+        return 1
+    rebuilt = sorted(get_builds(root, 'verify'))
+    if len(rebuilt) > 0:
+        print('rebuilt after importing every bundle: %s' % ', '.join(rebuilt))
+        status = 1
+
+    if status == 0:
+        print('%d projects built once each across %d nodes'
+              % (len(projects), nodes))
+    return status
+
+
+def main():
+    '''Entrypoint.'''
+    parser = argparse.ArgumentParser(
+        description='Simulate a build sharded across machines')
+    parser.add_argument(
+        '-p', '--projects',
+        action='store',
+        type=int,
+        default=50,
+        help='Number of projects')
+    parser.add_argument(
+        '-n', '--nodes',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of simulated machines')
+    parser.add_argument(
+        '--depth',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of layers in the dependency graph')
+    parser.add_argument(
+        '--fanout',
+        action='store',
+        type=int,
+        default=2,
+        help='Number of dependencies of each project outside the first layer')
+    parser.add_argument(
+        '-k', '--keep',
+        action='store',
+        default=None,
+        metavar='DIR',
+        help='Run in the given empty directory and keep it afterwards, '
+             'including each node\'s log')
+    args = parser.parse_args()
+
+    if args.keep is not None:
+        os.makedirs(args.keep, exist_ok=True)
+        if len(os.listdir(args.keep)) > 0:
+            print('%s is not empty' % args.keep)
+            return 1
+        return simulate(os.path.realpath(args.keep),
+                        args.projects,
+                        args.nodes,
+                        args.depth,
+                        args.fanout)
+    with tempfile.TemporaryDirectory() as root:
+        return simulate(os.path.realpath(root),
+                        args.projects,
+                        args.nodes,
+                        args.depth,
+                        args.fanout)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
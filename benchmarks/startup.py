@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+#
+# Startup-time benchmark for the ws tool.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Measures how long "ws list" takes to start up, which is what bash completion
+# pays on every tab. Since interpreter startup varies a lot between machines,
+# the budget applies to the time spent on top of a bare "python3 -c pass". The
+# script also checks that "ws list" does not import any of the modules that
+# should only be loaded by the commands that need them. It exits non-zero if
+# either check fails.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+_SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+_TOP_DIR = os.path.realpath(os.path.join(_SCRIPT_DIR, os.pardir))
+_WS = os.path.join(_TOP_DIR, 'bin', 'ws')
+
+# Modules that "ws list" should never need to import.
+_FORBIDDEN_MODULES = (
+    'multiprocessing',
+    'wst.builder.cmake',
+    'wst.builder.meson',
+    'wst.builder.setuptools',
+    'wst.cmd.build',
+    'wst.cmd.clean',
+    'wst.cmd.config',
+    'wst.cmd.env',
+    'wst.cmd.init',
+    'wst.cmd.plan',
+    'wst.cmd.test',
+    'wst.events',
+    'wst.metrics',
+    'wst.profiling',
+    'wst.shell',
+    'wst.trace',
+    'wst.trash',
+    'yaml',
+)
+
+# Runs bin/ws in-process and then writes out the set of imported modules.
+_IMPORT_CHECK = '''
+import runpy
+import sys
+ws, out = sys.argv[1], sys.argv[2]
+sys.argv = [ws] + sys.argv[3:]
+try:
+    runpy.run_path(ws, run_name='__main__')
+except SystemExit:
+    pass
+with open(out, 'w') as f:
+    f.write('\\n'.join(sorted(sys.modules)))
+'''
+
+
+def make_workspace(path, num_projects):
+    '''Creates a minimal ws root with the given number of projects. The
+    projects don't need to exist on disk, as "ws list" only reads the
+    manifest.'''
+    manifest = os.path.join(path, 'ws.yaml')
+    with open(manifest, 'w') as f:
+        f.write('projects:\n')
+        for i in range(num_projects):
+            f.write('    proj%d:\n' % i)
+            f.write('        build: cmake\n')
+            if i > 0:
+                f.write('        deps:\n')
+                f.write('            - proj%d\n' % (i - 1))
+    subprocess.check_call((sys.executable, _WS, 'init', '-s', 'fs', '-m',
+                           manifest),
+                          cwd=path,
+                          env=get_env())
+
+    # ws doesn't cache a manifest that changed in the last couple of seconds,
+    # so age it and run once to fill the cache, as it would be by the time
+    # anyone tab-completes.
+    old = time.time() - 60
+    os.utime(manifest, (old, old))
+    subprocess.check_call((sys.executable, _WS, 'list'),
+                          cwd=path,
+                          env=get_env(),
+                          stdout=subprocess.DEVNULL)
+
+
+def get_env():
+    '''Returns the environment in which to run ws.'''
+    env = os.environ.copy()
+    env['PYTHONPATH'] = _TOP_DIR
+    env.pop('WSROOT', None)
+    return env
+
+
+def time_cmd(cmd, cwd, runs):
+    '''Returns the median wall time in seconds of running the given
+    command.'''
+    env = get_env()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, cwd=cwd, env=env,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def check_imports(cwd):
+    '''Returns the list of forbidden modules imported by "ws list".'''
+    with tempfile.NamedTemporaryFile('r') as f:
+        subprocess.check_call((sys.executable, '-c', _IMPORT_CHECK, _WS,
+                               f.name, 'list'),
+                              cwd=cwd,
+                              env=get_env(),
+                              stdout=subprocess.DEVNULL)
+        modules = set(f.read().split('\n'))
+    return [m for m in _FORBIDDEN_MODULES if m in modules]
+
+
+def main():
+    '''Entrypoint.'''
+    parser = argparse.ArgumentParser(description='Benchmark ws startup')
+    parser.add_argument(
+        '-b', '--budget',
+        action='store',
+        type=float,
+        default=0.1,
+        help='Maximum time in seconds that "ws list" may add on top of bare '
+             'interpreter startup')
+    parser.add_argument(
+        '-p', '--projects',
+        action='store',
+        type=int,
+        default=100,
+        help='Number of projects in the benchmark manifest')
+    parser.add_argument(
+        '-r', '--runs',
+        action='store',
+        type=int,
+        default=20,
+        help='Number of runs to take the median of')
+    args = parser.parse_args()
+
+    status = 0
+    with tempfile.TemporaryDirectory() as path:
+        make_workspace(path, args.projects)
+
+        imported = check_imports(path)
+        if len(imported) > 0:
+            print('ws list imported %s' % ', '.join(imported))
+            status = 1
+
+        baseline = time_cmd((sys.executable, '-c', 'pass'), path, args.runs)
+        ws_list = time_cmd((sys.executable, _WS, 'list'), path, args.runs)
+
+    overhead = ws_list - baseline
+    print('python startup: %.1f ms' % (baseline * 1000))
+    print('ws list:        %.1f ms' % (ws_list * 1000))
+    print('overhead:       %.1f ms (budget %.1f ms)'
+          % (overhead * 1000, args.budget * 1000))
+    if overhead > args.budget:
+        print('ws list is over its startup budget')
+        status = 1
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
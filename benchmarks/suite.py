@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+#
+# Benchmark suite for the ws tool.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Generates synthetic workspaces of increasing size (see generate.py) and times
+# the parts of ws that grow with the number of projects: parsing the manifest,
+# computing dependency closures, composing build environments, checksumming
+# every source tree the way ws build does, and a whole no-op ws build. Each
+# measurement is the median of several runs. The results can be written out as
+# JSON and compared against an earlier run to see whether a change made any
+# of them slower.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import (
+    generate,
+    get_env
+)
+
+_SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+_TOP_DIR = os.path.realpath(os.path.join(_SCRIPT_DIR, os.pardir))
+_WS = os.path.join(_TOP_DIR, 'bin', 'ws')
+sys.path.insert(0, _TOP_DIR)
+
+from wst.conf import (  # noqa: E402
+    calculate_checksum,
+    clear_caches,
+    dependency_closure,
+    get_build_env,
+    get_source_dir,
+    get_ws_config,
+    get_ws_dir,
+    parse_manifest
+)
+
+_DEFAULT_SIZES = (10, 100, 1000, 10000)
+
+# How much slower a benchmark must get for --compare to flag it.
+_REGRESSION_THRESHOLD = 1.1
+
+
+def median_time(func, runs, setup=None):
+    '''Returns the median wall time in seconds of calling func, calling setup
+    (untimed) before each run if given.'''
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_parse_manifest(root, ws, runs):
+    '''Times parsing the manifest from scratch.'''
+    return median_time(lambda: parse_manifest(root), runs, clear_caches)
+
+
+def bench_dependency_closure(root, ws, runs):
+    '''Times computing the dependency closure of every project.'''
+    d = parse_manifest(root)
+    return median_time(lambda: dependency_closure(d, list(d)), runs)
+
+
+def bench_get_build_env(root, ws, runs):
+    '''Times composing the build environment of every project, starting with
+    nothing cached.'''
+    def setup():
+        '''Drops the cached environments, keeping the config loaded.'''
+        clear_caches()
+        get_ws_config(ws)
+
+    def compose():
+        '''Composes every build environment.'''
+        d = parse_manifest(root)
+        for proj in d:
+            get_build_env(ws, d, proj)
+    return median_time(compose, runs, setup)
+
+
+def bench_checksums(root, ws, runs):
+    '''Times checksumming every source tree with a process pool, the way ws
+    build does.'''
+    d = parse_manifest(root)
+    src_dirs = [get_source_dir(root, d, proj) for proj in d]
+
+    def checksum():
+        '''Checksums every source tree.'''
+        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+            pool.map(calculate_checksum, src_dirs)
+    return median_time(checksum, runs)
+
+
+def bench_noop_build(root, ws, runs):
+    '''Times a whole ws build with nothing to rebuild.'''
+    cwd = os.path.join(root, os.pardir)
+    env = get_env(cwd)
+
+    def build():
+        '''Runs ws build.'''
+        subprocess.check_call((sys.executable, _WS, 'build'),
+                              cwd=cwd,
+                              env=env,
+                              stdout=subprocess.DEVNULL)
+    # The first build actually builds everything.
+    build()
+    return median_time(build, runs)
+
+
+_BENCHMARKS = (
+    ('parse_manifest', bench_parse_manifest),
+    ('dependency_closure', bench_dependency_closure),
+    ('get_build_env', bench_get_build_env),
+    ('calculate_checksum', bench_checksums),
+    ('noop_build', bench_noop_build),
+)
+
+
+def run_size(num_projects, args):
+    '''Generates a workspace with the given number of projects and runs every
+    benchmark on it, returning a dictionary of median times in seconds.'''
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        generate(path,
+                 num_projects,
+                 args.depth,
+                 args.fanout,
+                 int(num_projects * args.submodule_ratio),
+                 int(num_projects * args.dirty_ratio),
+                 args.manifests,
+                 args.seed)
+        print('%d projects: generated in %.1f s'
+              % (num_projects, time.perf_counter() - start))
+
+        root = os.path.join(path, '.ws')
+        ws = get_ws_dir(root, 'default')
+        results = {}
+        for name, bench in _BENCHMARKS:
+            if name not in args.only:
+                continue
+            clear_caches()
+            results[name] = bench(root, ws, args.runs)
+            print('%d projects: %-20s %10.1f ms'
+                  % (num_projects, name, results[name] * 1000))
+        clear_caches()
+    return results
+
+
+def compare(old, new):
+    '''Prints the ratio of new to old times for every benchmark both ran,
+    returning the number that got slower by more than the threshold.'''
+    regressions = 0
+    for size, results in sorted(new['results'].items(), key=lambda r:
+                                int(r[0])):
+        try:
+            old_results = old['results'][size]
+        except KeyError:
+            continue
+        for name, secs in sorted(results.items()):
+            try:
+                old_secs = old_results[name]
+            except KeyError:
+                continue
+            ratio = secs / old_secs if old_secs > 0 else float('inf')
+            flag = ''
+            if ratio > _REGRESSION_THRESHOLD:
+                flag = '  <- slower'
+                regressions += 1
+            print('%6s projects: %-20s %10.1f ms -> %10.1f ms  (%.2fx)%s'
+                  % (size, name, old_secs * 1000, secs * 1000, ratio, flag))
+    return regressions
+
+
+def _sizes(val):
+    '''Parses a comma-separated list of workspace sizes.'''
+    try:
+        sizes = [int(size) for size in val.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a list of sizes' % val)
+    if any(size <= 0 for size in sizes):
+        raise argparse.ArgumentTypeError('sizes must be positive')
+    return sizes
+
+
+def main():
+    '''Entrypoint.'''
+    parser = argparse.ArgumentParser(description='Benchmark ws')
+    parser.add_argument(
+        '-s', '--sizes',
+        action='store',
+        type=_sizes,
+        default=_DEFAULT_SIZES,
+        help=('Comma-separated numbers of projects to benchmark with '
+              '(default: %s)' % ','.join(str(s) for s in _DEFAULT_SIZES)))
+    parser.add_argument(
+        '-r', '--runs',
+        action='store',
+        type=int,
+        default=3,
+        help='Number of runs to take the median of')
+    parser.add_argument(
+        '-b', '--benchmark',
+        action='append',
+        dest='only',
+        choices=[name for name, _ in _BENCHMARKS],
+        help='Run only the given benchmark (may be given more than once)')
+    parser.add_argument(
+        '--depth',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of layers in the dependency graph')
+    parser.add_argument(
+        '--fanout',
+        action='store',
+        type=int,
+        default=2,
+        help='Number of dependencies of each project outside the first layer')
+    parser.add_argument(
+        '--submodule-ratio',
+        action='store',
+        type=float,
+        default=0.1,
+        help='Fraction of projects with a submodule')
+    parser.add_argument(
+        '--dirty-ratio',
+        action='store',
+        type=float,
+        default=0.1,
+        help='Fraction of projects with uncommitted changes')
+    parser.add_argument(
+        '--manifests',
+        action='store',
+        type=int,
+        default=4,
+        help=('Split the projects across this many manifests in an included '
+              'directory; 0 puts them all in one'))
+    parser.add_argument(
+        '--seed',
+        action='store',
+        type=int,
+        default=0,
+        help='Seed for the random dependency graphs')
+    parser.add_argument(
+        '-o', '--output',
+        action='store',
+        help='Write the results to the given JSON file')
+    parser.add_argument(
+        '-c', '--compare',
+        action='store',
+        help=('Compare the results to an earlier JSON file, exiting non-zero '
+              'if anything got more than 10%% slower'))
+    args = parser.parse_args()
+    if args.only is None:
+        args.only = [name for name, _ in _BENCHMARKS]
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = run_size(size, args)
+
+    output = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.time(),
+        'params': {
+            'runs': args.runs,
+            'depth': args.depth,
+            'fanout': args.fanout,
+            'submodule_ratio': args.submodule_ratio,
+            'dirty_ratio': args.dirty_ratio,
+            'manifests': args.manifests,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
+            f.write('\n')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        if compare(old, output) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
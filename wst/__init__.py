@@ -24,7 +24,9 @@
 #
 
 
+import contextlib
 import logging
+import sys
 
 
 # Constants used by multiple modules. Normally we would put these in conf, but
@@ -60,3 +62,14 @@ def log(msg, level=logging.DEBUG):
 def log_cmd(cmd, level=logging.DEBUG):
     '''Logs a given command being run.'''
     log(' '.join(cmd), level=level)
+
+
+def span(name, cat='ws', **args):
+    '''Returns wst.trace.span for the given arguments. Nothing can be traced
+    or timed before something imports wst.trace, so until then this returns a
+    block that does nothing, which keeps wst.trace off the startup path of
+    quick commands.'''
+    trace = sys.modules.get('wst.trace')
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, cat, **args)
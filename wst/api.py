@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+#
+# A Python API for driving ws in-process.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# This module lets other Python programs drive ws without shelling out to it.
+# A Workspace loads the manifest and config once and then runs the same
+# Command.do implementations that bin/ws does, returning structured results
+# rather than log lines. bin/ws itself runs workspace commands through here.
+#
+# Example:
+#
+#     from wst.api import Workspace
+#
+#     ws = Workspace(start_dir='/path/to/source')
+#     result = ws.build(['some-project'], progress=print)
+#     if not result.ok:
+#         print(result.error)
+#     for r in result.projects:
+#         print(r['project'], r['status'], r['duration'])
+
+import argparse
+import collections
+import importlib
+import os
+import threading
+import time
+
+from wst import WSError
+from wst.conf import (
+    calculate_checksums,
+    clear_config_cache,
+    clear_manifest_cache,
+    dependency_closure,
+    find_root,
+    get_default_ws_link,
+    get_source_dir,
+    get_ws_config,
+    get_ws_dir,
+    parse_manifest,
+    sync_config
+)
+from wst.events import (
+    start_event_log,
+    stop_event_log
+)
+from wst.lock import lock_workspace
+from wst.metrics import write_metrics
+
+
+# The event log, trace and phase timings that commands record into are
+# process-wide, so only one command may run at a time in a process, whichever
+# workspace it is for.
+_RUN_LOCK = threading.RLock()
+
+# The outcome of running a command. ok is whether it succeeded, error is the
+# error message if it didn't, and projects is a list of per-project results,
+# each a dictionary holding the project, phase, status and duration in seconds.
+Result = collections.namedtuple('Result', ('ok', 'error', 'projects'))
+
+
+def _default_args(cls):
+    '''Returns the arguments a command gets when none are given on the command
+    line.'''
+    parser = argparse.ArgumentParser()
+    cls.args(parser)
+    args = argparse.Namespace()
+    for action in parser._actions:
+        if action.dest != argparse.SUPPRESS and action.dest != 'help':
+            setattr(args, action.dest, action.default)
+    return args
+
+
+def _get_cmd(module, cmd):
+    '''Imports and returns the given command class.'''
+    return getattr(importlib.import_module(module), cmd)
+
+
+class Workspace(object):
+    '''A single workspace inside a ws root. Any number of these can be open
+    at once, for the same or different roots, but a process runs only one
+    command at a time; run() waits for any other command in progress to
+    finish.'''
+    def __init__(self, root=None, name=None, start_dir=None):
+        '''Opens a workspace. If root is not given, it is found by searching
+        upward from start_dir (or the current directory). If name is not
+        given, the default workspace is used.'''
+        if root is None:
+            if start_dir is None:
+                start_dir = os.getcwd()
+            root = find_root(start_dir)
+            if root is None:
+                raise WSError("can't find .ws directory from %s" % start_dir)
+        self.root = root
+        if name is None:
+            name = get_default_ws_link(root)
+        self.name = name
+        self.ws_dir = get_ws_dir(root, name)
+        if not os.path.isdir(self.ws_dir):
+            raise WSError('workspace %s at %s does not exist.'
+                          % (name, self.ws_dir))
+        self.reload()
+
+    def reload(self):
+        '''Re-reads the manifest and workspace config, picking up changes made
+        by anyone else since they were loaded.'''
+        # Don't read the workspace while someone is removing it.
+        with lock_workspace(self.ws_dir):
+            clear_manifest_cache(self.root)
+            clear_config_cache(self.ws_dir)
+            self.manifest = parse_manifest(self.root)
+            self.config = get_ws_config(self.ws_dir)
+
+    def projects(self):
+        '''Returns the names of all projects in the manifest.'''
+        return list(self.manifest.keys())
+
+    def run(self, cls, args):
+        '''Runs the given command class with the given arguments, returning a
+        Result. Errors ws reports to the user are returned in the Result; any
+        other exception propagates.'''
+        args.root = self.root
+        args.ws = self.name
+        results = getattr(args, 'results', None)
+        if results is None:
+            results = []
+            args.results = results
+
+        # Keep the workspace from being removed or renamed while we use it.
+        start = time.time()
+        with _RUN_LOCK, lock_workspace(self.ws_dir):
+            start_event_log(self.ws_dir)
+            try:
+                cls.do(self.ws_dir, args)
+            except WSError as e:
+                result = Result(False, str(e), results)
+            else:
+                result = Result(True, None, results)
+            finally:
+                stop_event_log()
+                sync_config(self.ws_dir)
+            if cls.metrics:
+                # Commands working on several workspaces name them in their
+                # results.
+                names = set(r['workspace'] for r in results
+                            if 'workspace' in r)
+                names.add(self.name)
+                write_metrics(self.root,
+                              names,
+                              cls.__name__.lower(),
+                              result.ok,
+                              time.time() - start)
+        return result
+
+    def _run(self, module, cmd, progress, **fields):
+        '''Runs the given command with its default arguments, overridden by the
+        given fields.'''
+        cls = _get_cmd(module, cmd)
+        args = _default_args(cls)
+        for k, v in fields.items():
+            setattr(args, k, v)
+        args.progress = progress
+        return self.run(cls, args)
+
+    def build(self, projects=(), force=False, progress=None):
+        '''Builds the given projects and their dependencies, or everything if
+        no projects are given. progress, if given, is called with a dictionary
+        for every project as it starts and finishes, possibly from a worker
+        thread.'''
+        return self._run('wst.cmd.build', 'Build', progress,
+                         projects=list(projects), force=force)
+
+    def clean(self, projects=(), force=False, progress=None):
+        '''Cleans the given projects, or everything if no projects are
+        given.'''
+        return self._run('wst.cmd.clean', 'Clean', progress,
+                         projects=list(projects), force=force)
+
+    def test(self, projects=(), progress=None):
+        '''Tests the given projects, or everything if no projects are
+        given.'''
+        return self._run('wst.cmd.test', 'Test', progress,
+                         projects=list(projects))
+
+    def env(self, proj):
+        '''Returns the environment in which commands for the given project
+        run, as "ws env" would set it up.'''
+        from wst.cmd.env import get_env
+        if proj not in self.manifest:
+            raise WSError('unknown project %s' % proj)
+        return get_env(self.root, self.ws_dir, proj)
+
+    def fingerprint(self, projects=()):
+        '''Returns a dictionary mapping each of the given projects and their
+        dependencies (or every project if none are given) to the checksum of
+        its source tree, which is what ws compares to decide what to
+        rebuild.'''
+        for proj in projects:
+            if proj not in self.manifest:
+                raise WSError('unknown project %s' % proj)
+        if len(projects) == 0:
+            projects = self.manifest.keys()
+        order = dependency_closure(self.manifest, projects)
+
+        src_dirs = [get_source_dir(self.root, self.manifest, proj)
+                    for proj in order]
+        return dict(zip(order, calculate_checksums(src_dirs)))
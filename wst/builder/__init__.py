@@ -29,6 +29,9 @@ class Builder(object):
     '''A builder, representing the interaction with an underlying build
     system, such as CMake or meson. Since this is really an interface and not a
     class, all methods on it should be class methods.'''
+    # Whether the build system has its own test runner, which test() runs.
+    native_tests = False
+
     @classmethod
     def env(cls,
             proj,
@@ -51,6 +54,21 @@ class Builder(object):
              builder_args):
         raise NotImplementedError
 
+    @classmethod
+    def reconf(cls,
+               proj,
+               prefix,
+               source_dir,
+               build_dir,
+               env,
+               build_type,
+               builder_args,
+               args):
+        '''Re-runs configure in an existing build directory with new arguments,
+        keeping whatever was already built so that the next build only
+        rebuilds what the change affects.'''
+        raise NotImplementedError
+
     @classmethod
     def build(cls,
               proj,
@@ -65,3 +83,19 @@ class Builder(object):
     @classmethod
     def clean(cls, proj, build_dir, env, builder_args):
         raise NotImplementedError
+
+    @classmethod
+    def test(cls,
+             proj,
+             prefix,
+             source_dir,
+             build_dir,
+             env,
+             builder_args,
+             jobs,
+             history):
+        '''Runs the project's own test suite using up to the given number of
+        parallel jobs. history maps test names to how long they took last
+        time. Returns whether the tests passed, a list of per-test results,
+        and the output of the test runner.'''
+        raise NotImplementedError
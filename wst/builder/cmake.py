@@ -24,16 +24,51 @@
 #
 
 
+import re
+
 from wst.builder import Builder
 from wst.shell import (
     call_build,
     call_clean,
-    call_configure
+    call_configure,
+    call_test_output
 )
 
 
+# A line of ctest's progress output for a finished test, such as:
+#   3/10 Test  #3: some-test ........................***Failed    0.52 sec
+_CTEST_RESULT = re.compile(
+    r'^\s*\d+/\d+\s+Test\s+#\d+:\s+(?P<name>\S+)\s+\.*\s*'
+    r'(?:\*{3})?(?P<result>.*?)\s+(?P<duration>[0-9.]+)\s+sec\s*$')
+
+
+def parse_ctest_output(output):
+    '''Returns the per-test results from the given ctest output.'''
+    cases = []
+    for line in output.splitlines():
+        m = _CTEST_RESULT.match(line)
+        if m is None:
+            continue
+        result = m.group('result')
+        if result == 'Passed':
+            status = 'passed'
+        elif result.startswith('Not Run') or result.startswith('Skipped'):
+            status = 'skipped'
+        else:
+            status = 'failed'
+        cases.append({
+            'name': m.group('name'),
+            'status': status,
+            'duration': float(m.group('duration')),
+            'output': ''
+        })
+    return cases
+
+
 class CMakeBuilder(Builder):
     '''A CMake builder.'''
+    native_tests = True
+
     @classmethod
     def env(cls, proj, prefix, build_dir, env, builder_args):
         '''Sets up environment tweaks for cmake.'''
@@ -59,6 +94,27 @@ class CMakeBuilder(Builder):
         cmd.append(source_dir)
         return call_configure(cmd, env=env, cwd=build_dir)
 
+    @classmethod
+    def reconf(cls,
+               proj,
+               prefix,
+               source_dir,
+               build_dir,
+               env,
+               build_type,
+               builder_args,
+               args):
+        '''Reconfigures using CMake. Re-running cmake in an existing build
+        directory updates its cache in place.'''
+        return cls.conf(proj,
+                        prefix,
+                        source_dir,
+                        build_dir,
+                        env,
+                        build_type,
+                        builder_args,
+                        args)
+
     @classmethod
     def build(cls,
               proj,
@@ -76,3 +132,23 @@ class CMakeBuilder(Builder):
     def clean(cls, proj, prefix, source_dir, build_dir, env, builder_args):
         '''Calls clean using CMake.'''
         return call_clean(('ninja', '-C', build_dir, 'clean'), env=env)
+
+    @classmethod
+    def test(cls,
+             proj,
+             prefix,
+             source_dir,
+             build_dir,
+             env,
+             builder_args,
+             jobs,
+             history):
+        '''Runs the tests using ctest. ctest already orders parallel tests by
+        the costs it recorded in previous runs, so history isn't needed.'''
+        cmd = ('ctest', '--output-on-failure', '-j', str(jobs))
+        success, output = call_test_output(cmd, cwd=build_dir, env=env)
+        cases = parse_ctest_output(output)
+        for case in cases:
+            case['cwd'] = build_dir
+            case['cmd'] = 'ctest --output-on-failure -R ^%s$' % case['name']
+        return success, cases, output
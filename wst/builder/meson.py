@@ -23,16 +23,85 @@
 # SOFTWARE.
 #
 
+import json
+import os
+import subprocess
+
+from wst import log
 from wst.builder import Builder
 from wst.shell import (
     call_build,
     call_clean,
-    call_configure
+    call_configure,
+    call_output,
+    call_test_output,
+    remove
 )
 
 
+# How meson test reports results in its JSON log.
+_MESON_STATUSES = {
+    'OK': 'passed',
+    'EXPECTEDFAIL': 'passed',
+    'SKIP': 'skipped'
+}
+
+
+def _bare_name(name):
+    '''Strips the "project:suite / " prefix meson adds to test names in its
+    logs.'''
+    return name.rsplit(' / ', 1)[-1]
+
+
+def get_test_names(build_dir, env):
+    '''Returns the names of the tests in a meson build directory, or None if
+    they can't be determined.'''
+    try:
+        out = call_output(('meson', 'introspect', '--tests', build_dir),
+                          env=env)
+    except subprocess.CalledProcessError:
+        return None
+    if out is None:
+        # Dry run.
+        return None
+    try:
+        tests = json.loads(out)
+    except ValueError:
+        return None
+    names = []
+    for test in tests:
+        if test['name'] not in names:
+            names.append(test['name'])
+    return names
+
+
+def parse_test_log(path):
+    '''Returns the per-test results from the given meson test JSON log, or None
+    if there is no log.'''
+    try:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None
+    cases = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        cases.append({
+            'name': _bare_name(entry['name']),
+            'status': _MESON_STATUSES.get(entry['result'], 'failed'),
+            'duration': entry.get('duration', 0),
+            'output': entry.get('stdout') or ''
+        })
+    return cases
+
+
 class MesonBuilder(Builder):
     '''A meson builder.'''
+    native_tests = True
+
     @classmethod
     def env(cls, proj, prefix, build_dir, env, builder_args):
         '''Sets up environment tweaks for meson.'''
@@ -58,6 +127,27 @@ class MesonBuilder(Builder):
         cmd.append(source_dir)
         return call_configure(cmd, env=env)
 
+    @classmethod
+    def reconf(cls,
+               proj,
+               prefix,
+               source_dir,
+               build_dir,
+               env,
+               build_type,
+               builder_args,
+               args):
+        '''Reconfigures an existing Meson build directory.'''
+        cmd = [
+            'meson',
+            '--reconfigure',
+            '--buildtype', build_type,
+            '--prefix', prefix]
+        cmd.extend(args)
+        cmd.append(build_dir)
+        cmd.append(source_dir)
+        return call_configure(cmd, env=env)
+
     @classmethod
     def build(cls,
               proj,
@@ -75,3 +165,36 @@ class MesonBuilder(Builder):
     def clean(cls, proj, prefix, source_dir, build_dir, env, builder_args):
         '''Calls clean using the Meson build itself.'''
         return call_clean(('ninja', '-C', build_dir, 'clean'), env=env)
+
+    @classmethod
+    def test(cls,
+             proj,
+             prefix,
+             source_dir,
+             build_dir,
+             env,
+             builder_args,
+             jobs,
+             history):
+        '''Runs the tests using meson test, starting the tests that took the
+        longest last time first so that they don't hold up the end of the
+        run.'''
+        cmd = ['meson', 'test', '-C', build_dir, '--num-processes', str(jobs)]
+        names = get_test_names(build_dir, env)
+        if names is not None and len(history) > 0:
+            # Tests we haven't seen before might be slow, so start them first.
+            names.sort(key=lambda name: -history.get(name, float('inf')))
+            cmd.extend(names)
+        else:
+            log('running %s tests in meson order' % proj)
+
+        log_path = os.path.join(build_dir, 'meson-logs', 'testlog.json')
+        remove(log_path, True)
+        success, output = call_test_output(cmd, env=env)
+        cases = parse_test_log(log_path)
+        if cases is None:
+            cases = []
+        for case in cases:
+            case['cwd'] = build_dir
+            case['cmd'] = 'meson test -C %s %s' % (build_dir, case['name'])
+        return success, cases, output
@@ -37,12 +37,19 @@ from wst.shell import (
 )
 
 
-def get_python_version(python_exe):
+_PYTHON_VERSIONS = {}
+def get_python_version(python_exe):  # noqa: E302
     '''Returns the Python version of the given executable.'''
+    try:
+        return _PYTHON_VERSIONS[python_exe]
+    except KeyError:
+        pass
     cmd = 'import sys;print("%d.%d" % (sys.version_info[0], sys.version_info[1]))'  # noqa: E501
     ver_str = call_output((python_exe, '-c', cmd))
     split = ver_str.rstrip().split('.')
-    return (int(split[0]), int(split[1]))
+    version = (int(split[0]), int(split[1]))
+    _PYTHON_VERSIONS[python_exe] = version
+    return version
 
 
 def get_python_exe(builder_args):
@@ -104,6 +111,20 @@ class SetuptoolsBuilder(Builder):
         # setuptools doesn't have a configure step.
         return True
 
+    @classmethod
+    def reconf(cls,
+               proj,
+               prefix,
+               source_dir,
+               build_dir,
+               env,
+               build_type,
+               builder_args,
+               args):
+        '''Calls reconfigure using setuptools.'''
+        # setuptools doesn't have a configure step.
+        return True
+
     @classmethod
     def build(cls,
               proj,
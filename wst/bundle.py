@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+#
+# Bundles of install trees for handing builds between machines.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# A bundle is a gzipped tarball holding the install trees of some projects of
+# a workspace, along with the checksums of the sources they were built from.
+# Importing a bundle into another workspace of the same build type makes those
+# projects count as built, so that building the projects depending on them
+# doesn't build them again. This is how the shards of a partitioned build (see
+# wst.partition) pass their results on. Install trees can contain absolute
+# paths, so a bundle should only be imported into a workspace at the same path
+# as the one it was exported from.
+#
+# The build directory of an imported project holds only its install tree, so if
+# it needs to be built later, it is force-cleaned first.
+#
+# Links inside a bundle must stay inside the install tree they belong to, so
+# that extracting one can't write anywhere else. Absolute symlinks into the
+# install tree are made relative on export.
+
+import errno
+import io
+import json
+import logging
+import os
+import tarfile
+import tempfile
+
+from wst import (
+    WSError,
+    dry_run,
+    log
+)
+from wst.conf import (
+    dependency_closure,
+    get_build_type,
+    get_build_type_dir,
+    get_build_dir,
+    get_cache_key,
+    get_install_dir,
+    get_proj_dir,
+    get_stored_checksum,
+    invalidate_checksums,
+    set_cache_key,
+    set_stored_checksum
+)
+from wst.lock import lock_projects
+from wst.shell import (
+    mkdir,
+    rename
+)
+from wst.trash import trash
+
+
+# The version of the bundle format.
+_FORMAT = 1
+
+# The name of the file inside a bundle describing it.
+_INFO = 'bundle.json'
+
+# The directory inside a bundle holding the install trees.
+_INSTALL = 'install'
+
+
+def _imported_kind(ws):
+    '''Returns the kind of cache key marking a project's build of the current
+    type as imported.'''
+    return 'imported-%s' % get_build_type(ws)
+
+
+def is_imported(ws, proj):
+    '''Returns True if the project's build directory came from a bundle rather
+    than being built here.'''
+    return get_cache_key(ws, proj, _imported_kind(ws)) is not None
+
+
+def clear_imported(ws, proj):
+    '''Forgets that the project's build directory came from a bundle.'''
+    set_cache_key(ws, proj, _imported_kind(ws), None)
+
+
+def _inside(path, top):
+    '''Returns True if the given normalized path is top or below it.'''
+    return path == top or path.startswith(top + os.sep)
+
+
+def _relative_links(install_dir, arcname, path):
+    '''Returns a tar.add filter rewriting absolute symlinks into the install
+    tree added as the given arcname to relative ones, and refusing links that
+    lead out of it.'''
+    # Links may reach the install tree through symlinks, such as that of the
+    # default workspace.
+    install_dir = os.path.realpath(install_dir)
+
+    def rewrite(member):
+        '''Rewrites a single member.'''
+        if not (member.issym() or member.islnk()):
+            return member
+        if member.islnk():
+            # Hard links name another member of the archive.
+            target = os.path.normpath(member.linkname)
+            top = arcname
+        else:
+            # The member's location on disk, which its link is relative to.
+            src = os.path.join(install_dir, member.name[len(arcname) + 1:])
+            target = os.path.join(os.path.dirname(src), member.linkname)
+            target = os.path.normpath(os.path.join(
+                os.path.realpath(os.path.dirname(target)),
+                os.path.basename(target)))
+            top = install_dir
+        if not _inside(target, top):
+            raise WSError("can't bundle %s, since %s links to %s, outside "
+                          "its install tree"
+                          % (path, member.name, member.linkname))
+        if member.issym() and os.path.isabs(member.linkname):
+            member.linkname = os.path.relpath(target, os.path.dirname(src))
+        return member
+
+    return rewrite
+
+
+def export_bundle(ws, projects, path):
+    '''Writes a bundle of the given projects' install trees to the given path.
+    Projects that aren't built are left out.'''
+    info = {
+        'format': _FORMAT,
+        'type': get_build_type(ws),
+        'projects': {}
+    }
+    included = []
+    for proj in projects:
+        checksum = get_stored_checksum(ws, proj)
+        install_dir = get_install_dir(ws, proj)
+        if checksum is None or not os.path.isdir(install_dir):
+            log('not bundling %s since it is not built' % proj,
+                logging.WARNING)
+            continue
+        info['projects'][proj] = {'checksum': checksum}
+        included.append(proj)
+
+    log('writing bundle of %d projects to %s' % (len(included), path))
+    if dry_run():
+        return
+
+    # Write to a temporary file first so that nobody sees a partial bundle.
+    tmp = '%s.tmp' % path
+    try:
+        with tarfile.open(tmp, 'w:gz') as tar:
+            data = json.dumps(info, indent=4, sort_keys=True).encode('utf-8')
+            member = tarfile.TarInfo(_INFO)
+            member.size = len(data)
+            member.mode = 0o644
+            tar.addfile(member, io.BytesIO(data))
+            for proj in included:
+                install_dir = get_install_dir(ws, proj)
+                arcname = '%s/%s' % (_INSTALL, proj)
+                tar.add(install_dir,
+                        arcname=arcname,
+                        filter=_relative_links(install_dir, arcname, path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def _read_info(tar, path):
+    '''Returns the description of the bundle opened as the given tarfile.'''
+    try:
+        f = tar.extractfile(_INFO)
+    except KeyError:
+        f = None
+    if f is None:
+        raise WSError('%s is not a ws bundle' % path)
+    try:
+        info = json.loads(f.read().decode('utf-8'))
+    except ValueError as e:
+        raise WSError('bundle %s is corrupt: %s' % (path, e))
+    if info.get('format') != _FORMAT:
+        raise WSError('bundle %s has unsupported format %s'
+                      % (path, info.get('format')))
+    return info
+
+
+def _check_members(tar, path):
+    '''Makes sure every file in the bundle stays inside the directory it is
+    extracted to, and every link inside the install tree of its project.'''
+    for member in tar.getmembers():
+        name = os.path.normpath(member.name)
+        if name == _INFO:
+            continue
+        parts = name.split(os.sep)
+        if (os.path.isabs(name) or
+                '..' in parts or
+                parts[0] != _INSTALL or
+                len(parts) < 2 or
+                member.isdev()):
+            raise WSError('bundle %s contains unsafe path %s'
+                          % (path, member.name))
+        if not (member.issym() or member.islnk()):
+            continue
+        top = os.path.join(_INSTALL, parts[1])
+        if os.path.isabs(member.linkname):
+            target = None
+        elif member.islnk():
+            target = os.path.normpath(member.linkname)
+        else:
+            target = os.path.normpath(
+                os.path.join(os.path.dirname(name), member.linkname))
+        if target is None or not _inside(target, top):
+            raise WSError('bundle %s contains unsafe link %s to %s'
+                          % (path, member.name, member.linkname))
+
+
+def import_bundles(root, ws, d, paths):
+    '''Imports the projects in the bundles at the given paths, unless they are
+    already built from the same sources. Returns the list of projects
+    imported.'''
+    build_type = get_build_type(ws)
+    tars = []
+    sources = {}
+    try:
+        for path in paths:
+            try:
+                tar = tarfile.open(path, 'r:gz')
+            except (IOError, tarfile.TarError) as e:
+                raise WSError('cannot open bundle %s: %s' % (path, e))
+            tars.append(tar)
+            info = _read_info(tar, path)
+            if info['type'] != build_type:
+                raise WSError('bundle %s was built as %s, not %s'
+                              % (path, info['type'], build_type))
+            for proj, proj_info in info['projects'].items():
+                if proj not in d:
+                    raise WSError('bundle %s has project %s, which is not in '
+                                  'the manifest' % (path, proj))
+                sources[proj] = (len(tars) - 1, proj_info['checksum'])
+            _check_members(tar, path)
+        if dry_run():
+            return []
+
+        tmp = tempfile.mkdtemp(prefix='import-', dir=ws)
+        try:
+            extracted = set()
+            imported = []
+            # Importing a project invalidates everything depending on it, so
+            # go in dependency order.
+            for proj in dependency_closure(d, sorted(sources)):
+                try:
+                    i, checksum = sources[proj]
+                except KeyError:
+                    continue
+                if get_stored_checksum(ws, proj) == checksum:
+                    log('%s is already built from the same sources; not '
+                        'importing it' % proj)
+                    continue
+                extract_dir = os.path.join(tmp, str(i))
+                if i not in extracted:
+                    log('extracting bundle %s' % paths[i])
+                    try:
+                        if hasattr(tarfile, 'data_filter'):
+                            tars[i].extractall(extract_dir, filter='data')
+                        else:
+                            tars[i].extractall(extract_dir)
+                    except tarfile.TarError as e:
+                        raise WSError('cannot extract bundle %s: %s'
+                                      % (paths[i], e))
+                    extracted.add(i)
+                _import(root,
+                        ws,
+                        d,
+                        proj,
+                        os.path.join(extract_dir, _INSTALL, proj),
+                        checksum)
+                imported.append(proj)
+        finally:
+            trash(root, tmp)
+    finally:
+        for tar in tars:
+            tar.close()
+    return imported
+
+
+def _import(root, ws, d, proj, install_tree, checksum):
+    '''Moves an extracted install tree into place as the build of a
+    project.'''
+    log('importing %s' % proj)
+    with lock_projects(ws, exclusive=(proj,)):
+        # Whatever was built before is now stale.
+        trash(root, get_build_dir(ws, proj))
+        for path in (get_proj_dir(ws, proj),
+                     get_build_type_dir(ws, proj),
+                     get_build_dir(ws, proj)):
+            try:
+                mkdir(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        rename(install_tree, get_install_dir(ws, proj))
+
+        set_stored_checksum(ws, proj, checksum)
+        set_cache_key(ws, proj, _imported_kind(ws), checksum)
+        invalidate_checksums(ws,
+                             d[proj]['downstream'],
+                             'dependency imported (%s)' % proj)
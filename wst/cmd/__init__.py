@@ -28,6 +28,14 @@ class Command(object):
 
     '''A class representing a top-level ws command. Since this is really an
     interface and not a class, all methods on it should be class methods.'''
+
+    # Tools that must be in the PATH for this command to work. These are only
+    # checked when the command is actually run.
+    tools = ()
+
+    # Whether to write metrics after running this command (see wst.metrics).
+    metrics = False
+
     @classmethod
     def args(cls, parser):
         '''Populate the arguments for this command.'''
@@ -37,3 +45,34 @@ class Command(object):
     def do(cls, ws, args):
         '''Execute the command.'''
         raise NotImplementedError
+
+    @classmethod
+    def serve(cls, ws, args):
+        '''Execute the command inside the ws daemon, using its cached state.
+        Returns the exit status, or None if the command can't be answered by
+        the daemon and must instead run in the client.'''
+        return None
+
+
+def report(args, proj, phase, status, duration=None, workspace=None):
+    '''Reports the progress of a command on a single project. Users of the
+    Python API (see wst.api) receive these through the progress and results
+    attributes of args; on the command line, args has neither and this does
+    nothing. The workspace name is only given by commands working on several
+    workspaces at once.'''
+    event = {
+        'project': proj,
+        'phase': phase,
+        'status': status
+    }
+    if duration is not None:
+        event['duration'] = duration
+    if workspace is not None:
+        event['workspace'] = workspace
+
+    progress = getattr(args, 'progress', None)
+    if progress is not None:
+        progress(event)
+    results = getattr(args, 'results', None)
+    if results is not None and status != 'started':
+        results.append(event)
@@ -23,71 +23,636 @@
 # SOFTWARE.
 #
 
+import concurrent.futures
+import contextlib
 import errno
+import json
 import logging
-import multiprocessing
 import os
+import time
 
 from wst import (
     WSError,
     log
 )
-from wst.cmd import Command
+from wst.bundle import (
+    clear_imported,
+    export_bundle,
+    import_bundles,
+    is_imported
+)
+from wst.cmd import (
+    Command,
+    report
+)
 from wst.cmd.clean import clean
+from wst.cmd.stats import print_table
 from wst.conf import (
     calculate_checksum,
+    config_changed,
     dependency_closure,
     get_build_dir,
+    get_build_type_dir,
     get_build_env,
+    get_build_estimate,
     get_builder,
+    get_cache_key,
     get_install_dir,
+    get_invalidation_reason,
+    get_legacy_build_dir,
+    get_peak_memory,
     get_proj_dir,
+    get_recent_duration,
     get_source_dir,
     get_source_link,
     get_stored_checksum,
+    get_stored_checksums,
     get_ws_config,
     get_ws_dir,
-    invalidate_checksum,
+    get_ws_names,
+    invalidate_checksums,
     parse_manifest,
-    set_stored_checksum
+    parse_size,
+    record_timing,
+    record_timings,
+    set_cache_key,
+    set_stored_checksum,
+    sync_config
+)
+from wst.lock import (
+    lock_projects,
+    lock_workspace
+)
+from wst.events import track_usage
+from wst.ninja import update_ninja_log
+from wst.partition import (
+    load_partition,
+    parse_shard,
+    partition_projects
+)
+from wst.profiling import profiling
+from wst.sched import (
+    Job,
+    available_memory,
+    run_jobs
 )
 from wst.shell import (
-    rmtree,
     symlink,
     mkdir
 )
+from wst.trace import (
+    span,
+    start_trace,
+    stop_trace,
+    tracing
+)
+from wst.trash import trash
+
+
+def _label(name, proj):
+    '''Returns how to refer to a project of the given workspace in messages.
+    The workspace name is None when only one workspace is being built.'''
+    if name is None:
+        return proj
+    return '%s/%s' % (name, proj)
+
+
+def _timed_checksum(source_dir):
+    '''Returns the checksum of the given source directory, along with when we
+    started calculating it and how long it took.'''
+    start = time.time()
+    checksum = calculate_checksum(source_dir)
+    return checksum, start, time.time() - start
+
+
+def _checksums(root, d, order):
+    '''Returns the checksum of each of the given projects, along with when we
+    started calculating it and how long it took (see _timed_checksum).'''
+    # Since this is a nop build bottle-neck, do it in parallel. On my machine,
+    # this produces a ~20% speedup on a nop "build-all". multiprocessing is
+    # slow to import, so only pull it in when we actually need it. Checksums
+    # calculated in other processes would be missing from a trace or a
+    # profile, so use threads instead when tracing or profiling.
+    src_dirs = [get_source_dir(root, d, proj) for proj in order]
+    with span('checksums'):
+        if tracing() or profiling():
+            workers = os.cpu_count() or 1
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                return list(pool.map(_timed_checksum, src_dirs))
+        import multiprocessing
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        return pool.map(_timed_checksum, src_dirs)
+
+
+def _critical_paths(d, order, estimates, default):
+    '''Returns, for each project in the given build order, the estimated work
+    along the longest chain of builds starting with it and going through the
+    projects that depend on it. Projects without an estimate count as
+    default.'''
+    building = set(order)
+    paths = {}
+    for proj in reversed(order):
+        own = estimates[proj]
+        if own is None:
+            own = default
+        downstream = [paths[p] for p in d[proj]['downstream']
+                      if p in building]
+        paths[proj] = own + max(downstream, default=0)
+    return paths
+
+
+# Reasons for building that a dependency being rebuilt doesn't override, as
+# they don't depend on the stored checksum.
+_EXPLICIT_REASONS = ('configuration changed', 'forced', 'tainted',
+                     'not built before')
+
+
+def _plan(args, d, ws, order, checksums):
+    '''Works out what building the given projects, whose sources have the
+    given checksums, would do in the given workspace, without changing
+    anything. Returns the plan as a dictionary.'''
+    ws_config = get_ws_config(ws)
+    rebuilding = set()
+    plans = []
+    estimates = {}
+    for i, proj in enumerate(order):
+        proj_config = ws_config['projects'][proj]
+        if not proj_config['enable']:
+            plans.append({
+                'project': proj,
+                'build': False,
+                'reason': 'disabled',
+                'estimate': None
+            })
+            estimates[proj] = 0
+            continue
+
+        inputs = _conf_inputs(d, proj, ws_config)
+        old_inputs = _get_conf_inputs(ws, proj, ws_config['type'])
+        reconfigure = old_inputs is not None and old_inputs != inputs
+        tainted = proj_config['taint']
+        reason = _rebuild_reason(ws,
+                                 proj,
+                                 checksums[i],
+                                 tainted,
+                                 reconfigure,
+                                 args.force)
+        if reason not in _EXPLICIT_REASONS:
+            # Building a dependency invalidates our stored checksum.
+            upstream = [dep for dep in d[proj]['deps'] if dep in rebuilding]
+            if len(upstream) > 0:
+                reason = 'dependency rebuilt (%s)' % upstream[0]
+
+        if reason is None:
+            estimate = 0
+        else:
+            rebuilding.add(proj)
+            estimate = get_recent_duration(ws, proj, 'build')
+            configure = (reconfigure or tainted or
+                         not os.path.isdir(get_build_dir(ws, proj)))
+            if estimate is not None and configure:
+                estimate += get_recent_duration(ws, proj, 'configure') or 0
+        estimates[proj] = estimate
+        plans.append({
+            'project': proj,
+            'build': reason is not None,
+            'reason': reason if reason is not None else 'up to date',
+            'estimate': estimate if reason is not None else None
+        })
+
+    # Builds we know nothing about are left out of the totals rather than
+    # guessed at.
+    known = [p['estimate'] for p in plans
+             if p['build'] and p['estimate'] is not None]
+    if len(known) > 0:
+        paths = _critical_paths(d, order, estimates, 0)
+        estimate = sum(known)
+        critical_path = max(paths[proj] for proj in rebuilding)
+    else:
+        estimate = None
+        critical_path = None
+    return {
+        'projects': plans,
+        'builds': len(rebuilding),
+        'estimate': estimate,
+        'unknown': len(rebuilding) - len(known),
+        'critical_path': critical_path
+    }
+
+
+def _print_plan(plan):
+    '''Prints a plan computed by _plan.'''
+    rows = []
+    for p in plan['projects']:
+        if p['estimate'] is not None:
+            estimate = '%.1fs' % p['estimate']
+        elif p['build']:
+            estimate = 'unknown'
+        else:
+            estimate = ''
+        rows.append((p['project'],
+                     'build' if p['build'] else 'skip',
+                     p['reason'],
+                     estimate))
+    print_table(('project', 'action', 'reason', 'estimate'), rows)
+
+    summary = ('%d of %d projects would be built'
+               % (plan['builds'], len(plan['projects'])))
+    if plan['builds'] > 0 and plan['estimate'] is None:
+        summary += '; no build history to estimate how long they take'
+    elif plan['builds'] > 0:
+        summary += ('; estimated %.1fs of builds, %.1fs along the longest '
+                    'chain' % (plan['estimate'], plan['critical_path']))
+        if plan['unknown'] > 0:
+            summary += (' for those with history (%d without)'
+                        % plan['unknown'])
+    print(summary)
+
+
+def plan_workspaces(args, d, workspaces):
+    '''Prints what building the requested projects in the given workspaces,
+    which are (name, workspace directory) pairs, would do.'''
+    if len(args.projects) == 0:
+        projects = d.keys()
+    else:
+        projects = args.projects
+    order = dependency_closure(d, projects)
+    checksums = [checksum for checksum, _, _ in
+                 _checksums(args.root, d, order)]
+
+    plans = []
+    for name, ws in workspaces:
+        plan = _plan(args, d, ws, order, checksums)
+        if name is not None:
+            plan['workspace'] = name
+        plans.append(plan)
+
+    if args.json:
+        if workspaces[0][0] is None:
+            # Only the current workspace was asked for.
+            print(json.dumps(plans[0], indent=4))
+        else:
+            print(json.dumps(plans, indent=4))
+        return
+    for plan in plans:
+        if 'workspace' in plan:
+            print('%s:' % plan['workspace'])
+        _print_plan(plan)
+
+
+def _get_shard(args, d, ws, projects):
+    '''Returns the projects in the shard of the build that --shard asks
+    for.'''
+    i, n = parse_shard(args.shard)
+    if args.partition is not None:
+        plan = load_partition(args.partition, d)
+        if plan['partitions'] != n:
+            raise WSError('partition %s has %d shards, not %d'
+                          % (args.partition, plan['partitions'], n))
+    else:
+        # This only agrees with the other machines if they all have the same
+        # build history; the partition from "ws plan --partition" is safer.
+        plan = partition_projects(ws, d, projects, n)
+    shard = plan['shards'][i - 1]['projects']
+    if len(shard) == 0:
+        log('shard %s has no projects' % args.shard, logging.WARNING)
+    return shard
+
+
+def _import_bundles(args, d, ws):
+    '''Imports the bundles given with --import-bundle into the workspace.'''
+    imported = import_bundles(args.root, ws, d, args.import_bundle)
+    build_type = get_ws_config(ws)['type']
+    for proj in imported:
+        # The imported build wasn't configured here, so whatever we recorded
+        # about configuring the project before no longer applies.
+        set_cache_key(ws, proj, _conf_kind(build_type), None)
+
+
+def _check_upstream(ws, d, order, checksums, shard):
+    '''Makes sure that every project the given shard depends on, which is
+    built by other shards, is up to date.'''
+    ws_config = get_ws_config(ws)
+    stale = []
+    for proj, checksum in zip(order, checksums):
+        if proj in shard or not ws_config['projects'][proj]['enable']:
+            continue
+        if get_stored_checksum(ws, proj) != checksum:
+            stale.append(proj)
+    if len(stale) > 0:
+        raise WSError('this shard depends on %s, which other shards build; '
+                      'import their bundles with --import-bundle first'
+                      % ', '.join(stale))
+
+
+def _build_workspaces(args, d, workspaces):
+    '''Builds, and with --test tests, the requested projects in the given
+    workspaces, which are (name, workspace directory) pairs. The projects of
+    all the workspaces are scheduled together under one job budget.'''
+    if len(args.projects) == 0:
+        projects = d.keys()
+    else:
+        projects = args.projects
+
+    # Sharded builds and bundles only ever involve the current workspace.
+    if args.import_bundle is not None:
+        _import_bundles(args, d, workspaces[0][1])
+    if args.shard is not None:
+        shard = _get_shard(args, d, workspaces[0][1], projects)
+        projects = shard
+
+    # Build in reverse-dependency order.
+    order = dependency_closure(d, projects)
+
+    # All workspaces build the same sources, so they share the checksums.
+    timed = _checksums(args.root, d, order)
+    checksums = [checksum for checksum, _, _ in timed]
+    for _, ws in workspaces:
+        record_timings(ws, [(proj, 'checksum', start, duration)
+                            for proj, (_, start, duration)
+                            in zip(order, timed)])
+
+    # A shard builds only its own projects, relying on the other shards for
+    # those it depends on.
+    if args.shard is not None:
+        _check_upstream(workspaces[0][1], d, order, checksums, shard)
+        keep = set(shard)
+        checksums = [checksum for proj, checksum in zip(order, checksums)
+                     if proj in keep]
+        order = tuple(proj for proj in order if proj in keep)
+
+    if args.test:
+        # Imported here since test pulls in a lot that plain builds don't
+        # need.
+        from wst.cmd.test import (
+            TestRun,
+            failure_msg,
+            has_tests
+        )
+    ws_configs = {}
+    test_runs = {}
+    for name, ws in workspaces:
+        ws_configs[name] = get_ws_config(ws)
+        if args.test:
+            test_runs[name] = TestRun(args.root, ws, d, args, True, name)
+
+    def make_job(name, ws, proj, checksum):
+        '''Returns the job that builds the given project.'''
+        label = _label(name, proj)
+
+        def func(slots):
+            log('building %s' % label)
+            report(args, proj, 'build', 'started', workspace=name)
+            start = time.time()
+            # We write to this project's build and install trees and read
+            # from those of everything it depends on.
+            deps = dependency_closure(d, (proj,))[:-1]
+            with span(label, 'project', project=proj, workspace=name):
+                with lock_projects(ws, exclusive=(proj,), shared=deps):
+                    status = _build(
+                        args.root,
+                        ws,
+                        proj,
+                        d,
+                        checksum,
+                        ws_configs[name],
+                        args.force)
+            duration = time.time() - start
+            if status == 'current':
+                # Keep track of what no-op builds cost.
+                record_timing(ws, proj, 'noop', start, duration)
+            report(args, proj, 'build', status, duration, workspace=name)
+            if status == 'failed':
+                raise WSError('%s build failed' % label)
+            return True
+
+        deps = [('build', name, dep) for dep in d[proj]['deps']]
+        if args.test and args.test_blocks:
+            deps.extend(('test', name, dep) for dep in d[proj]['deps'])
+        # Predict how much memory the build needs from the manifest, or else
+        # from how much it needed recently.
+        resources = d[proj]['resources']
+        memory = resources['memory']
+        if memory is None:
+            memory = get_peak_memory(ws, proj)
+        return Job(('build', name, proj),
+                   func,
+                   deps=deps,
+                   weight=resources['weight'],
+                   memory=memory)
+
+    # Builds come first so that, when there is a choice, the builds that other
+    # work is waiting on start before tests that nothing waits on. Among the
+    # builds, those heading the longest chains of work go first, so that what
+    # everything else is waiting on isn't left for last. Projects that are
+    # already up to date take no time.
+    builds = []
+    for name, ws in workspaces:
+        stored = get_stored_checksums(ws)
+        estimates = {}
+        for i, proj in enumerate(order):
+            if not args.force and stored.get(proj) == checksums[i]:
+                estimates[proj] = 0
+            else:
+                estimates[proj] = get_build_estimate(ws, proj)
+        # Without any history, rank by the number of builds in each chain.
+        known = [e for e in estimates.values() if e]
+        default = sum(known) / len(known) if len(known) > 0 else 1
+        paths = _critical_paths(d, order, estimates, default)
+        for i, proj in enumerate(order):
+            builds.append((-paths[proj],
+                           i,
+                           make_job(name, ws, proj, checksums[i])))
+    builds.sort(key=lambda b: b[:2])
+    jobs = [job for _, _, job in builds]
+    tested = []
+    if args.test:
+        for proj in order:
+            if not has_tests(d, proj):
+                continue
+            tested.append(proj)
+            for name, ws in workspaces:
+                if ws_configs[name]['projects'][proj]['enable']:
+                    jobs.append(test_runs[name].job(('test', name, proj),
+                                                    proj,
+                                                    (('build', name, proj),)))
+
+    def done(job):
+        '''Handles a finished job.'''
+        kind, name, proj = job.name
+        if kind == 'test':
+            test_runs[name].done(job)
+        elif job.status == 'skipped':
+            log('not building %s because tests of a project it depends on '
+                'failed' % _label(name, proj), logging.WARNING)
+
+    if args.memory is not None:
+        max_memory = parse_size(args.memory)
+    else:
+        max_memory = available_memory()
+    run_jobs(jobs, args.jobs, done, max_memory)
+
+    if args.export_bundle is not None:
+        export_bundle(workspaces[0][1], order, args.export_bundle)
+
+    if args.test:
+        msgs = []
+        for name, _ in workspaces:
+            failed = [r for r in test_runs[name].ordered(tested)
+                      if r['status'] == 'failed']
+            if len(failed) == 0:
+                continue
+            msgs.append(failure_msg(failed, name))
+        if len(msgs) > 0:
+            raise WSError('\n'.join(msgs))
+
+
+def _conf_inputs(d, proj, ws_config):
+    '''Returns everything that goes into configuring a project. If any of it
+    changes, the project needs to be reconfigured.'''
+    return {
+        'args': d[proj]['args'] + ws_config['projects'][proj]['args'],
+        'builder-args': d[proj]['builder-args'],
+        'env': d[proj]['env'],
+        'type': ws_config['type']
+    }
+
+
+def _conf_kind(build_type):
+    '''Returns the kind of cache key under which we store the inputs that the
+    build directory of the given type was last configured with.'''
+    return 'configure-%s' % build_type
+
+
+def _get_conf_inputs(ws, proj, build_type):
+    '''Returns the inputs that the project's build directory of the given type
+    was last configured with, or None if they are unknown.'''
+    key = get_cache_key(ws, proj, _conf_kind(build_type))
+    if key is None:
+        return None
+    return json.loads(key)
+
+
+def _set_conf_inputs(ws, proj, inputs):
+    '''Records the inputs that the project's build directory was just
+    configured with.'''
+    set_cache_key(ws,
+                  proj,
+                  _conf_kind(inputs['type']),
+                  json.dumps(inputs, sort_keys=True))
+
+
+def _options(args):
+    '''Splits configure arguments into the set of option names they define
+    using -D and a list of all other arguments.'''
+    names = set()
+    others = []
+    it = iter(args)
+    for arg in it:
+        if arg == '-D':
+            arg += next(it, '')
+        if arg.startswith('-D'):
+            names.add(arg[2:].split('=', 1)[0])
+        else:
+            others.append(arg)
+    return names, others
+
+
+def _can_reconf(old_args, new_args):
+    '''Returns True if a build directory configured with the old arguments can
+    be reconfigured in place with the new ones. Both CMake and Meson remember
+    options across reconfigures, so this is only possible if every option that
+    was set is still set (possibly to a different value).'''
+    old_names, old_others = _options(old_args)
+    new_names, new_others = _options(new_args)
+    return old_names <= new_names and old_others == new_others
+
+
+def _rebuild_reason(ws, proj, current, tainted, reconfigure, force):
+    '''Returns why a project whose sources have the given checksum needs to be
+    built, or None if it is up to date.'''
+    stored = get_stored_checksum(ws, proj)
+    reason = get_invalidation_reason(ws, proj)
+    if stored is None and reason is None:
+        return 'not built before'
+    if reconfigure:
+        return 'configuration changed'
+    if force:
+        return 'forced'
+    if tainted:
+        return 'tainted'
+    if current == stored:
+        return None
+    if stored is not None:
+        return 'sources changed'
+    return reason
 
 
 def _build(root, ws, proj, d, current, ws_config, force):
-    '''Builds a given project.'''
+    '''Builds a given project. Returns 'disabled' if the project is disabled,
+    'current' if it didn't need building, and 'built' or 'failed'
+    otherwise.'''
     if not ws_config['projects'][proj]['enable']:
         log('not building manually disabled project %s' % proj,
             logging.WARNING)
-        return True
+        return 'disabled'
 
-    if ws_config['projects'][proj]['taint']:
+    tainted = ws_config['projects'][proj]['taint']
+    if tainted:
         log('force-cleaning tainted project %s' % proj, logging.WARNING)
-        clean(root, ws, proj, d, True)
+        with span('taint-clean', project=proj):
+            clean(root, ws, proj, d, True)
+
+    # If anything that goes into configuring the project changed, we need to
+    # reconfigure it even if its sources didn't change.
+    inputs = _conf_inputs(d, proj, ws_config)
+    old_inputs = _get_conf_inputs(ws, proj, ws_config['type'])
+    reconfigure = old_inputs is not None and old_inputs != inputs
 
+    # Work out why we are building, which we record for ws stats.
     source_dir = get_source_dir(root, d, proj)
-    if not force:
-        stored = get_stored_checksum(ws, proj)
-        if current == stored:
-            log('checksum for %s is current; skipping' % proj)
-            return True
-    else:
+    reason = _rebuild_reason(ws, proj, current, tainted, reconfigure, force)
+    if reason is None:
+        log('checksum for %s is current; skipping' % proj)
+        return 'current'
+    elif reason == 'configuration changed':
+        log('configuration of %s changed' % proj, logging.INFO)
+    elif reason == 'forced':
         log('forcing a build of %s' % proj)
 
-    # Make the project directory if needed.
-    proj_dir = get_proj_dir(ws, proj)
-    try:
-        mkdir(proj_dir)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+    # An imported project has only an install tree, with nothing to build in.
+    if is_imported(ws, proj):
+        log('force-cleaning imported project %s' % proj, logging.INFO)
+        with span('taint-clean', project=proj):
+            clean(root, ws, proj, d, True)
+        clear_imported(ws, proj)
 
-    # Make the build directory if needed.
+    # Make the project and build type directories if needed.
+    for path in (get_proj_dir(ws, proj), get_build_type_dir(ws, proj)):
+        try:
+            mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    # Older versions of ws kept a single build tree for all build types, which
+    # is no longer used.
+    legacy_build_dir = get_legacy_build_dir(ws, proj)
+    if os.path.exists(legacy_build_dir):
+        trash(root, legacy_build_dir)
+
+    # Reconfiguring can't unset options, so start from scratch if any were
+    # removed.
     build_dir = get_build_dir(ws, proj)
+    if (reconfigure and
+            os.path.exists(build_dir) and
+            not _can_reconf(old_inputs['args'], inputs['args'])):
+        log('options were removed from %s; force-cleaning it' % proj,
+            logging.WARNING)
+        with span('taint-clean', project=proj):
+            clean(root, ws, proj, d, True)
+
+    # Make the build directory if needed.
     try:
         mkdir(build_dir)
     except OSError as e:
@@ -104,59 +669,86 @@ def _build(root, ws, proj, d, current, ws_config, force):
         symlink(source_dir, source_link)
 
     # Invalidate the checksums for any downstream projects.
-    for downstream_dep in d[proj]['downstream']:
-        invalidate_checksum(ws, downstream_dep)
+    with span('invalidate-downstream', project=proj):
+        invalidate_checksums(ws,
+                             d[proj]['downstream'],
+                             'dependency rebuilt (%s)' % proj)
 
     # Add envs to find all projects on which this project is dependent.
-    build_env = get_build_env(ws, d, proj)
+    with span('build-env', project=proj):
+        build_env = get_build_env(ws, d, proj)
 
     # Configure.
     builder = get_builder(d, proj)
     prefix = get_install_dir(ws, proj)
-    extra_args = d[proj]['args'] + ws_config['projects'][proj]['args']
-    if needs_configure:
+    extra_args = inputs['args']
+    if needs_configure or reconfigure:
+        if needs_configure:
+            conf = builder.conf
+            phase = 'configure'
+        else:
+            log('reconfiguring %s in place' % proj, logging.INFO)
+            conf = builder.reconf
+            phase = 'reconfigure'
+        start = time.time()
         try:
-            success = builder.conf(
-                proj,
-                prefix,
-                source_dir,
-                build_dir,
-                build_env,
-                ws_config['type'],
-                d[proj]['builder-args'],
-                extra_args)
+            with span(phase, project=proj), track_usage() as usage:
+                success = conf(
+                    proj,
+                    prefix,
+                    source_dir,
+                    build_dir,
+                    build_env,
+                    ws_config['type'],
+                    d[proj]['builder-args'],
+                    extra_args)
         except Exception as _e:
             success = False
             e = _e
         else:
             e = None
+        record_timing(ws, proj, 'configure', start, time.time() - start,
+                      usage.maxrss, reason)
         if not success:
             # Remove the build directory if we failed so that we are forced to
             # re-run configure next time.
-            rmtree(build_dir)
+            trash(root, build_dir)
             if e is not None:
                 raise e
             else:
-                return False
+                return 'failed'
+        _set_conf_inputs(ws, proj, inputs)
+    elif old_inputs is None:
+        # The build directory predates us recording configure inputs, so
+        # assume it was configured with the current ones.
+        _set_conf_inputs(ws, proj, inputs)
 
     # Build.
-    success = builder.build(
-        proj,
-        prefix,
-        source_dir,
-        build_dir,
-        build_env,
-        d[proj]['targets'],
-        d[proj]['builder-args'],
-        d[proj]['args'])
-    if success:
-        set_stored_checksum(ws, proj, current)
-
-    return success
+    start = time.time()
+    with span('build', project=proj), track_usage() as usage:
+        success = builder.build(
+            proj,
+            prefix,
+            source_dir,
+            build_dir,
+            build_env,
+            d[proj]['targets'],
+            d[proj]['builder-args'],
+            d[proj]['args'])
+    record_timing(ws, proj, 'build', start, time.time() - start,
+                  usage.maxrss, reason)
+    update_ninja_log(ws, proj)
+    if not success:
+        return 'failed'
+    set_stored_checksum(ws, proj, current)
+    return 'built'
 
 
 class Build(Command):
     '''The build command.'''
+    tools = ('git', 'gcc')
+    metrics = True
+
     @classmethod
     def args(cls, parser):
         '''Populates the argument parser for the build command.'''
@@ -170,43 +762,235 @@ class Build(Command):
             action='store_true',
             default=False,
             help='Force a build')
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            type=int,
+            default=None,
+            help='Number of projects to build or test at once (default 1, '
+                 'or 2 with --test)')
+        parser.add_argument(
+            '-t', '--test',
+            action='store_true',
+            default=False,
+            help='Test each project as soon as it is built, while building '
+                 'the projects that depend on it')
+        parser.add_argument(
+            '--test-blocks',
+            action='store_true',
+            default=False,
+            help='With --test, don\'t build projects depending on a project '
+                 'whose tests failed')
+        parser.add_argument(
+            '--memory',
+            action='store',
+            default=None,
+            metavar='SIZE',
+            help='Only build projects at once while their expected memory '
+                 'use adds up to at most SIZE (such as 32G); defaults to the '
+                 'memory available when the build starts')
+        parser.add_argument(
+            '--trace',
+            action='store',
+            default=None,
+            metavar='FILE',
+            help='Write a Chrome trace event file showing where the time '
+                 'went')
+        parser.add_argument(
+            '--plan',
+            action='store_true',
+            default=False,
+            help='Print which projects would be built and why, and how long '
+                 'that should take, without building anything')
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            default=False,
+            help='With --plan, print the plan as JSON')
+        parser.add_argument(
+            '--shard',
+            action='store',
+            default=None,
+            metavar='I/N',
+            help='Build only the I-th of N shards of the projects, for '
+                 'splitting a build across machines')
+        parser.add_argument(
+            '--partition',
+            action='store',
+            default=None,
+            metavar='FILE',
+            help='With --shard, take the shards from a partition written by '
+                 '"ws plan --partition" instead of working them out here')
+        parser.add_argument(
+            '--import-bundle',
+            action='append',
+            default=None,
+            metavar='FILE',
+            help='Before building, import the projects in the given bundle, '
+                 'which were built elsewhere; can be given more than once')
+        parser.add_argument(
+            '--export-bundle',
+            action='store',
+            default=None,
+            metavar='FILE',
+            help='After building, write the built projects to the given '
+                 'bundle')
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '--workspaces',
+            action='store',
+            default=None,
+            help='Build the given comma-separated workspaces instead of the '
+                 'current one')
+        group.add_argument(
+            '--all-workspaces',
+            action='store_true',
+            default=False,
+            help='Build every workspace instead of the current one')
 
     @classmethod
     def do(cls, ws, args):
         '''Executes the build subcmd.'''
-        ws_config = get_ws_config(get_ws_dir(args.root, ws))
         d = parse_manifest(args.root)
 
         # Validate.
         for project in args.projects:
             if project not in d:
                 raise WSError('unknown project %s' % project)
+        if args.jobs is None:
+            args.jobs = 2 if args.test else 1
+        if args.jobs < 1:
+            raise WSError('the number of jobs must be at least 1')
+        if args.test_blocks and not args.test:
+            raise WSError('--test-blocks only makes sense with --test')
+        if args.json and not args.plan:
+            raise WSError('--json only makes sense with --plan')
+        if args.shard is not None:
+            try:
+                parse_shard(args.shard)
+            except ValueError as e:
+                raise WSError('bad --shard: %s' % e)
+        if args.partition is not None:
+            if args.shard is None:
+                raise WSError('--partition only makes sense with --shard')
+            if len(args.projects) > 0:
+                raise WSError('the partition already says which projects to '
+                              'build')
+        distributed = (args.shard is not None or
+                       args.import_bundle is not None or
+                       args.export_bundle is not None)
+        if distributed and args.plan:
+            raise WSError('--plan cannot be used with --shard or bundles')
+        if (distributed and
+                (args.workspaces is not None or args.all_workspaces)):
+            raise WSError('--shard and bundles only work on the current '
+                          'workspace')
+        if args.memory is not None:
+            try:
+                parse_size(args.memory)
+            except ValueError as e:
+                raise WSError('bad --memory: %s' % e)
 
-        if len(args.projects) == 0:
-            projects = d.keys()
+        if args.trace is not None:
+            start_trace()
+            try:
+                cls._do(ws, args, d)
+            finally:
+                stop_trace(args.trace)
         else:
-            projects = args.projects
+            cls._do(ws, args, d)
 
-        # Build in reverse-dependency order.
-        order = dependency_closure(d, projects)
+    @classmethod
+    def _do(cls, ws, args, d):
+        '''Builds the workspaces the arguments ask for.'''
+        if args.all_workspaces:
+            names = get_ws_names(args.root)
+        elif args.workspaces is not None:
+            names = [name for name in args.workspaces.split(',')
+                     if len(name) > 0]
+            for name in names:
+                if not os.path.isdir(get_ws_dir(args.root, name)):
+                    raise WSError('workspace %s does not exist' % name)
+        else:
+            names = None
+        run = plan_workspaces if args.plan else _build_workspaces
+        if names is None:
+            run(args, d, [(None, ws)])
+            return
+        if len(names) == 0:
+            raise WSError('no workspaces to build')
 
-        # Get all checksums; since this is a nop build bottle-neck, do it in
-        # parallel. On my machine, this produces a ~20% speedup on a nop
-        # "build-all".
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        src_dirs = [get_source_dir(args.root, d, proj) for proj in order]
-        checksums = pool.map(calculate_checksum, src_dirs)
+        workspaces = [(name, get_ws_dir(args.root, name)) for name in names]
+        with contextlib.ExitStack() as stack:
+            # Keep the other workspaces from being removed or renamed while we
+            # build them, as is done for the current one.
+            for _, ws_dir in workspaces:
+                stack.enter_context(lock_workspace(ws_dir))
+            try:
+                run(args, d, workspaces)
+            finally:
+                for _, ws_dir in workspaces:
+                    sync_config(ws_dir)
 
-        for i, proj in enumerate(order):
+    @classmethod
+    def serve(cls, ws, args):
+        '''Answers a build from the daemon if there is nothing to build, which
+        only needs the cached checksums. Anything else goes back to the
+        client.'''
+        if (args.force or args.test or args.workspaces is not None or
+                args.all_workspaces or args.trace is not None or args.plan or
+                args.shard is not None or args.import_bundle is not None or
+                args.export_bundle is not None):
+            return None
+
+        from wst.server import cached_checksums
+        # Keep the workspace from being removed or renamed while we use it, as
+        # a build in the client would.
+        with lock_workspace(ws):
+            ws_config = get_ws_config(get_ws_dir(args.root, ws))
+            if config_changed(ws):
+                return None
+            d = parse_manifest(args.root)
+            for project in args.projects:
+                if project not in d:
+                    return None
+
+            if len(args.projects) == 0:
+                projects = d.keys()
+            else:
+                projects = args.projects
+            order = dependency_closure(d, projects)
+
+            src_dirs = [get_source_dir(args.root, d, proj) for proj in order]
+            checksums = cached_checksums(src_dirs)
+            # Keep the projects from being cleaned or rebuilt while we decide
+            # they are current.
+            noops = []
+            with lock_projects(ws, shared=order):
+                for i, proj in enumerate(order):
+                    start = time.time()
+                    proj_config = ws_config['projects'][proj]
+                    if not proj_config['enable']:
+                        continue
+                    if proj_config['taint']:
+                        return None
+                    if checksums[i] != get_stored_checksum(ws, proj):
+                        return None
+                    inputs = _conf_inputs(d, proj, ws_config)
+                    old_inputs = _get_conf_inputs(ws,
+                                                  proj,
+                                                  ws_config['type'])
+                    if old_inputs is not None and old_inputs != inputs:
+                        return None
+                    noops.append((proj, 'noop', start, time.time() - start))
+
+            # Nothing to do. Log and record what a real build would have.
+            record_timings(ws, noops)
+        for proj in order:
             log('building %s' % proj)
-            checksum = checksums[i]
-            success = _build(
-                args.root,
-                ws,
-                proj,
-                d,
-                checksum,
-                ws_config,
-                args.force)
-            if not success:
-                raise WSError('%s build failed' % proj)
+            if not ws_config['projects'][proj]['enable']:
+                log('not building manually disabled project %s' % proj,
+                    logging.WARNING)
+            else:
+                log('checksum for %s is current; skipping' % proj)
+        return 0
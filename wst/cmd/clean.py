@@ -23,15 +23,18 @@
 # SOFTWARE.
 #
 
-import errno
 import os
+import time
 
 from wst import (
     dry_run,
     log,
     WSError
 )
-from wst.cmd import Command
+from wst.cmd import (
+    Command,
+    report
+)
 from wst.conf import (
     get_build_dir,
     get_build_env,
@@ -42,23 +45,27 @@ from wst.conf import (
     invalidate_checksum,
     parse_manifest
 )
-from wst.shell import rmtree
+from wst.lock import lock_projects
+from wst.sched import (
+    Job,
+    run_jobs
+)
+from wst.trace import span
+from wst.trash import trash
 
 
-def _force_clean(ws, proj):
+def _force_clean(root, ws, proj):
     '''Performs a force-clean of a project, removing all files instead of
-    politely calling the clean function of the underlying build system.'''
+    politely calling the clean function of the underlying build system. The
+    files are actually deleted in the background.'''
     build_dir = get_build_dir(ws, proj)
-    log('removing %s' % build_dir)
     if dry_run():
+        log('removing %s' % build_dir)
         return
-    try:
-        rmtree(build_dir)
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            log('%s already removed' % build_dir)
-        else:
-            raise
+    if not os.path.exists(build_dir):
+        log('%s already removed' % build_dir)
+    else:
+        trash(root, build_dir)
 
     config = get_ws_config(ws)
     config['projects'][proj]['taint'] = False
@@ -70,12 +77,12 @@ def _polite_clean(root, ws, proj, d):
     builder = get_builder(d, proj)
     build_dir = get_build_dir(ws, proj)
     if not os.path.exists(build_dir):
-        return
+        return True
 
     build_env = get_build_env(ws, d, proj)
     prefix = get_install_dir(ws, proj)
     source_dir = get_source_dir(root, d, proj)
-    builder.clean(
+    return builder.clean(
         proj,
         prefix,
         source_dir,
@@ -85,17 +92,22 @@ def _polite_clean(root, ws, proj, d):
 
 
 def clean(root, ws, proj, d, force):
-    '''Cleans a project, forcefully or not.'''
-    invalidate_checksum(ws, proj)
-
-    if force:
-        _force_clean(ws, proj)
-    else:
-        _polite_clean(root, ws, proj, d)
+    '''Cleans a project, forcefully or not. Returns False if the underlying
+    build system failed to clean it.'''
+    with lock_projects(ws, exclusive=(proj,)):
+        invalidate_checksum(ws, proj, 'cleaned')
+
+        if force:
+            _force_clean(root, ws, proj)
+            return True
+        else:
+            return _polite_clean(root, ws, proj, d) is not False
 
 
 class Clean(Command):
     '''The clean command.'''
+    tools = ('gcc',)
+
     @classmethod
     def args(cls, parser):
         '''Populates the argument parser for the clean command.'''
@@ -109,6 +121,12 @@ class Clean(Command):
             action='store_true',
             default=False,
             help='Force-clean (remove the build directory)')
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='Number of projects to clean at once')
 
     @classmethod
     def do(cls, ws, args):
@@ -118,11 +136,43 @@ class Clean(Command):
         for project in args.projects:
             if project not in d:
                 raise WSError('unknown project %s' % project)
+        if args.jobs < 1:
+            raise WSError('the number of jobs must be at least 1')
 
         if len(args.projects) == 0:
             projects = d.keys()
         else:
             projects = args.projects
 
-        for project in projects:
-            clean(args.root, ws, project, d, args.force)
+        # Cleaning a project doesn't touch any other project, so they can all
+        # be cleaned independently. Keep going if one fails, and report all
+        # the failures at the end.
+        failures = {}
+
+        def make_job(proj):
+            '''Returns the job that cleans the given project.'''
+            def func(slots):
+                report(args, proj, 'clean', 'started')
+                start = time.time()
+                try:
+                    with span('clean', project=proj):
+                        success = clean(args.root, ws, proj, d, args.force)
+                except (OSError, WSError) as e:
+                    failures[proj] = str(e)
+                    success = False
+                else:
+                    if not success:
+                        failures[proj] = 'the %s clean failed' % (
+                            d[proj]['build'])
+                status = 'cleaned' if success else 'failed'
+                report(args, proj, 'clean', status, time.time() - start)
+                return success
+            return Job(proj, func)
+
+        run_jobs([make_job(proj) for proj in projects], args.jobs)
+
+        if len(failures) > 0:
+            msg = '\n'.join('%s: %s' % (proj, failures[proj])
+                            for proj in projects if proj in failures)
+            raise WSError('failed to clean %d project(s):\n%s'
+                          % (len(failures), msg))
@@ -32,8 +32,10 @@ from wst import (
 )
 from wst.cmd import Command
 from wst.conf import (
+    config_changed,
     get_ws_config,
-    parse_manifest
+    parse_manifest,
+    split_args
 )
 
 
@@ -139,7 +141,9 @@ class Config(Command):
                     if val is None:
                         raise WSError('build args are not in the right format '
                                       '("args=key=val")')
-                    can_taint = True
+                    val = split_args(val)
+                    # There's no need to taint the project, as the next build
+                    # notices the change and reconfigures it.
                 else:
                     raise WSError('project key "%s" not found' % key)
 
@@ -161,8 +165,18 @@ class Config(Command):
                     if val is None or val not in BUILD_TYPES:
                         raise WSError('"type" key must be one of %s'
                                       % str(BUILD_TYPES))
-                    if config[key] != val:
-                        for proj_config in config['projects'].values():
-                            proj_config['taint'] = True
-
                 config[key] = val
+
+    @classmethod
+    def serve(cls, ws, args):
+        '''Lists the config from the daemon's cache. Changing the config is
+        left to the client.'''
+        if not args.list:
+            return None
+        get_ws_config(ws)
+        if config_changed(ws):
+            # The manifest changed in a way that requires updating the
+            # config, which the client must write out.
+            return None
+        cls.do(ws, args)
+        return 0
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# Daemon action implementation.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from wst import WSError
+from wst.cmd import Command
+
+
+DAEMON_ACTIONS = ('start', 'stop', 'status')
+
+
+class Daemon(Command):
+    '''The daemon command.'''
+    @classmethod
+    def args(cls, parser):
+        '''Populates the argument parser for the daemon command.'''
+        parser.add_argument(
+            'action',
+            action='store',
+            choices=DAEMON_ACTIONS,
+            help='What to do with the daemon')
+        parser.add_argument(
+            '-t', '--idle-timeout',
+            action='store',
+            type=int,
+            default=None,
+            help='Seconds without a request after which the daemon exits')
+
+    @classmethod
+    def do(cls, _, args):
+        '''Executes the daemon command.'''
+        # Only the daemon command itself needs the daemon machinery, so don't
+        # import it for every command.
+        import wst.daemon
+
+        if args.action == 'start':
+            if args.idle_timeout is None:
+                idle_timeout = wst.daemon.DEFAULT_IDLE_TIMEOUT
+            else:
+                idle_timeout = args.idle_timeout
+            wst.daemon.start(args.root, idle_timeout)
+        elif args.action == 'stop':
+            if not wst.daemon.stop(args.root):
+                raise WSError('ws daemon is not running')
+        elif args.action == 'status':
+            status = wst.daemon.ping(args.root)
+            if status is None:
+                print('not running')
+            else:
+                print('running (pid %d, up %d seconds, %d cached checksums, '
+                      'inotify %s)' % (status['pid'],
+                                       status['uptime'],
+                                       status['checksums'],
+                                       'on' if status['inotify'] else 'off'))
+        else:
+            raise NotImplementedError('Daemon action %s should be '
+                                      'implemented' % args.action)
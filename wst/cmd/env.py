@@ -35,13 +35,41 @@ from wst.conf import (
     get_build_dir,
     get_build_env,
     merge_var,
-    parse_manifest
+    parse_manifest,
+    ROOT_ENV_VAR
 )
 from wst.shell import get_shell
 
 
+def get_env(root, ws, proj):
+    '''Returns the environment in which commands for the given project run,
+    which is its build environment plus a few conveniences.'''
+    build_dir = get_build_dir(ws, proj)
+    if not os.path.isdir(build_dir):
+        raise WSError('build directory for %s doesn\'t exist; have you '
+                      'built it yet?' % proj)
+
+    d = parse_manifest(root)
+    build_env = get_build_env(ws, d, proj)
+
+    # Add the build directory to the path for convenience of running
+    # non-installed binaries, such as unit tests.
+    merge_var(build_env, 'PATH', [build_dir])
+
+    # Set an env var so the user can easily cd $WSBUILD and run tests or
+    # similar inside the build directory.
+    build_env['WSBUILD'] = build_dir
+
+    # Let any ws invocations inside the env skip searching for the root.
+    build_env[ROOT_ENV_VAR] = root
+
+    return build_env
+
+
 class Env(Command):
     '''The env command.'''
+    tools = ('gcc',)
+
     @classmethod
     def args(cls, parser):
         group = parser.add_mutually_exclusive_group()
@@ -71,17 +99,7 @@ class Env(Command):
     @classmethod
     def do(cls, ws, args):
         '''Executes the env command.'''
-        build_dir = get_build_dir(ws, args.project)
-        if not os.path.isdir(build_dir):
-            raise WSError('build directory for %s doesn\'t exist; have you '
-                          'built it yet?' % args.project)
-
-        d = parse_manifest(args.root)
-        build_env = get_build_env(ws, d, args.project)
-
-        # Add the build directory to the path for convenience of running
-        # non-installed binaries, such as unit tests.
-        merge_var(build_env, 'PATH', [build_dir])
+        build_env = get_env(args.root, ws, args.project)
 
         if len(args.command) > 0:
             cmd = args.command
@@ -96,14 +114,10 @@ class Env(Command):
             build_env['PS1'] = prompt
             cmd.insert(1, '--norc')
 
-        # Set an env var so the user can easily cd $WSBUILD and run tests or
-        # similar inside the build directory.
-        build_env['WSBUILD'] = build_dir
-
         log('execing with %s build environment: %s' % (args.project, cmd))
 
         if args.build_dir:
-            args.current_dir = build_dir
+            args.current_dir = build_env['WSBUILD']
 
         if args.current_dir is not None:
             os.chdir(args.current_dir)
@@ -32,7 +32,6 @@ from wst import (
 )
 from wst.cmd import Command
 from wst.conf import (
-    get_checksum_dir,
     get_default_ws_link,
     get_default_ws_name,
     get_default_manifest_name,
@@ -40,6 +39,7 @@ from wst.conf import (
     get_manifest_link_name,
     get_new_config,
     get_toplevel_build_dir,
+    get_trash_name,
     get_ws_dir,
     parse_manifest_file,
     write_config
@@ -104,7 +104,9 @@ class Init(Command):
         if args.init_ws is None:
             ws = 'ws'
         else:
-            reserved = (get_default_ws_name(), get_manifest_link_name())
+            reserved = (get_default_ws_name(),
+                        get_manifest_link_name(),
+                        get_trash_name())
             for name in reserved:
                 if args.init_ws == name:
                     raise WSError('%s is a reserved name; please choose a '
@@ -176,7 +178,6 @@ class Init(Command):
             # This is a brand-new workspace, so populate the initial workspace
             # directories.
             mkdir(get_toplevel_build_dir(ws_dir))
-            mkdir(get_checksum_dir(ws_dir))
 
             proj_map = dict((proj, {}) for proj in d)
             for proj in proj_map:
@@ -23,12 +23,9 @@
 # SOFTWARE.
 #
 
-import os
-
 from wst.cmd import Command
 from wst.conf import (
-    get_default_ws_name,
-    get_manifest_link_name,
+    get_ws_names,
     parse_manifest
 )
 
@@ -49,14 +46,15 @@ class List(Command):
     def do(cls, _, args):
         '''Executes the list subcmd.'''
         if args.list_workspaces:
-            dirs = os.listdir(args.root)
-            for ws in dirs:
-                if ws == get_default_ws_name():
-                    continue
-                if ws == get_manifest_link_name():
-                    continue
+            for ws in get_ws_names(args.root):
                 print(ws)
         else:
             d = parse_manifest(args.root)
             for proj in d:
                 print(proj)
+
+    @classmethod
+    def serve(cls, ws, args):
+        '''Lists projects from the daemon's cached manifest.'''
+        cls.do(ws, args)
+        return 0
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+#
+# The ninja-report command.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import datetime
+import json
+
+from wst.cmd import Command
+from wst.cmd.stats import print_table
+from wst.conf import (
+    get_build_type,
+    get_state,
+    get_ws_config,
+    parse_manifest
+)
+from wst.ninja import (
+    edge_kind,
+    update_ninja_log
+)
+
+
+def _targets(rows):
+    '''Groups .ninja_log entries, given as (project, target, batch, start_ms,
+    end_ms, hash) tuples, by project and target, returning a dictionary
+    mapping each (project, target) to a list of (batch, seconds) runs, oldest
+    first.'''
+    targets = {}
+    for proj, target, batch, start, end, _ in rows:
+        runs = targets.setdefault((proj, target), [])
+        runs.append((batch, (end - start) / 1000))
+    return targets
+
+
+def compute_report(rows, limit):
+    '''Computes the slowest edges and the per-project totals from the given
+    .ninja_log entries, cutting the list of edges down to the given number.'''
+    targets = _targets(rows)
+
+    edges = []
+    projects = {}
+    for (proj, target), runs in targets.items():
+        kind = edge_kind(target)
+        durations = [duration for _, duration in runs]
+        last = durations[-1]
+        edges.append({
+            'project': proj,
+            'target': target,
+            'kind': kind,
+            'last': last,
+            'avg': sum(durations) / len(durations),
+            'max': max(durations),
+            'runs': len(durations)
+        })
+        totals = projects.setdefault(proj, {
+            'project': proj,
+            'compile': 0,
+            'link': 0,
+            'other': 0,
+            'edges': 0
+        })
+        totals[kind] += last
+        totals['edges'] += 1
+    edges.sort(key=lambda e: -e['last'])
+    totals = sorted(projects.values(),
+                    key=lambda t: -(t['compile'] + t['link'] + t['other']))
+    return {
+        'edges': edges[:limit],
+        'projects': totals
+    }
+
+
+def target_history(rows, name):
+    '''Returns every recorded run of the targets whose path ends with the
+    given name, as a list of dictionaries, oldest first.'''
+    history = []
+    for (proj, target), runs in _targets(rows).items():
+        if target != name and not target.endswith('/' + name):
+            continue
+        for batch, duration in runs:
+            history.append({
+                'project': proj,
+                'target': target,
+                'time': batch,
+                'duration': duration
+            })
+    history.sort(key=lambda h: h['time'])
+    return history
+
+
+def _secs(val):
+    '''Formats a duration in seconds.'''
+    return '%.2fs' % val
+
+
+def print_report(report):
+    '''Prints a report computed by compute_report.'''
+    print('Slowest edges:')
+    print_table(
+        ('project', 'kind', 'target', 'last', 'avg', 'max', 'runs'),
+        [(e['project'],
+          e['kind'],
+          e['target'],
+          _secs(e['last']),
+          _secs(e['avg']),
+          _secs(e['max']),
+          str(e['runs'])) for e in report['edges']])
+
+    print()
+    print('Projects:')
+    print_table(
+        ('project', 'edges', 'compile', 'link', 'other'),
+        [(t['project'],
+          str(t['edges']),
+          _secs(t['compile']),
+          _secs(t['link']),
+          _secs(t['other'])) for t in report['projects']])
+
+
+def print_history(history):
+    '''Prints the runs returned by target_history.'''
+    print_table(
+        ('time', 'project', 'target', 'duration'),
+        [(datetime.datetime.fromtimestamp(h['time']).strftime(
+            '%Y-%m-%d %H:%M:%S'),
+          h['project'],
+          h['target'],
+          _secs(h['duration'])) for h in history])
+
+
+class NinjaReport(Command):
+    '''The ninja-report command.'''
+    @classmethod
+    def args(cls, parser):
+        '''Populates the argument parser for the ninja-report subcmd.'''
+        parser.add_argument(
+            '-t', '--target',
+            action='store',
+            default=None,
+            help=('Show how long the given target took in every build instead '
+                  'of the overall report'))
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            default=False,
+            help='Print the report as JSON')
+        parser.add_argument(
+            '-n', '--limit',
+            action='store',
+            type=int,
+            default=20,
+            help='How many of the slowest edges to list')
+
+    @classmethod
+    def do(cls, ws, args):
+        '''Executes the ninja-report subcmd.'''
+        d = parse_manifest(args.root)
+        config = get_ws_config(ws)
+        build_type = get_build_type(ws)
+        for proj in d:
+            if config['projects'][proj]['enable']:
+                update_ninja_log(ws, proj, build_type)
+
+        rows = get_state(ws).get_ninja_edges(build_type)
+        if args.target is not None:
+            result = target_history(rows, args.target)
+            show = print_history
+        else:
+            result = compute_report(rows, args.limit)
+            show = print_report
+
+        if args.json:
+            print(json.dumps(result, indent=4))
+        else:
+            show(result)
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#
+# The plan command.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import json
+
+from wst import (
+    WSError,
+    log
+)
+from wst.cmd import Command
+from wst.cmd.build import plan_workspaces
+from wst.cmd.stats import print_table
+from wst.conf import parse_manifest
+from wst.partition import partition_projects
+
+
+def _print_partition(partition):
+    '''Prints a partition computed by partition_projects.'''
+    rows = []
+    for shard in partition['shards']:
+        if shard['estimate'] is None:
+            estimate = 'unknown'
+        else:
+            estimate = '%.1fs' % shard['estimate']
+        rows.append(('%d/%d' % (shard['shard'], partition['partitions']),
+                     str(len(shard['projects'])),
+                     estimate,
+                     ', '.join(str(j) for j in shard['needs']),
+                     ', '.join(shard['projects'])))
+    print_table(('shard', 'count', 'estimate', 'needs', 'projects'), rows)
+
+
+class Plan(Command):
+    '''The plan command.'''
+    tools = ('git',)
+
+    @classmethod
+    def args(cls, parser):
+        '''Populates the argument parser for the plan subcmd.'''
+        parser.add_argument(
+            'projects',
+            action='store',
+            nargs='*',
+            help='Plan building a particular project or projects')
+        parser.add_argument(
+            '-f', '--force',
+            action='store_true',
+            default=False,
+            help='Plan a forced build')
+        parser.add_argument(
+            '--partition',
+            action='store',
+            type=int,
+            default=None,
+            metavar='N',
+            help='Instead, split the projects into N shards of similar '
+                 'build time for "ws build --shard"')
+        parser.add_argument(
+            '-o', '--output',
+            action='store',
+            default=None,
+            metavar='FILE',
+            help='With --partition, write the partition to FILE for '
+                 '"ws build --partition"')
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            default=False,
+            help='Print the plan as JSON')
+
+    @classmethod
+    def do(cls, ws, args):
+        '''Executes the plan subcmd.'''
+        d = parse_manifest(args.root)
+        for project in args.projects:
+            if project not in d:
+                raise WSError('unknown project %s' % project)
+
+        if args.partition is None:
+            if args.output is not None:
+                raise WSError('--output only makes sense with --partition')
+            plan_workspaces(args, d, [(None, ws)])
+            return
+
+        if args.partition < 1:
+            raise WSError('the number of shards must be at least 1')
+        if len(args.projects) == 0:
+            projects = d.keys()
+        else:
+            projects = args.projects
+        partition = partition_projects(ws, d, projects, args.partition)
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(partition, f, indent=4)
+                f.write('\n')
+            log('wrote partition to %s' % args.output)
+        if args.json:
+            print(json.dumps(partition, indent=4))
+        elif args.output is None:
+            _print_partition(partition)
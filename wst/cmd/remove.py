@@ -31,11 +31,12 @@ from wst.conf import (
     get_default_ws_link,
     get_ws_dir
 )
+from wst.lock import lock_workspace
 from wst.shell import (
     remove,
-    rmtree,
     symlink
 )
+from wst.trash import trash
 
 
 class Remove(Command):
@@ -78,8 +79,9 @@ class Remove(Command):
             raise WSError('-d/--default is not applicable unless you are '
                           'removing the default workspace')
 
-        # We are good to go.
-        rmtree(ws_dir)
+        # We are good to go. Wait for anyone still using the workspace.
+        with lock_workspace(ws_dir, exclusive=True):
+            trash(args.root, ws_dir)
         if is_default:
             remove(default_link)
             symlink(args.default, default_link)
@@ -25,14 +25,19 @@
 
 import os
 
-from wst import WSError
+from wst import (
+    BUILD_TYPES,
+    WSError
+)
 from wst.cmd import Command
 from wst.conf import (
     get_build_dir,
     get_default_ws_link,
+    get_legacy_build_dir,
     get_ws_dir,
     parse_manifest
 )
+from wst.lock import lock_workspace
 from wst.shell import (
     remove,
     rename,
@@ -69,8 +74,10 @@ class Rename(Command):
 
         d = parse_manifest(args.root)
         for proj in d:
-            build_dir = get_build_dir(old_ws_dir, proj)
-            if os.path.exists(build_dir):
+            build_dirs = [get_build_dir(old_ws_dir, proj, build_type)
+                          for build_type in BUILD_TYPES]
+            build_dirs.append(get_legacy_build_dir(old_ws_dir, proj))
+            if any(os.path.exists(build_dir) for build_dir in build_dirs):
                 raise WSError('cannot rename a workspace that contains build '
                               'artifacts, as some builds contain absolute '
                               'paths and are thus not relocatable. Please '
@@ -82,7 +89,8 @@ class Rename(Command):
             raise WSError('workspace %s already exists; please delete it '
                           'first if you want to do this rename' % args.new_ws)
 
-        rename(old_ws_dir, new_ws_dir)
+        with lock_workspace(old_ws_dir, exclusive=True):
+            rename(old_ws_dir, new_ws_dir)
         default_link = get_default_ws_link(args.root)
         if os.readlink(default_link) == args.old_ws:
             remove(default_link)
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+#
+# The stats command.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import json
+
+from wst.cmd import Command
+from wst.conf import get_state
+
+
+# Phases that cost time without building anything.
+_OVERHEAD_PHASES = ('checksum', 'noop')
+
+# Rebuilds with a reason starting with this were caused by a dependency being
+# rebuilt (see wst.cmd.build).
+_CASCADE_PREFIX = 'dependency rebuilt'
+
+
+def _summarize(durations):
+    '''Returns the count, total, average and maximum of the given
+    durations.'''
+    count = len(durations)
+    total = sum(durations)
+    return {
+        'count': count,
+        'total': total,
+        'avg': total / count if count > 0 else None,
+        'max': max(durations) if count > 0 else None
+    }
+
+
+def _hit_rate(hits, misses):
+    '''Returns a cache summary given the number of hits and misses.'''
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'rate': hits / total if total > 0 else None
+    }
+
+
+def compute_stats(history, limit):
+    '''Computes stats from the given timing history, which is a list of
+    (project, phase, start, duration, maxrss, reason) tuples. Per-project lists
+    are cut down to the given number of entries.'''
+    # (project, phase) -> durations
+    durations = {}
+    # project -> reason -> count
+    triggers = {}
+    cascade = []
+    for proj, phase, _, duration, _, reason in history:
+        durations.setdefault((proj, phase), []).append(duration)
+        if phase not in ('configure', 'build') or reason is None:
+            continue
+        if phase == 'build':
+            counts = triggers.setdefault(proj, {})
+            counts[reason] = counts.get(reason, 0) + 1
+        if reason.startswith(_CASCADE_PREFIX):
+            cascade.append(duration)
+
+    projects = sorted(set(proj for proj, _ in durations))
+
+    slowest = []
+    for proj in projects:
+        build = _summarize(durations.get((proj, 'build'), []))
+        configure = _summarize(durations.get((proj, 'configure'), []))
+        if build['count'] == 0 and configure['count'] == 0:
+            continue
+        slowest.append({
+            'project': proj,
+            'build': build,
+            'configure': configure
+        })
+    slowest.sort(key=lambda s: -((s['build']['avg'] or 0) +
+                                 (s['configure']['avg'] or 0)))
+
+    rebuilds = [{
+        'project': proj,
+        'count': sum(counts.values()),
+        'triggers': counts
+    } for proj, counts in triggers.items()]
+    rebuilds.sort(key=lambda r: (-r['count'], r['project']))
+
+    overhead = {}
+    for phase in _OVERHEAD_PHASES:
+        overhead[phase] = _summarize([
+            duration
+            for proj in projects
+            for duration in durations.get((proj, phase), [])])
+
+    def count(phase):
+        '''Returns how many times a phase ran across all projects.'''
+        return sum(len(durations.get((proj, phase), [])) for proj in projects)
+
+    build_time = sum(sum(durations.get((proj, phase), []))
+                     for proj in projects
+                     for phase in ('configure', 'build'))
+    cascade_time = sum(cascade)
+    return {
+        'slowest': slowest[:limit],
+        'rebuilds': rebuilds[:limit],
+        'overhead': overhead,
+        'cache': {
+            'build': _hit_rate(count('noop'), count('build')),
+            'test': _hit_rate(count('test-cached'), count('test'))
+        },
+        'cascade': {
+            'count': len(cascade),
+            'time': cascade_time,
+            'share': cascade_time / build_time if build_time > 0 else None
+        }
+    }
+
+
+def _secs(val):
+    '''Formats a duration in seconds, which may be None.'''
+    return '-' if val is None else '%.2fs' % val
+
+
+def _percent(val):
+    '''Formats a fraction as a percentage, which may be None.'''
+    return '-' if val is None else '%.1f%%' % (100 * val)
+
+
+def print_table(header, rows):
+    '''Prints rows of strings as a table with aligned columns.'''
+    widths = [max(len(row[i]) for row in [header] + rows)
+              for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(cell.ljust(width)
+                        for cell, width in zip(row, widths)).rstrip())
+
+
+def print_stats(stats):
+    '''Prints stats computed by compute_stats as human-readable tables.'''
+    print('Slowest projects:')
+    print_table(
+        ('project', 'builds', 'avg build', 'max build', 'configures',
+         'avg configure', 'max configure'),
+        [(s['project'],
+          str(s['build']['count']),
+          _secs(s['build']['avg']),
+          _secs(s['build']['max']),
+          str(s['configure']['count']),
+          _secs(s['configure']['avg']),
+          _secs(s['configure']['max'])) for s in stats['slowest']])
+
+    print()
+    print('Most rebuilt projects:')
+    print_table(
+        ('project', 'rebuilds', 'triggers'),
+        [(r['project'],
+          str(r['count']),
+          ', '.join('%s (%d)' % (reason, count) for reason, count in
+                    sorted(r['triggers'].items(), key=lambda t: -t[1])))
+         for r in stats['rebuilds']])
+
+    print()
+    print('Overhead:')
+    print_table(
+        ('phase', 'count', 'total', 'avg'),
+        [(phase,
+          str(o['count']),
+          _secs(o['total']),
+          _secs(o['avg'])) for phase, o in stats['overhead'].items()])
+
+    print()
+    print('Cache hit rates:')
+    print_table(
+        ('cache', 'hits', 'misses', 'rate'),
+        [(kind,
+          str(c['hits']),
+          str(c['misses']),
+          _percent(c['rate'])) for kind, c in stats['cache'].items()])
+
+    print()
+    cascade = stats['cascade']
+    print('Cascade rebuilds: %d, taking %s (%s of configure and build time)'
+          % (cascade['count'],
+             _secs(cascade['time']),
+             _percent(cascade['share'])))
+
+
+class Stats(Command):
+    '''The stats command.'''
+    @classmethod
+    def args(cls, parser):
+        '''Populates the argument parser for the stats subcmd.'''
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            default=False,
+            help='Print the stats as JSON')
+        parser.add_argument(
+            '-n', '--limit',
+            action='store',
+            type=int,
+            default=10,
+            help='How many projects to list in each per-project table')
+
+    @classmethod
+    def do(cls, ws, args):
+        '''Executes the stats subcmd.'''
+        stats = compute_stats(get_state(ws).get_history(), args.limit)
+        if args.json:
+            print(json.dumps(stats, indent=4))
+        else:
+            print_stats(stats)
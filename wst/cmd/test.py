@@ -23,38 +23,425 @@
 # SOFTWARE.
 #
 
+import json
 import os
+import subprocess
+import sys
+import time
 
 from wst import (
     WSError,
     log
 )
-from wst.cmd import Command
+from wst.cmd import (
+    Command,
+    report
+)
 from wst.conf import (
+    calculate_checksums,
+    dependency_closure,
     expand_vars,
     get_build_dir,
     get_build_env,
-    parse_manifest)
-from wst.shell import call_test
+    get_builder,
+    get_cache_key,
+    get_install_dir,
+    get_latest_durations,
+    get_source_dir,
+    get_stored_checksums,
+    get_test_durations,
+    get_ws_config,
+    parse_manifest,
+    record_test_cases,
+    record_timing,
+    set_cache_key)
+from wst.lock import lock_projects
+from wst.sched import (
+    Job,
+    run_jobs
+)
+from wst.shell import (
+    call,
+    call_git,
+    call_test_output
+)
+from wst.trace import span
+
 
+def _test_native(root, ws, proj, d, env, jobs, history):
+    '''Runs the test suite of a project using its builder's own test runner.
+    Returns whether the tests passed, the per-test results and the runner's
+    output.'''
+    builder = get_builder(d, proj)
+    try:
+        return builder.test(
+            proj,
+            get_install_dir(ws, proj),
+            get_source_dir(root, d, proj),
+            get_build_dir(ws, proj),
+            env,
+            d[proj]['builder-args'],
+            jobs,
+            history)
+    except NotImplementedError:
+        raise WSError('project %s uses native tests, but %s has no native '
+                      'test runner' % (proj, d[proj]['build']))
+
+
+def has_tests(d, proj):
+    '''Returns True if a project has any tests we can run: test commands, or
+    native tests its builder has a test runner for.'''
+    for props in d[proj]['tests']:
+        if props['builder'] != 'native' or get_builder(d, proj).native_tests:
+            return True
+    return False
+
+
+def _test(root, ws, proj, d, env, jobs, history):
+    '''Tests a given project, returning a dictionary describing the results.
+    Each test command, and each test run by a native test runner, becomes a
+    case in the results. Testing stops at the first failing entry.'''
+    cases = []
+    outputs = []
+    status = 'passed'
+    for props in d[proj]['tests']:
+        if props['builder'] == 'native':
+            success, native_cases, output = _test_native(root, ws, proj, d,
+                                                         env, jobs, history)
+            cases.extend(native_cases)
+            outputs.append(output)
+            if not success:
+                status = 'failed'
+                break
+            continue
 
-def _test(root, ws, proj, cmds, env):
-    '''Tests a given project.'''
-    for props in cmds:
         cwd = expand_vars(props['cwd'], ws, proj, env)
-        cmds = props['cmds']
-        for cmd in cmds:
+        for cmd in props['cmds']:
             cmd = expand_vars(cmd, ws, proj, env)
-            success = call_test(cmd.split(), cwd=cwd, env=env)
+            start = time.time()
+            success, output = call_test_output(cmd.split(), cwd=cwd, env=env)
+            cases.append({
+                'name': cmd,
+                'cmd': cmd,
+                'cwd': cwd,
+                'status': 'passed' if success else 'failed',
+                'duration': time.time() - start,
+                'output': output
+            })
             if not success:
-                repro_cmd = '(cd %s && ws env %s %s)' % (cwd, proj, cmd)
-                raise WSError('''
-%s tests failed. You can reproduce this failure by running:
-%s''' % (proj, repro_cmd))
+                status = 'failed'
+                break
+        if status == 'failed':
+            break
+
+    return {
+        'project': proj,
+        'status': status,
+        'cases': cases,
+        'output': ''.join(outputs)
+    }
+
+
+def _cache_key(ws, d, proj, build_type, env, checksums):
+    '''Returns the test cache key for a project, which changes whenever
+    anything that could change the outcome of its tests does, or None if the
+    project can't be cached.'''
+    closure = dependency_closure(d, (proj,))
+    try:
+        deps = [(dep, checksums[dep]) for dep in closure]
+    except KeyError:
+        # Something wasn't built (or was cleaned), so we know nothing about it.
+        return None
+    cmds = []
+    for props in d[proj]['tests']:
+        cwd = expand_vars(props['cwd'], ws, proj, env)
+        if props['builder'] is not None:
+            cmds.append((cwd, props['builder']))
+        for cmd in props['cmds']:
+            cmds.append((cwd, expand_vars(cmd, ws, proj, env)))
+
+    import hashlib
+    h = hashlib.sha1()
+    h.update(json.dumps([build_type, deps, cmds]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _changed_since(source_dir, ref):
+    '''Returns whether the given source tree differs from the given git ref,
+    or None if the ref doesn't exist in its repository.'''
+    try:
+        call_git(source_dir, ('rev-parse', '--verify', '--quiet',
+                              ref + '^{commit}'))
+    except subprocess.CalledProcessError:
+        return None
+    try:
+        call(('git', '-C', source_dir, 'diff', '--quiet', ref, '--'))
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1:
+            return True
+        raise
+    return False
+
+
+def _affected(root, ws, d, projects, since):
+    '''Returns the projects among the given ones whose tests could be affected
+    by changes, as a list of (project, reason) pairs. A project is affected if
+    its source changed, either since its tests last passed or, if since is
+    given, since that git ref, or if anything it depends on is affected.'''
+    candidates = [proj for proj in projects if has_tests(d, proj)]
+    closure = dependency_closure(d, candidates)
+
+    reasons = {}
+    built = get_stored_checksums(ws)
+    if since is None:
+        src_dirs = [get_source_dir(root, d, proj) for proj in closure]
+        current = dict(zip(closure, calculate_checksums(src_dirs)))
+    for proj in closure:
+        if since is not None:
+            changed = _changed_since(get_source_dir(root, d, proj), since)
+            if changed is None:
+                reasons[proj] = '%s not found in its repository' % since
+            elif changed:
+                reasons[proj] = 'sources differ from %s' % since
+            continue
+
+        tested = get_cache_key(ws, proj, 'tested')
+        if tested is None:
+            reasons[proj] = 'no passing test run recorded'
+        elif tested != current[proj]:
+            reasons[proj] = 'sources changed since its tests last passed'
+            if current[proj] != built.get(proj):
+                # The tests run against the build, which may still be the one
+                # that passed.
+                reasons[proj] += ', but it has not been rebuilt since'
+
+    # Everything downstream of a changed project is affected too. The closure
+    # is in dependency order, so dependencies are always decided first.
+    for proj in closure:
+        if proj in reasons:
+            continue
+        for dep in d[proj]['deps']:
+            if dep in reasons:
+                reasons[proj] = 'depends on %s' % dep
+                break
+
+    return [(proj, reasons[proj]) for proj in candidates if proj in reasons]
+
+
+def _replay(result, name=None):
+    '''Prints the captured output of a tested project, prefixing the project
+    with the name of its workspace if given.'''
+    label = result['project']
+    if name is not None:
+        label = '%s/%s' % (name, label)
+    if result['status'] == 'cached':
+        print('==> %s: cached pass' % label)
+        return
+    print('==> %s: %s (%.1fs)' % (label,
+                                  result['status'],
+                                  result['duration']))
+    for case in result['cases']:
+        sys.stdout.write(case['output'])
+    sys.stdout.write(result.get('output', ''))
+    sys.stdout.flush()
+
+
+def failure_msg(results, name=None):
+    '''Returns the error message for the given failed project results. If the
+    name of the workspace is given, the message refers to it explicitly.'''
+    if name is None:
+        ws_cmd = 'ws'
+        where = ''
+    else:
+        ws_cmd = 'ws -w %s' % name
+        where = ' in workspace %s' % name
+    repro_cmds = []
+    for result in results:
+        for case in result['cases']:
+            if case['status'] == 'failed':
+                repro_cmds.append('(cd %s && %s env %s %s)'
+                                  % (case['cwd'], ws_cmd, result['project'],
+                                     case['cmd']))
+    names = ', '.join(result['project'] for result in results)
+    return '''
+%s tests failed%s. You can reproduce the failures by running:
+%s''' % (names, where, '\n'.join(repro_cmds))
+
+
+def write_junit_xml(path, results):
+    '''Writes the given project results as JUnit XML, with one test suite per
+    project and one test case per test.'''
+    import xml.etree.ElementTree as ET
+
+    suites = ET.Element('testsuites')
+    for result in results:
+        cases = result['cases']
+        failures = [c for c in cases if c['status'] == 'failed']
+        skipped = [c for c in cases if c['status'] == 'skipped']
+        suite = ET.SubElement(suites, 'testsuite', {
+            'name': result['project'],
+            'tests': str(len(cases)),
+            'failures': str(len(failures)),
+            'skipped': str(len(skipped)),
+            'time': '%.3f' % result['duration']
+        })
+        if result['status'] == 'cached':
+            elem = ET.SubElement(suite, 'testcase', {
+                'classname': result['project'],
+                'name': 'tests',
+                'time': '0.000'
+            })
+            ET.SubElement(elem, 'skipped', {
+                'message': 'cached pass'
+            })
+        for case in cases:
+            elem = ET.SubElement(suite, 'testcase', {
+                'classname': result['project'],
+                'name': case['name'],
+                'time': '%.3f' % case['duration']
+            })
+            if case['status'] == 'failed':
+                failure = ET.SubElement(elem, 'failure', {
+                    'message': '%s failed' % case['name']
+                })
+                failure.text = case['output']
+            elif case['status'] == 'skipped':
+                ET.SubElement(elem, 'skipped')
+            else:
+                ET.SubElement(elem, 'system-out').text = case['output']
+        if len(result.get('output', '')) > 0:
+            ET.SubElement(suite, 'system-out').text = result['output']
+
+    ET.ElementTree(suites).write(path, encoding='utf-8',
+                                 xml_declaration=True)
+
+
+def write_json(path, results):
+    '''Writes the given project results as JSON.'''
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    with open(path, 'w') as f:
+        json.dump({'summary': summary, 'projects': results}, f, indent=4)
+        f.write('\n')
+
+
+class TestRun(object):
+    '''Tests projects as jobs for the scheduler (see wst.sched), keeping track
+    of the results. This is shared by ws test and ws build --test. If the
+    workspace name is given, progress reports include it.'''
+    def __init__(self, root, ws, d, args, use_cache, name=None):
+        self._root = root
+        self._ws = ws
+        self._name = name
+        self._d = d
+        self._args = args
+        self._use_cache = use_cache
+        self._projects = {}
+        self._keys = {}
+        self._tested = {}
+        self.results = {}
+
+    def _check_cache(self, proj, build_env):
+        '''Returns True if the project's tests passed before and nothing that
+        goes into them has changed since.'''
+        ws = self._ws
+        checksums = get_stored_checksums(ws)
+        build_type = get_ws_config(ws)['type']
+        key = _cache_key(ws, self._d, proj, build_type, build_env, checksums)
+        self._keys[proj] = key
+        self._tested[proj] = checksums.get(proj)
+        if not self._use_cache or key is None:
+            return False
+        return key == get_cache_key(ws, proj, 'test')
+
+    def _run(self, proj, slots):
+        '''Tests a single project, returning True if its tests passed.'''
+        ws = self._ws
+        d = self._d
+        start = time.time()
+        # Keep the project and everything it uses from being rebuilt or
+        # cleaned out from under the tests.
+        closure = dependency_closure(d, (proj,))
+        with lock_projects(ws, shared=closure):
+            build_env = get_build_env(ws, d, proj)
+            if self._check_cache(proj, build_env):
+                log('tests for %s passed before and nothing changed; '
+                    'skipping' % proj)
+                result = {
+                    'project': proj,
+                    'status': 'cached',
+                    'cases': []
+                }
+            else:
+                log('testing %s' % proj)
+                report(self._args, proj, 'test', 'started',
+                       workspace=self._name)
+                with span('test', project=proj, workspace=self._name):
+                    result = _test(self._root, ws, proj, d, build_env, slots,
+                                   get_test_durations(ws, proj))
+        result['start'] = start
+        result['duration'] = time.time() - start
+        self.results[proj] = result
+        return result['status'] != 'failed'
+
+    def job(self, name, proj, deps=()):
+        '''Returns a scheduler job with the given name that tests the given
+        project once the given jobs have succeeded.'''
+        self._projects[name] = proj
+        # Native test runners can run tests in parallel themselves.
+        native = any(props['builder'] == 'native'
+                     for props in self._d[proj]['tests'])
+        return Job(name,
+                   lambda slots: self._run(proj, slots),
+                   deps=deps,
+                   slots=self._args.jobs if native else 1,
+                   exclusive=self._d[proj]['serial'])
+
+    def done(self, job):
+        '''Replays the output of a finished test job and records its
+        results. This must be called from the scheduler's done callback.'''
+        ws = self._ws
+        proj = self._projects[job.name]
+        try:
+            result = self.results[proj]
+        except KeyError:
+            # The job raised an exception, which run_jobs will re-raise, or was
+            # skipped.
+            return
+        _replay(result, self._name)
+        report(self._args, proj, 'test', result['status'], result['duration'],
+               workspace=self._name)
+
+        # Remember which sources passed the tests for --affected.
+        if result['status'] == 'failed':
+            set_cache_key(ws, proj, 'tested', None)
+        else:
+            set_cache_key(ws, proj, 'tested', self._tested[proj])
+        if result['status'] == 'cached':
+            # Keep track of how often the cache saves us a run, for ws stats.
+            record_timing(ws, proj, 'test-cached', result['start'],
+                          result['duration'])
+            return
+        if result['status'] == 'passed':
+            set_cache_key(ws, proj, 'test', self._keys[proj])
+        else:
+            set_cache_key(ws, proj, 'test', None)
+        record_timing(ws, proj, 'test', result['start'], result['duration'])
+        record_test_cases(ws, proj, result['cases'])
+
+    def ordered(self, projects):
+        '''Returns the results for the given projects that were tested, in
+        the given order.'''
+        return [self.results[proj] for proj in projects
+                if proj in self.results]
 
 
 class Test(Command):
     '''The test command.'''
+    tools = ('gcc',)
+    metrics = True
+
     @classmethod
     def args(cls, parser):
         '''Populates the argument parser for the build command.'''
@@ -63,6 +450,41 @@ class Test(Command):
             action='store',
             nargs='*',
             help='Test a particular project or projects')
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='Number of projects, or tests within projects using native '
+                 'test runners, to run at once')
+        parser.add_argument(
+            '--junit-xml',
+            action='store',
+            default=None,
+            help='Write the results as JUnit XML to the given file')
+        parser.add_argument(
+            '--json',
+            action='store',
+            default=None,
+            help='Write the results as JSON to the given file')
+        parser.add_argument(
+            '--no-cache',
+            action='store_true',
+            default=False,
+            help='Rerun tests even if nothing they depend on changed since '
+                 'they last passed')
+        parser.add_argument(
+            '--affected',
+            action='store_true',
+            default=False,
+            help='Test only projects affected by source changes since their '
+                 'tests last passed, and everything depending on them')
+        parser.add_argument(
+            '--since',
+            action='store',
+            default=None,
+            help='With --affected, select projects whose sources differ from '
+                 'the given git ref instead')
 
     @classmethod
     def do(cls, ws, args):
@@ -73,11 +495,32 @@ class Test(Command):
         for project in args.projects:
             if project not in d:
                 raise WSError('unknown project %s' % project)
+        if args.jobs < 1:
+            raise WSError('the number of jobs must be at least 1')
+        if args.since is not None and not args.affected:
+            raise WSError('--since only makes sense with --affected')
 
         if len(args.projects) == 0:
-            projects = d.keys()
+            # Only schedule the projects that have anything to test.
+            projects = [proj for proj in d if has_tests(d, proj)]
+            if len(projects) == 0:
+                print('no projects have tests')
+                return
         else:
             projects = args.projects
+            for proj in projects:
+                if not has_tests(d, proj):
+                    raise WSError('no tests that can run are configured for '
+                                  '%s' % proj)
+
+        if args.affected:
+            affected = _affected(args.root, ws, d, projects, args.since)
+            if len(affected) == 0:
+                print('no projects are affected')
+                return
+            for proj, reason in affected:
+                print('selected %s: %s' % (proj, reason))
+            projects = [proj for proj, _ in affected]
 
         for proj in projects:
             build_dir = get_build_dir(ws, proj)
@@ -85,11 +528,22 @@ class Test(Command):
                 raise WSError('build directory for %s doesn\'t exist; have '
                               'you built it yet?' % proj)
 
-            if 'tests' not in d[proj]:
-                raise WSError('no test configured for %s' % proj)
+        run = TestRun(args.root, ws, d, args, not args.no_cache)
 
-        for proj in projects:
-            log('testing %s' % proj)
-            build_env = get_build_env(ws, d, proj)
-            cmds = d[proj]['tests']
-            _test(args.root, ws, proj, cmds, build_env)
+        # Start the projects that took longest last time first, so they don't
+        # hold up the end of the run. Projects never tested before might be
+        # slow too, so they go first.
+        last_durations = get_latest_durations(ws, 'test')
+        order = sorted(projects,
+                       key=lambda p: -last_durations.get(p, float('inf')))
+        run_jobs([run.job(proj, proj) for proj in order], args.jobs, run.done)
+
+        results = run.ordered(projects)
+        if args.junit_xml is not None:
+            write_junit_xml(args.junit_xml, results)
+        if args.json is not None:
+            write_json(args.json, results)
+
+        failed = [r for r in results if r['status'] == 'failed']
+        if len(failed) > 0:
+            raise WSError(failure_msg(failed))
@@ -24,40 +24,47 @@
 #
 
 import collections
-import copy
-import errno
-import hashlib
+import importlib
 import logging
 import os
-import yaml
+import threading
+import time
 
 from wst import (
     DEFAULT_TARGETS,
     dry_run,
     log,
+    span,
     WSError
 )
-from wst.shell import (
-    call_git,
-    call_output,
-    remove,
-    rmtree
-)
 
-from wst.builder.cmake import CMakeBuilder  # noqa: E402
-from wst.builder.meson import MesonBuilder  # noqa: E402
-from wst.builder.setuptools import SetuptoolsBuilder  # noqa: E402
+
+def _yaml():
+    '''Returns the yaml module. PyYAML is comparatively slow to import and not
+    every command needs it, so we import it only on first use.'''
+    import yaml
+    return yaml
+
+
+def _yaml_load(f):
+    '''Safely loads YAML from the given file, using the libyaml-backed loader
+    if PyYAML was built with it, since it is much faster on large
+    manifests.'''
+    yaml = _yaml()
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(f, Loader=loader)
 
 
 _REQUIRED_KEYS = {'build'}
-_OPTIONAL_KEYS = {'deps', 'env', 'args', 'builder-args', 'targets', 'tests'}
+_OPTIONAL_KEYS = {'deps', 'env', 'args', 'builder-args', 'targets', 'tests',
+                  'serial', 'resources'}
 _ALL_KEYS = _REQUIRED_KEYS.union(_OPTIONAL_KEYS)
 def parse_yaml(root, manifest):  # noqa: E302
     '''Parses the given manifest for YAML and syntax correctness, or bails if
     something went wrong.'''
     try:
         with open(manifest, 'r') as f:
-            d = yaml.safe_load(f)
+            d = _yaml_load(f)
     except IOError:
         raise WSError('ws manifest %s not found' % manifest)
 
@@ -189,9 +196,17 @@ def parse_yaml(root, manifest):  # noqa: E302
                 raise WSError('"tests" key in project %s must be a list'
                               % proj)
             for i, test in enumerate(tests):
+                builder = None
                 if isinstance(test, str):
                     cwd = '${BUILDDIR}'
                     cmds = [test]
+                elif isinstance(test, dict) and 'builder' in test:
+                    builder = test['builder']
+                    if builder != 'native':
+                        raise WSError('test "builder" key "%s" in project %s '
+                                      'must be "native"' % (builder, proj))
+                    cwd = '${BUILDDIR}'
+                    cmds = []
                 elif isinstance(test, dict):
                     try:
                         cwd = test['cwd']
@@ -213,16 +228,76 @@ def parse_yaml(root, manifest):  # noqa: E302
                 else:
                     raise WSError('test "%s" in project %s must be '
                                   'a string or dictionary' % (test, proj))
-                tests[i] = {'cwd': cwd, 'cmds': cmds}
+                tests[i] = {'cwd': cwd, 'cmds': cmds, 'builder': builder}
+
+        try:
+            serial = props['serial']
+        except KeyError:
+            props['serial'] = False
+        else:
+            if not isinstance(serial, bool):
+                raise WSError('"serial" key in project %s must be true or '
+                              'false' % proj)
+
+        try:
+            resources = props['resources']
+        except KeyError:
+            resources = {}
+        if not isinstance(resources, dict):
+            raise WSError('"resources" key in project %s must be a dictionary'
+                          % proj)
+        for key in resources:
+            if key not in ('memory', 'weight'):
+                raise WSError('unknown resource "%s" in project %s'
+                              % (key, proj))
+        try:
+            memory = parse_size(resources['memory'])
+        except KeyError:
+            memory = None
+        except ValueError as e:
+            raise WSError('bad "memory" resource in project %s: %s'
+                          % (proj, e))
+        weight = resources.get('weight', 1)
+        if not isinstance(weight, int) or weight < 1:
+            raise WSError('"weight" resource in project %s must be a '
+                          'positive integer' % proj)
+        props['resources'] = {'memory': memory, 'weight': weight}
 
         props['path'] = os.path.join(parent, proj)
 
     return d
 
 
-def include_paths(d, manifest):
+_SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+def parse_size(val):  # noqa: E302
+    '''Parses a size in bytes, given either as a number or as a string with an
+    optional K, M, G or T suffix (such as "20G"). Raises ValueError if it's not
+    a valid size.'''
+    if isinstance(val, bool):
+        raise ValueError('%s is not a size' % val)
+    if isinstance(val, (int, float)):
+        size = val
+    else:
+        s = str(val).strip().lower()
+        if s.endswith('b'):
+            s = s[:-1]
+        multiplier = 1
+        if len(s) > 0 and s[-1] in _SIZE_SUFFIXES:
+            multiplier = _SIZE_SUFFIXES[s[-1]]
+            s = s[:-1]
+        try:
+            size = float(s) * multiplier
+        except ValueError:
+            raise ValueError('"%s" is not a size' % val)
+    if size < 0:
+        raise ValueError('%s is negative' % val)
+    return int(size)
+
+
+def include_paths(d, manifest, probed=None):
     '''Return the manifest absolute paths included from the given parsed
-    manifest.'''
+    manifest. If probed is given, every path looked at to find them is added
+    to it.'''
     try:
         includes = d['include']
     except KeyError:
@@ -251,6 +326,8 @@ def include_paths(d, manifest):
         found_match = False
         for search_path in search_paths:
             full_path = os.path.realpath(os.path.join(search_path, path))
+            if probed is not None:
+                probed.add(full_path)
             if os.path.exists(full_path):
                 found_match = True
                 break
@@ -294,30 +371,38 @@ def merge_manifest(parent, parent_path, child, child_path):
     parent_projects.update(child_projects)
 
 
-def merge_includes(root, d, parent_manifest):
+def merge_includes(root, d, parent_manifest, probed=None):
     '''Recursively merge all the include lines from the manifest into the given
     dictionary. Include paths are relative to the including manifest's parent
-    directory.'''
-    included = set(include_paths(d, parent_manifest))
+    directory. Returns the set of manifests that were included. If probed is
+    given, every path looked at to find them is added to it.'''
+    included = set(include_paths(d, parent_manifest, probed))
     queue = collections.deque(included)
     while len(queue) > 0:
         manifest = queue.popleft()
         d_include = parse_yaml(root, manifest)
         log('merging manifest %s into %s' % (manifest, parent_manifest))
         merge_manifest(d, parent_manifest, d_include, manifest)
-        for path in include_paths(d_include, manifest):
+        for path in include_paths(d_include, manifest, probed):
             # Prevent double-inclusion.
             if path in included:
                 continue
             queue.append(path)
             included.add(path)
 
+    return included
 
-def parse_manifest_file(root, manifest):
+
+def parse_manifest_file(root, manifest, files=None, probed=None):
     '''Parses the given ws manifest file, returning a dictionary of the
-    manifest data.'''
+    manifest data. If files is given, the paths of every manifest that was read
+    are added to it, and if probed is given, so is every other path looked at
+    to find them.'''
     d = parse_yaml(root, manifest)
-    merge_includes(root, d, manifest)
+    included = merge_includes(root, d, manifest, probed)
+    if files is not None:
+        files.add(os.path.realpath(manifest))
+        files.update(included)
 
     # Compute reverse-dependency list.
     projects = d['projects']
@@ -338,14 +423,144 @@ def parse_manifest_file(root, manifest):
     return projects
 
 
-_WS_MANIFEST = None
+# Importing PyYAML and parsing the manifest take longer than everything else
+# that quick commands like ws list do, so the parsed manifest is also cached in
+# the root. The cache records every path the manifest was read from or looked
+# for, and is only used if none of them changed since.
+_MANIFEST_CACHE_VERSION = 1
+# A file changed this recently may change again without its mtime moving, so
+# we don't cache what we read from it.
+_RACY_SECONDS = 2
+def get_manifest_cache(root):  # noqa: E302
+    '''Returns the file caching the parsed manifest of the given root.'''
+    return os.path.join(root, 'manifest.cache')
+
+
+def _path_state(path):
+    '''Returns what tells us whether the given path changed, or None if it
+    doesn't exist.'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _load_manifest_cache(root):
+    '''Returns the parsed manifest of the given root and the files it was read
+    from, or None if the cache is missing or out of date.'''
+    import marshal
+    try:
+        with open(get_manifest_cache(root), 'rb') as f:
+            version, paths, d, files = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != _MANIFEST_CACHE_VERSION:
+        return None
+    for path, state in paths:
+        if _path_state(path) != state:
+            return None
+    return d, set(files)
+
+
+def _write_manifest_cache(root, d, files, probed):
+    '''Caches the parsed manifest of the given root, which was read from the
+    given files after looking at the given paths.'''
+    import marshal
+    now = time.time()
+    paths = []
+    for path in sorted(probed.union(files)):
+        state = _path_state(path)
+        if state is not None and now - state[0] / 1e9 < _RACY_SECONDS:
+            return
+        paths.append((path, state))
+    try:
+        data = marshal.dumps((_MANIFEST_CACHE_VERSION,
+                              paths,
+                              d,
+                              sorted(files)))
+    except ValueError:
+        # Something in the manifest, such as a date, can't be cached.
+        return
+
+    # This is not a user-visible action, so do it even on dry runs. Failing
+    # just means parsing again next time.
+    path = get_manifest_cache(root)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+# Parsed manifests and the files they were read from, keyed by root. These are
+# keyed rather than global so that a process (such as the ws daemon or a user
+# of wst.api) can work with several roots at once.
+_WS_MANIFESTS = {}
+_WS_MANIFEST_FILES = {}
 def parse_manifest(root):  # noqa: E302
     '''Parses the ws manifest, returning a dictionary of the manifest data.'''
-    # Parse.
-    global _WS_MANIFEST
-    if _WS_MANIFEST is None:
-        _WS_MANIFEST = parse_manifest_file(root, get_manifest_link(root))
-    return _WS_MANIFEST
+    key = os.path.realpath(root)
+    try:
+        return _WS_MANIFESTS[key]
+    except KeyError:
+        pass
+
+    with span('parse-manifest'):
+        cached = _load_manifest_cache(key)
+        if cached is not None:
+            d, files = cached
+        else:
+            files = set()
+            # The manifest link can be pointed at another manifest.
+            probed = {get_manifest_link(key)}
+            d = parse_manifest_file(root, get_manifest_link(root), files,
+                                    probed)
+            _write_manifest_cache(key, d, files, probed)
+    _WS_MANIFESTS[key] = d
+    _WS_MANIFEST_FILES[key] = files
+    return d
+
+
+def get_manifest_files(root):
+    '''Returns the paths of every manifest file that makes up the ws manifest,
+    including the ones pulled in through "include".'''
+    parse_manifest(root)
+    return set(_WS_MANIFEST_FILES[os.path.realpath(root)])
+
+
+def clear_manifest_cache(root):
+    '''Forgets the parsed manifest of the given root so that it is re-read the
+    next time it is needed.'''
+    key = os.path.realpath(root)
+    _WS_MANIFESTS.pop(key, None)
+    _WS_MANIFEST_FILES.pop(key, None)
+    # Build environments come from the manifest too.
+    _BUILD_ENVS.clear()
+
+
+def clear_config_cache(ws):
+    '''Forgets the cached config of the given workspace so that it is re-read
+    the next time it is needed. Any unsynced changes to it are lost.'''
+    key = os.path.realpath(ws)
+    _WS_CONFIGS.pop(key, None)
+    _ORIG_WS_CONFIGS.pop(key, None)
+
+
+def clear_caches():
+    '''Forgets every parsed manifest and workspace config so that they are
+    re-read the next time they are needed. This is only needed by long-running
+    processes like the ws daemon.'''
+    _WS_MANIFESTS.clear()
+    _WS_MANIFEST_FILES.clear()
+    _BUILD_ENVS.clear()
+    _WS_CONFIGS.clear()
+    _ORIG_WS_CONFIGS.clear()
 
 
 def dependency_closure(d, projects):
@@ -372,10 +587,31 @@ def dependency_closure(d, projects):
     return tuple(order)
 
 
+# Environment variable that caches the result of find_root. ws env sets it
+# inside project environments, and scripts calling ws repeatedly (such as bash
+# completion) can export it to skip the search.
+ROOT_ENV_VAR = 'WSROOT'
+
+
 def find_root(start_dir):
     '''Recursively looks up in the directory hierarchy for a directory named
-    .ws, and returns the first one found, or None if one was not found.'''
+    .ws, and returns the first one found, or None if one was not found. If
+    WSROOT is set to a root whose tree contains start_dir, it is returned
+    without searching.'''
     path = os.path.realpath(start_dir)
+    try:
+        root = os.environ[ROOT_ENV_VAR]
+    except KeyError:
+        pass
+    else:
+        # Resolve symlinks the same way as the search below, so that the root
+        # is always known under the same path.
+        root = os.path.realpath(root)
+        parent = os.path.dirname(root)
+        if (os.path.commonpath((path, parent)) == parent and
+                os.path.isdir(root)):
+            return root
+
     while path != '/':
         ws = os.path.join(path, '.ws')
         if os.path.isdir(ws):
@@ -396,11 +632,17 @@ def get_ws_dir(root, ws):
 
 
 def get_ws_config_path(ws):
-    '''Returns the ws internal config file, used for tracking the state of the
-    workspace.'''
+    '''Returns the YAML config file that older versions of ws used for
+    tracking the state of the workspace. This is only used to migrate such
+    workspaces to the state store.'''
     return os.path.join(ws, 'config.yaml')
 
 
+def get_state_path(ws):
+    '''Returns the database holding the state of the workspace.'''
+    return os.path.join(ws, 'state.db')
+
+
 def get_ws_root(ws):
     '''Returns the root (.ws directory) given a workspace path.'''
     return os.path.realpath(os.path.join(ws, os.pardir))
@@ -415,88 +657,178 @@ def get_new_config(proj):
             }
 
 
-_ORIG_WS_CONFIG = None
-_WS_CONFIG = None
+def split_args(args):
+    '''Splits all arguments by spaces so that args like '-D something' turn
+    into ['-D', 'something'], which is what exec requires.'''
+    split = []
+    for arg in args:
+        split.extend(arg.split())
+    return split
+
+
+def _migrate_state(ws, store):
+    '''Imports the config.yaml used by older versions of ws into the given
+    empty state store, and then removes it along with the per-project checksum
+    files. The checksums describe build trees in a layout that is no longer
+    used, so they are dropped.'''
+    config_path = get_ws_config_path(ws)
+    # Other ws processes may be migrating the same workspace, and not all of
+    # them hold the workspace lock. Taking the database's write lock up front
+    # queues us behind them, and then whoever comes second finds the work
+    # done.
+    with store.transaction():
+        if not store.is_empty():
+            return
+        try:
+            with open(config_path, 'r') as f:
+                config = _yaml_load(f)
+        except FileNotFoundError:
+            # Someone else migrated it and removed the file before we looked.
+            return
+
+        log('migrating %s to %s' % (config_path, get_state_path(ws)),
+            logging.INFO)
+        store.set_type(config['type'])
+        for proj_config in config['projects'].values():
+            # Older versions allowed hand-edited, unsplit args.
+            proj_config['args'] = split_args(proj_config['args'])
+        store.set_projects(config['projects'])
+
+    # The state store is now authoritative, so the old files would only be
+    # confusing. This is not a user-visible action, so do it even on dry runs.
+    try:
+        os.unlink(config_path)
+    except FileNotFoundError:
+        pass
+    import shutil
+    shutil.rmtree(get_checksum_dir(ws), ignore_errors=True)
+
+
+# SQLite connections can't be shared between threads, so each thread opens its
+# own state stores. WAL mode lets them all work on the database at once.
+_STATES = threading.local()
+def get_state(ws):  # noqa: E302
+    '''Returns the current thread's state store for the given workspace,
+    creating it if needed.'''
+    key = os.path.realpath(ws)
+    try:
+        states = _STATES.stores
+    except AttributeError:
+        states = {}
+        _STATES.stores = states
+    try:
+        return states[key]
+    except KeyError:
+        pass
+
+    # sqlite3 is slow to import, and commands like ws list don't need it.
+    from wst.state import StateStore
+    store = StateStore(get_state_path(key))
+    if store.is_empty() and os.path.exists(get_ws_config_path(key)):
+        _migrate_state(key, store)
+    states[key] = store
+    return store
+
+
+_SNAPSHOT_FIELDS = ('enable', 'taint', 'args')
+def _snapshot(config):  # noqa: E302
+    '''Returns a cheap, comparable copy of the given config, used to tell
+    what changed.'''
+    if config is None:
+        return None
+    # Project entries are in _SNAPSHOT_FIELDS order.
+    projects = dict((proj, (c['enable'], c['taint'], tuple(c['args'])))
+                    for proj, c in config['projects'].items())
+    return (config['type'], projects)
+
+
+# Workspace configs, and snapshots of them as they were when read, keyed by
+# the real path of the workspace.
+_ORIG_WS_CONFIGS = {}
+_WS_CONFIGS = {}
 def get_ws_config(ws):  # noqa: E302
     '''Parses the current workspace config, returning a dictionary of the
     state.'''
-    global _WS_CONFIG
-    if _WS_CONFIG is None:
-        config_path = get_ws_config_path(ws)
-        with open(config_path, 'r') as f:
-            _WS_CONFIG = yaml.safe_load(f)
-            global _ORIG_WS_CONFIG
-            # Save a copy of the config so we know later whether or not to
-            # write it out when someone asks to sync the config.
-            _ORIG_WS_CONFIG = copy.deepcopy(_WS_CONFIG)
+    key = os.path.realpath(ws)
+    try:
+        config = _WS_CONFIGS[key]
+    except KeyError:
+        with span('load-config'):
+            store = get_state(ws)
+            if store.is_empty():
+                raise WSError('workspace %s has no config; was it created '
+                              'with ws init?' % ws)
+            config = store.load_config()
+        _WS_CONFIGS[key] = config
+        # Save a snapshot of the config so we know later which parts of it to
+        # write out when someone asks to sync the config.
+        _ORIG_WS_CONFIGS[key] = _snapshot(config)
 
     # Check if projects were added or removed from the manifest. If so, the
     # config needs to be updated accordingly.
     d = parse_manifest(get_ws_root(ws))
     deletions = []
-    for proj in _WS_CONFIG['projects']:
+    for proj in config['projects']:
         if proj not in d:
             deletions.append(proj)
+    if len(deletions) > 0:
+        # Import here to prevent a circular import.
+        from wst.lock import lock_projects
+        from wst.trash import trash
     for proj in deletions:
-        del _WS_CONFIG['projects'][proj]
-        checksum_file = get_checksum_file(ws, proj)
+        del config['projects'][proj]
         proj_dir = get_proj_dir(ws, proj)
         log('removing project %s, which is not in the manifest' % proj,
             logging.INFO)
-        remove(checksum_file, True)
-        rmtree(proj_dir, True)
+        with lock_projects(ws, exclusive=(proj,)):
+            trash(get_ws_root(ws), proj_dir)
 
     for proj in d:
-        if proj in _WS_CONFIG['projects']:
+        if proj in config['projects']:
             continue
         # Project is not in the config, so add it in.
-        _WS_CONFIG['projects'][proj] = get_new_config(proj)
-
-    # Split all project arguments by spaces so that args like '-D something'
-    # turn into ['-D', 'something'], which is what exec requires. We do this
-    # at parse time rather than in the "config" command to allow the user to
-    # hand-edit in a natural way and have the config still work properly. The
-    # next time the config is saved, it will be split by spaces.
-    for proj, proj_map in _WS_CONFIG['projects'].items():
-        parsed_args = []
-        args = proj_map['args']
-        for arg in args:
-            parsed_args.extend(arg.split())
-        proj_map['args'] = parsed_args
-
-    return _WS_CONFIG
-
-
-def _sync_file(f):
-    '''Syncs a file to disk in whichever way we have available.'''
-    # Not all systems have fdatasync. Empirically, the Mac appears not to have
-    # it.
-    if hasattr(os, 'fdatasync'):
-        os.fdatasync(f)
-    else:
-        os.fsync(f)
+        config['projects'][proj] = get_new_config(proj)
 
+    return config
 
-def write_config(ws, config):
-    '''Atomically updates the current ws config using the standard trick of
-       writing to a tmp file in the same filesystem, syncing that file, and
-       renaming it to replace the current contents.'''
-    config_path = get_ws_config_path(ws)
-    tmpfile = '%s.tmp' % config_path
-    with open(tmpfile, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
-        f.flush()
-        _sync_file(f)
-    os.rename(tmpfile, config_path)
 
-    global _WS_CONFIG
-    _WS_CONFIG = config
+def write_config(ws, config):
+    '''Replaces the entire ws config in a single transaction.'''
+    store = get_state(ws)
+    with store.transaction():
+        store.set_type(config['type'])
+        store.delete_projects(set(store.load_config()['projects']) -
+                              set(config['projects']))
+        store.set_projects(config['projects'])
+
+    key = os.path.realpath(ws)
+    _WS_CONFIGS[key] = config
+    _ORIG_WS_CONFIGS[key] = _snapshot(config)
+
+
+def config_changed(ws):
+    '''Returns True if the config of the given workspace was changed since we
+    first read it.'''
+    if ws is None:
+        return False
+    key = os.path.realpath(ws)
+    try:
+        config = _WS_CONFIGS[key]
+    except KeyError:
+        return False
+    return _snapshot(config) != _ORIG_WS_CONFIGS[key]
 
 
 def sync_config(ws):
-    '''Writes out the config if and only if it changed since we first read
-       it.'''
-    if _WS_CONFIG == _ORIG_WS_CONFIG:
+    '''Writes out the parts of the config that changed since we first read
+       it, if any.'''
+    with span('sync-config'):
+        _sync_config(ws)
+
+
+def _sync_config(ws):
+    '''Does the work of sync_config.'''
+    if not config_changed(ws):
         log('ws config did not change, so not updating')
         return
     log('updating config at %s' % ws)
@@ -504,7 +836,39 @@ def sync_config(ws):
     if dry_run():
         return
 
-    write_config(ws, _WS_CONFIG)
+    # Other ws processes may have changed the config since we read it, so
+    # write only the individual fields we changed rather than our whole copy.
+    key = os.path.realpath(ws)
+    config = _WS_CONFIGS[key]
+    orig_type, orig_projects = _ORIG_WS_CONFIGS[key]
+    current = _snapshot(config)
+    current_type, current_projects = current
+
+    added = {}
+    changed = {}
+    for proj, c in current_projects.items():
+        try:
+            orig = orig_projects[proj]
+        except KeyError:
+            added[proj] = config['projects'][proj]
+            continue
+        fields = {}
+        for i, field in enumerate(_SNAPSHOT_FIELDS):
+            if c[i] != orig[i]:
+                fields[field] = config['projects'][proj][field]
+        if len(fields) > 0:
+            changed[proj] = fields
+    deleted = [proj for proj in orig_projects if proj not in current_projects]
+
+    store = get_state(ws)
+    with store.transaction():
+        if current_type != orig_type:
+            store.set_type(current_type)
+        store.add_projects(added)
+        for proj, fields in changed.items():
+            store.update_project(proj, fields)
+        store.delete_projects(deleted)
+    _ORIG_WS_CONFIGS[key] = current
 
 
 def get_default_ws_name():
@@ -518,6 +882,21 @@ def get_default_ws_link(root):
     return os.path.join(root, get_default_ws_name())
 
 
+def get_ws_names(root):
+    '''Returns the names of all workspaces in the given root.'''
+    names = []
+    for name in os.listdir(root):
+        if name in (get_default_ws_name(),
+                    get_manifest_link_name(),
+                    get_trash_name()):
+            continue
+        if not os.path.isdir(os.path.join(root, name)):
+            # Not a workspace (e.g. the daemon socket).
+            continue
+        names.append(name)
+    return names
+
+
 def get_manifest_link_name():
     '''Returns the name of the symlink to the ws manifest.'''
     return 'manifest'
@@ -528,14 +907,61 @@ def get_manifest_link(root):
     return os.path.join(root, get_manifest_link_name())
 
 
-def get_checksum_dir(ws):
-    '''Returns the directory containing project build checksums.'''
-    return os.path.join(ws, 'checksum')
+def get_ws_lock(ws):
+    '''Returns the file used to lock a workspace.'''
+    return os.path.join(ws, 'lock')
+
+
+def get_lock_dir(ws):
+    '''Returns the directory containing the per-project lock files.'''
+    return os.path.join(ws, 'locks')
+
+
+def get_proj_lock(ws, proj):
+    '''Returns the file used to lock a project.'''
+    return os.path.join(get_lock_dir(ws), '%s.lock' % proj)
+
+
+def get_daemon_socket(root):
+    '''Returns the path of the unix socket the ws daemon listens on.'''
+    return os.path.join(root, 'daemon.sock')
+
+
+def get_daemon_log(root):
+    '''Returns the path of the file to which the ws daemon writes errors.'''
+    return os.path.join(root, 'daemon.log')
+
+
+def get_trash_name():
+    '''Returns the name of the directory into which directories are moved to
+    be deleted in the background.'''
+    return 'trash'
+
+
+def get_trash_dir(root):
+    '''Returns the directory into which directories are moved to be deleted in
+    the background.'''
+    return os.path.join(root, get_trash_name())
+
+
+def has_trash(root):
+    '''Returns True if the trash of the given root has anything in it.'''
+    try:
+        return len(os.listdir(get_trash_dir(root))) > 0
+    except FileNotFoundError:
+        return False
 
 
-def get_checksum_file(ws, proj):
-    '''Returns the file containing the checksum for a given project.'''
-    return os.path.join(get_checksum_dir(ws), proj)
+def get_trash_lock(root):
+    '''Returns the lock file held by the process emptying the trash.'''
+    return os.path.join(root, 'trash.lock')
+
+
+def get_checksum_dir(ws):
+    '''Returns the directory in which older versions of ws kept project build
+    checksums. This is only used to migrate such workspaces to the state
+    store.'''
+    return os.path.join(ws, 'checksum')
 
 
 def get_source_dir(root, d, proj):
@@ -562,15 +988,36 @@ def get_source_link(ws, proj):
     return os.path.join(get_proj_dir(ws, proj), 'src')
 
 
-def get_build_dir(ws, proj):
-    '''Returns the build directory for a given project.'''
+def get_legacy_build_dir(ws, proj):
+    '''Returns the build directory that older versions of ws used for all
+    build types.'''
     return os.path.join(get_proj_dir(ws, proj), 'build')
 
 
-def get_install_dir(ws, proj):
+def get_build_type(ws):
+    '''Returns the current build type of the workspace.'''
+    return get_ws_config(ws)['type']
+
+
+def get_build_type_dir(ws, proj, build_type=None):
+    '''Returns the directory holding a project's build and install trees for
+    the given build type, which defaults to the current one. Each build type
+    has its own trees, so switching between them doesn't require a
+    rebuild.'''
+    if build_type is None:
+        build_type = get_build_type(ws)
+    return os.path.join(get_proj_dir(ws, proj), build_type)
+
+
+def get_build_dir(ws, proj, build_type=None):
+    '''Returns the build directory for a given project.'''
+    return os.path.join(get_build_type_dir(ws, proj, build_type), 'build')
+
+
+def get_install_dir(ws, proj, build_type=None):
     '''Returns the install directory for a given project (the directory we use
     for --prefix and similar arguments.'''
-    return os.path.join(get_build_dir(ws, proj), 'install')
+    return os.path.join(get_build_dir(ws, proj, build_type), 'install')
 
 
 _HOST_TRIPLET = None
@@ -578,6 +1025,7 @@ def get_host_triplet():  # noqa: E302
     '''Gets the GCC host triplet for the current machine.'''
     global _HOST_TRIPLET
     if _HOST_TRIPLET is None:
+        from wst.shell import call_output
         _HOST_TRIPLET = call_output(['gcc', '-dumpmachine'], override=True)
         _HOST_TRIPLET = _HOST_TRIPLET.rstrip()
     return _HOST_TRIPLET
@@ -609,31 +1057,53 @@ def get_pkgconfig_paths(ws, proj):
 def set_stored_checksum(ws, proj, checksum):
     '''Sets the stored project checksum. This should be called after building
     the project.'''
-    # Note that we don't worry about atomically writing this. The worst cases
-    # are:
-    # - We crash or get power loss and have a partial write. This causes a
-    # corrupt checksum, which will not match the calculated checksum, be
-    # stale, and cause us to redo the build. But an incremental build system
-    # will cause this to have pretty low cost.
-    # - The checksum is never updated when it should have been. Again, we'll
-    # get a stale checksum and a rebuild, which shouldn't much hurt us.
-    checksum_file = get_checksum_file(ws, proj)
-    with open(checksum_file, 'w') as f:
-        f.write('%s\n' % checksum)
-
-
-def invalidate_checksum(ws, proj):
-    '''Invalidates the current project checksum. This can be used to force a
-    project to rebuild, for example if one of its dependencies rebuilds.'''
-    log('invalidating checksum for %s' % proj)
+    if dry_run():
+        return
+    store = get_state(ws)
+    with store.transaction():
+        store.set_checksum(proj, get_build_type(ws), checksum)
+        store.set_cache_key(proj, _invalidation_kind(ws), None)
+
+
+def _invalidation_kind(ws):
+    '''Returns the kind of cache key under which we store why the checksum of
+    a project's build of the current type was invalidated.'''
+    return 'invalidated-%s' % get_build_type(ws)
+
+
+def invalidate_checksums(ws, projects, reason=None):
+    '''Invalidates the current checksums of the given projects in a single
+    transaction. This can be used to force projects to rebuild, for example if
+    one of their dependencies rebuilds. The reason, if given, is what the next
+    build of the projects reports as why they were built. It is only recorded
+    for projects that had a checksum, since a project that was never built
+    needs building no matter what happened to its dependencies.'''
+    for proj in projects:
+        log('invalidating checksum for %s' % proj)
     if dry_run():
         return
 
-    try:
-        remove(get_checksum_file(ws, proj))
-    except OSError as e:
-        if e.errno != errno.ENOENT:
-            raise
+    store = get_state(ws)
+    build_type = get_build_type(ws)
+    with store.transaction():
+        if reason is not None:
+            stored = store.get_checksums(build_type)
+            kind = _invalidation_kind(ws)
+            for proj in projects:
+                if proj in stored:
+                    store.set_cache_key(proj, kind, reason)
+        store.invalidate_checksums(projects, build_type)
+
+
+def invalidate_checksum(ws, proj, reason=None):
+    '''Invalidates the current project checksum.'''
+    invalidate_checksums(ws, (proj,), reason)
+
+
+def get_invalidation_reason(ws, proj):
+    '''Returns why the checksum of a project was last invalidated, or None if
+    we don't know.'''
+    return get_cache_key(ws, proj, _invalidation_kind(ws))
 
 
 def get_stored_checksum(ws, proj):
@@ -643,21 +1113,153 @@ def get_stored_checksum(ws, proj):
     if dry_run():
         return 'bogus-stored-checksum'
 
-    checksum_file = get_checksum_file(ws, proj)
-    try:
-        with open(checksum_file, 'r') as f:
-            checksum = f.read().rstrip()
-    except IOError:
+    return get_state(ws).get_checksum(proj, get_build_type(ws))
+
+
+def get_stored_checksums(ws):
+    '''Returns every stored checksum for the current build type, keyed by
+    project.'''
+    return get_state(ws).get_checksums(get_build_type(ws))
+
+
+def get_cache_key(ws, proj, kind):
+    '''Returns the stored cache key of the given kind for a project, or None if
+    there is none. Cache keys record the inputs of the last successful run of
+    some piece of work, so that it can be skipped if they haven't changed.'''
+    if dry_run():
+        return None
+    return get_state(ws).get_cache_key(proj, kind)
+
+
+def set_cache_key(ws, proj, kind, key):
+    '''Stores a cache key of the given kind for a project. A key of None
+    removes it.'''
+    if dry_run():
+        return
+    get_state(ws).set_cache_key(proj, kind, key)
+
+
+def record_timing(ws, proj, phase, start, duration, maxrss=None,
+                  reason=None):
+    '''Records how long a phase of work on a project took, and optionally the
+    most memory in bytes any one process used in it and why it ran, so we can
+    later analyze where the time goes.'''
+    if dry_run():
+        return
+    get_state(ws).add_timing(proj, phase, start, duration, maxrss, reason,
+                             get_build_type(ws))
+
+
+def record_timings(ws, timings):
+    '''Records several (project, phase, start, duration) timings in a single
+    transaction.'''
+    if dry_run():
+        return
+    store = get_state(ws)
+    build_type = get_build_type(ws)
+    with store.transaction():
+        for proj, phase, start, duration in timings:
+            store.add_timing(proj, phase, start, duration,
+                             build_type=build_type)
+
+
+def _by_build_type(ws, get):
+    '''Returns get(build_type) for the current build type of the workspace,
+    or, if that is None, get(None), which goes by every build type. A
+    project's history of its current build type is the best guide to its
+    next build, but any history beats none.'''
+    val = get(get_build_type(ws))
+    if val is None:
+        val = get(None)
+    return val
+
+
+# How many of the most recent builds of a project we look at to predict how
+# much memory and time it needs.
+_RECENT_BUILDS = 5
+def get_peak_memory(ws, proj):  # noqa: E302
+    '''Returns the most memory in bytes that any one process used in the
+    recent builds of a project, or None if we don't know.'''
+    if dry_run():
+        return None
+    store = get_state(ws)
+    return _by_build_type(ws, lambda build_type: store.get_peak_memory(
+        proj, 'build', _RECENT_BUILDS, build_type))
+
+
+def get_recent_duration(ws, proj, phase):
+    '''Returns the longest a phase of a project took in its recent runs, or
+    None if we don't know.'''
+    if dry_run():
         return None
+    store = get_state(ws)
+    return _by_build_type(ws, lambda build_type: store.get_longest_duration(
+        proj, phase, _RECENT_BUILDS, build_type))
 
-    # Note that we don't need to check if the checksum is corrupt. If it is, it
-    # will not match the calculated checksum, so we will correctly see a stale
-    # checksum.
 
-    return checksum
+def get_latest_durations(ws, phase):
+    '''Returns a dictionary mapping each project to how long the given phase
+    took the last time it ran, for the projects for which it ever did. This
+    goes by the current build type where possible.'''
+    if dry_run():
+        return {}
+    store = get_state(ws)
+    durations = {}
+    for build_type in (None, get_build_type(ws)):
+        for proj, p, duration in store.get_latest_timings(build_type):
+            if p == phase:
+                durations[proj] = duration
+    return durations
+
+
+def get_build_estimate(ws, proj):
+    '''Returns roughly how many seconds building a project takes, or None if
+    we don't know. This is the longest of its recent builds of the current
+    build type. For projects we never timed such a build of but which were
+    built with ninja by hand (see wst.ninja), it is how long running every
+    edge of the build once took, which overestimates a parallel build but
+    still ranks it sensibly against other projects. Failing both, it goes by
+    the builds of other types.'''
+    if dry_run():
+        return None
+    store = get_state(ws)
+    build_type = get_build_type(ws)
+    duration = store.get_longest_duration(proj, 'build', _RECENT_BUILDS,
+                                          build_type)
+    if duration is not None:
+        return duration
+    total = store.get_ninja_total(proj, build_type)
+    if total is not None:
+        return total / 1000
+    return store.get_longest_duration(proj, 'build', _RECENT_BUILDS)
+
+
+def get_test_durations(ws, proj):
+    '''Returns how long each individual test of a project took the last time
+    it ran, as a dictionary keyed by test name.'''
+    if dry_run():
+        return {}
+    return get_state(ws).get_test_durations(proj)
+
+
+def record_test_cases(ws, proj, cases):
+    '''Records the results of individual tests of a project, given as
+    dictionaries with name, status and duration keys.'''
+    if dry_run():
+        return
+    get_state(ws).set_test_cases(
+        proj,
+        [(c['name'], c['status'], c['duration']) for c in cases])
 
 
 def calculate_checksum(source_dir):
+    '''Calculates and returns the SHA-1 checksum of a given git directory. See
+    _calculate_checksum for the details.'''
+    with span('checksum', 'checksum', path=source_dir):
+        return _calculate_checksum(source_dir)
+
+
+def _calculate_checksum(source_dir):
     '''Calculates and returns the SHA-1 checksum of a given git directory,
     including submodules and dirty files. This function should uniquely
     identify any source code that would impact the build. Note that we ignore
@@ -681,6 +1283,10 @@ def calculate_checksum(source_dir):
     # Additionally note the use of "submodule foreach --recursive", which will
     # recursively diff all submodules, submodules-inside-submodules, etc. This
     # ensures correctness even if deeply nested submodules change.
+    #
+    # wst.shell pulls in subprocess, which commands like ws list don't need, so
+    # import it here.
+    from wst.shell import call_git
     head = call_git(source_dir, ('rev-parse', '--verify', 'HEAD'))
     repo_diff = call_git(source_dir,
                          ('diff',
@@ -702,6 +1308,7 @@ def calculate_checksum(source_dir):
         return 'bogus-calculated-checksum'
 
     # Finally, combine all data into one master hash.
+    import hashlib
     total = hashlib.sha1()
     total.update(head)
     total.update(repo_diff)
@@ -710,13 +1317,26 @@ def calculate_checksum(source_dir):
     return total.hexdigest()
 
 
+def calculate_checksums(source_dirs):
+    '''Calculates the checksums of the given source directories in parallel,
+    returning them in the same order. The work happens in git, so threads are
+    enough to keep every core busy.'''
+    if len(source_dirs) == 0:
+        return []
+    import concurrent.futures
+    workers = min(len(source_dirs), os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(calculate_checksum, source_dirs))
+
+
 # These hooks contain functions to handle the build tasks for each build system
 # we support. To add a new build system, add a new entry and supply the correct
-# hooks.
+# hooks. Each entry gives the module and class name of the builder, which is
+# imported the first time a project needs it.
 _BUILD_TOOLS = {
-    'meson': MesonBuilder,
-    'cmake': CMakeBuilder,
-    'setuptools': SetuptoolsBuilder
+    'meson': ('wst.builder.meson', 'MesonBuilder'),
+    'cmake': ('wst.builder.cmake', 'CMakeBuilder'),
+    'setuptools': ('wst.builder.setuptools', 'SetuptoolsBuilder')
 }
 
 
@@ -725,12 +1345,12 @@ def get_builder(d, proj):
     be used instead of directly referencing _BUILD_TOOLS.'''
     build = d[proj]['build']
     try:
-        builder = _BUILD_TOOLS[build]
+        module, name = _BUILD_TOOLS[build]
     except KeyError:
         raise WSError('unknown build tool %s for project %s'
                       % (build, proj))
 
-    return builder
+    return getattr(importlib.import_module(module), name)
 
 
 def merge_var(env, var, val):
@@ -816,12 +1436,26 @@ def _merge_build_env(ws, d, proj, env):
         merge_var(env, var, [val])
 
 
-def get_build_env(ws, d, proj):
+# Build environments, keyed by workspace and project. Composing one means
+# merging in every dependency and, for some builders, running external tools,
+# so commands working on many projects would otherwise redo much of the same
+# work.
+_BUILD_ENVS = {}
+def get_build_env(ws, d, proj):  # noqa: E302
     '''Gets the environment that should be set during builds (and for the env
-    command) for a given project.'''
-    build_env = os.environ.copy()
-    deps = dependency_closure(d, [proj])
-    for dep in deps:
-        _merge_build_env(ws, d, dep, build_env)
+    command) for a given project. The caller may modify the returned
+    dictionary.'''
+    key = (os.path.realpath(ws), get_build_type(ws), proj)
+    try:
+        return dict(_BUILD_ENVS[key])
+    except KeyError:
+        pass
+
+    with span('compose-env', project=proj):
+        build_env = os.environ.copy()
+        deps = dependency_closure(d, [proj])
+        for dep in deps:
+            _merge_build_env(ws, d, dep, build_env)
 
-    return build_env
+    _BUILD_ENVS[key] = build_env
+    return dict(build_env)
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+#
+# A per-root background server that keeps ws state warm.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# The daemon holds the parsed manifest, the workspace config and the checksums
+# of every source tree in memory, and uses inotify to notice when any of them
+# go stale. bin/ws forwards each command to it over a unix socket inside the
+# root. Commands that can be answered from the warm state implement
+# Command.serve; everything else is handed back to the client, which then runs
+# the command as usual. A client that cannot reach the daemon for any reason
+# simply runs the command itself, so the daemon is never required for
+# correctness.
+#
+# This module holds the client side, which bin/ws loads on every command while
+# a daemon is running, so it should stay cheap to import. The server lives in
+# wst.server.
+
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+from wst import (
+    WSError,
+    log
+)
+from wst.conf import (
+    get_daemon_log,
+    get_daemon_socket
+)
+
+
+# How long the daemon waits without receiving a request before exiting.
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# How long a client waits for the daemon to answer before giving up and running
+# the command itself.
+CLIENT_TIMEOUT = 30
+
+# How long "ws daemon start" waits for a new daemon to come up.
+_START_TIMEOUT = 60
+
+# The longest path the kernel accepts for a unix socket address.
+_MAX_SOCKET_PATH = 107
+
+
+def sock_op(sock, op, path):
+    '''Binds or connects the given socket to the given path. Since unix socket
+    paths are limited in length and .ws directories can be deeply nested, this
+    temporarily changes into the socket's directory if needed.'''
+    if len(os.fsencode(path)) <= _MAX_SOCKET_PATH:
+        getattr(sock, op)(path)
+        return
+
+    cwd = os.open('.', os.O_RDONLY)
+    try:
+        os.chdir(os.path.dirname(path))
+        getattr(sock, op)(os.path.basename(path))
+    finally:
+        os.fchdir(cwd)
+        os.close(cwd)
+
+
+def recv_all(sock):
+    '''Reads from the socket until the peer shuts down its end.'''
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def request(root, msg, timeout=CLIENT_TIMEOUT):
+    '''Sends a request to the daemon for the given root, returning the decoded
+    response, or None if the daemon isn't running or didn't answer.'''
+    path = get_daemon_socket(root)
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock_op(sock, 'connect', path)
+        sock.sendall(json.dumps(msg).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = recv_all(sock)
+    except (OSError, socket.timeout) as e:
+        log('cannot talk to ws daemon at %s: %s' % (path, e))
+        return None
+    finally:
+        sock.close()
+
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        log('garbled response from ws daemon at %s' % path)
+        return None
+
+
+def forward(root, ws, module, cmd, args, level):
+    '''Asks the daemon to run the given command. Returns the exit status if the
+    daemon ran it, or None if the caller should run it itself.'''
+    # Only plain values make it across; everything the commands read from args
+    # is one of these.
+    plain = (str, int, float, bool, list, type(None))
+    fields = dict((k, v) for k, v in vars(args).items()
+                  if isinstance(v, plain))
+    response = request(root, {
+        'op': 'run',
+        'ws': ws,
+        'module': module,
+        'cmd': cmd,
+        'args': fields,
+        'level': level
+    })
+    if response is None or response['status'] is None:
+        return None
+
+    sys.stdout.write(response['stdout'])
+    sys.stdout.flush()
+    sys.stderr.write(response['log'])
+    return response['status']
+
+
+def ping(root):
+    '''Returns status information about the running daemon, or None if there
+    isn't one.'''
+    return request(root, {'op': 'ping'}, timeout=5)
+
+
+def start(root, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    '''Starts a daemon for the given root in the background, returning once it
+    is ready to serve requests.'''
+    if ping(root) is not None:
+        raise WSError('ws daemon is already running')
+
+    # Clean up after a daemon that died without removing its socket.
+    path = get_daemon_socket(root)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            # Double-fork so the daemon is fully detached from the terminal
+            # and reparented to init.
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            os.chdir('/')
+            null = os.open(os.devnull, os.O_RDWR)
+            os.dup2(null, 0)
+            os.dup2(null, 1)
+            err = os.open(get_daemon_log(root),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                          0o600)
+            os.dup2(err, 2)
+
+            from wst.server import serve
+            serve(root, idle_timeout)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    os.waitpid(pid, 0)
+    deadline = time.monotonic() + _START_TIMEOUT
+    while time.monotonic() < deadline:
+        if ping(root) is not None:
+            return
+        time.sleep(0.05)
+    raise WSError('ws daemon failed to start; see %s' % get_daemon_log(root))
+
+
+def stop(root):
+    '''Stops the daemon for the given root. Returns False if it wasn't
+    running.'''
+    return request(root, {'op': 'stop'}, timeout=5) is not None
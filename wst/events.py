@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# A log of every external command ws runs.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# When the WSEVENTLOG environment variable is set to a non-empty value other
+# than 0, every command ws runs through wst.shell is recorded in events.jsonl
+# inside the workspace, one JSON object per line, with what it was run for
+# (see wst.trace.current_context), when it ran, how it exited and the resources
+# it used, as reported by wait4(). The log is meant for offline analysis, like
+# tuning parallelism or explaining why builds got slower. It is rotated when ws
+# starts, so it never grows much past _MAX_SIZE, and the _KEEP most recent
+# rotated logs are kept.
+#
+# Independently of the log, code can find out what the commands it runs cost by
+# running them inside a track_usage() block.
+
+import contextlib
+import os
+import threading
+
+from wst import log
+from wst.trace import current_context
+
+
+_ENV_VAR = 'WSEVENTLOG'
+_MAX_SIZE = 16 * 1024 * 1024
+_KEEP = 4
+
+_LOCK = threading.Lock()
+
+
+def get_event_log(ws):
+    '''Returns the event log of the given workspace.'''
+    return os.path.join(ws, 'events.jsonl')
+
+
+def _enabled():
+    '''Returns True if the user asked for the event log.'''
+    return os.environ.get(_ENV_VAR, '') not in ('', '0')
+
+
+def _rotate(path):
+    '''Moves the log aside if it has grown too big, dropping the oldest
+    rotated log.'''
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    if size < _MAX_SIZE:
+        return
+    for i in range(_KEEP - 1, 0, -1):
+        try:
+            os.rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+        except FileNotFoundError:
+            pass
+    os.rename(path, '%s.1' % path)
+
+
+_PATH = None
+def start_event_log(ws):  # noqa: E302
+    '''Starts recording commands to the event log of the given workspace, if
+    the user asked for it.'''
+    global _PATH
+    if not _enabled():
+        return
+    path = get_event_log(ws)
+    with _LOCK:
+        try:
+            _rotate(path)
+        except OSError as e:
+            # Another ws process may have just rotated it.
+            log('cannot rotate %s: %s' % (path, e))
+        _PATH = path
+
+
+def stop_event_log():
+    '''Stops recording commands.'''
+    global _PATH
+    with _LOCK:
+        _PATH = None
+
+
+class Usage(object):
+    '''The resources used by the commands run in a track_usage() block.'''
+    def __init__(self):
+        # The peak memory use, in bytes, of the biggest single process.
+        self.maxrss = 0
+        self.utime = 0.0
+        self.stime = 0.0
+
+    def add(self, rusage):
+        '''Adds in the given resource.struct_rusage.'''
+        # Linux reports this in kilobytes.
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss * 1024)
+        self.utime += rusage.ru_utime
+        self.stime += rusage.ru_stime
+
+
+_TRACKED = threading.local()
+def _tracked():  # noqa: E302
+    '''Returns the current thread's stack of active Usage objects.'''
+    try:
+        return _TRACKED.stack
+    except AttributeError:
+        _TRACKED.stack = []
+        return _TRACKED.stack
+
+
+@contextlib.contextmanager
+def track_usage():
+    '''Returns a Usage object adding up the resources used by the commands the
+    current thread runs inside the block.'''
+    usage = Usage()
+    stack = _tracked()
+    stack.append(usage)
+    try:
+        yield usage
+    finally:
+        stack.pop()
+
+
+def record_event(cmd, cwd, start, end, status, rusage):
+    '''Records a command that ran from start to end (in seconds since the
+    epoch) and exited with the given status, having used the given
+    resource.struct_rusage.'''
+    for usage in _tracked():
+        usage.add(rusage)
+
+    path = _PATH
+    if path is None:
+        return
+
+    event = current_context()
+    event.update({
+        'cmd': list(cmd),
+        'cwd': os.path.abspath(cwd if cwd is not None else os.curdir),
+        'start': start,
+        'end': end,
+        'status': status,
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        # Linux reports this in kilobytes.
+        'maxrss': rusage.ru_maxrss * 1024,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock
+    })
+    import json
+    line = json.dumps(event, sort_keys=True) + '\n'
+    with _LOCK:
+        # Other ws processes may be appending too, so write each record in one
+        # go.
+        with open(path, 'a') as f:
+            f.write(line)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+#
+# Inter-process locking for workspaces and projects.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Every command that works inside a workspace holds a shared lock on the
+# workspace for its whole duration, so that removing or renaming a workspace
+# (which take the lock exclusively) waits for everyone else to finish. Work on
+# a project takes an exclusive lock on that project, covering its build
+# directory, install tree and checksum, plus shared locks on the projects whose
+# install trees it reads. This lets ws invocations on disjoint projects run in
+# parallel while invocations on the same project wait for each other.
+#
+# Locks are flock()s on per-open-file descriptions, so separate threads
+# exclude each other just like separate processes do. A thread that already
+# holds a lock can take it again (e.g. when a build force-cleans the project it
+# is building) without deadlocking against itself. It can't go from a shared
+# lock to an exclusive one, though: flock() converts a lock by dropping it and
+# then taking the new one, which would let another process in between, so
+# callers must take the strongest lock they need up front.
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import threading
+
+from wst import (
+    WSError,
+    log
+)
+from wst.conf import (
+    get_lock_dir,
+    get_proj_lock,
+    get_ws_lock
+)
+
+
+_HELD = threading.local()
+
+
+class _Held(object):
+    '''A lock held by the current thread.'''
+    def __init__(self, fd, exclusive):
+        self.fd = fd
+        self.exclusive = exclusive
+        self.count = 1
+
+
+def _held():
+    '''Returns the map of lock paths held by the current thread.'''
+    try:
+        return _HELD.locks
+    except AttributeError:
+        _HELD.locks = {}
+        return _HELD.locks
+
+
+def _flock(fd, exclusive, desc):
+    '''Takes a lock on the given file, waiting for it if needed.'''
+    op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(fd, op | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        log('waiting for another ws process to finish with %s' % desc,
+            logging.WARNING)
+        fcntl.flock(fd, op)
+
+
+def _acquire(path, exclusive, desc):
+    '''Acquires the lock at the given path.'''
+    held = _held()
+    try:
+        lock = held[path]
+    except KeyError:
+        pass
+    else:
+        if exclusive and not lock.exclusive:
+            raise WSError("can't lock %s exclusively while holding it shared"
+                          % desc)
+        lock.count += 1
+        return
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        _flock(fd, exclusive, desc)
+    except BaseException:
+        os.close(fd)
+        raise
+    held[path] = _Held(fd, exclusive)
+
+
+def _release(path):
+    '''Releases the lock at the given path.'''
+    held = _held()
+    lock = held[path]
+    lock.count -= 1
+    if lock.count == 0:
+        del held[path]
+        # Closing the file drops the lock.
+        os.close(lock.fd)
+
+
+@contextlib.contextmanager
+def lock_workspace(ws, exclusive=False):
+    '''Holds the lock on a workspace for the duration of the block.'''
+    path = get_ws_lock(ws)
+    _acquire(path, exclusive, 'workspace %s' % ws)
+    try:
+        yield
+    finally:
+        _release(path)
+
+
+@contextlib.contextmanager
+def lock_projects(ws, exclusive=(), shared=()):
+    '''Holds exclusive locks on one set of projects and shared locks on
+    another for the duration of the block.'''
+    modes = dict((proj, False) for proj in shared)
+    for proj in exclusive:
+        modes[proj] = True
+
+    lock_dir = get_lock_dir(ws)
+    try:
+        os.mkdir(lock_dir)
+    except FileExistsError:
+        pass
+
+    # Always lock in the same order so that two processes wanting overlapping
+    # sets of projects can't deadlock.
+    acquired = []
+    try:
+        for proj in sorted(modes):
+            path = get_proj_lock(ws, proj)
+            _acquire(path, modes[proj], 'project %s' % proj)
+            acquired.append(path)
+        yield
+    finally:
+        for path in reversed(acquired):
+            _release(path)
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+#
+# Metrics export for Prometheus.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# When the WSMETRICS environment variable names a file, ws build and ws test
+# rewrite it after every run with metrics in the Prometheus text exposition
+# format, meant for the textfile collector of the Prometheus node exporter.
+# Everything but the outcome of the run itself comes from the history kept in
+# the state of the workspaces involved, so the file is complete no matter
+# which command wrote it last: counters add up everything ever recorded, and
+# gauges give the latest values. The file is replaced atomically so the
+# collector never reads half of it.
+
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from wst import (
+    dry_run,
+    log
+)
+from wst.conf import (
+    get_cache_key,
+    get_state,
+    get_ws_dir
+)
+
+
+_ENV_VAR = 'WSMETRICS'
+
+# The metrics we export, as name -> (type, help).
+_METRICS = {
+    'ws_last_run_success': (
+        'gauge', 'Whether the last run of a ws command succeeded.'),
+    'ws_last_run_duration_seconds': (
+        'gauge', 'How long the last run of a ws command took.'),
+    'ws_last_run_timestamp_seconds': (
+        'gauge', 'When the last run of a ws command finished.'),
+    'ws_build_duration_seconds': (
+        'gauge', 'How long the latest build of a project took.'),
+    'ws_builds_total': (
+        'counter', 'How many times a project was built.'),
+    'ws_build_seconds_total': (
+        'counter', 'How long all builds of a project took.'),
+    'ws_build_rebuilds_total': (
+        'counter', 'How many times a project was built, by reason.'),
+    'ws_build_cache_hits_total': (
+        'counter', 'How many times a project was found to be up to date.'),
+    'ws_noop_seconds_total': (
+        'counter', 'How long checking up-to-date projects took.'),
+    'ws_checksum_seconds_total': (
+        'counter', 'How long calculating source checksums took.'),
+    'ws_test_duration_seconds': (
+        'gauge', 'How long the latest test run of a project took.'),
+    'ws_test_passed': (
+        'gauge', 'Whether the latest test run of a project passed.'),
+    'ws_test_cases': (
+        'gauge', 'How many individual tests of a project had each status.'),
+    'ws_tests_total': (
+        'counter', 'How many times the tests of a project were run.'),
+    'ws_test_cache_hits_total': (
+        'counter', 'How many times test results of a project were reused.'),
+}
+
+
+# A sample of one of the ws_last_run_* metrics in a file we wrote, such as:
+#   ws_last_run_success{command="build"} 1.0
+_LAST_RUN_RE = re.compile(
+    r'^(ws_last_run_[a-z_]+)\{command="([^"\\]*)"\} (\S+)$')
+
+
+def get_metrics_path():
+    '''Returns the file the user asked for metrics to be written to, or None
+    if they didn't.'''
+    path = os.environ.get(_ENV_VAR, '')
+    return path if path != '' else None
+
+
+def _escape(val):
+    '''Escapes a label value.'''
+    return (str(val).replace('\\', '\\\\')
+                    .replace('"', '\\"')
+                    .replace('\n', '\\n'))
+
+
+def _workspace_samples(samples, name, ws):
+    '''Adds the samples from the history of the given workspace.'''
+    store = get_state(ws)
+
+    def add(metric, value, **labels):
+        '''Adds a sample for the workspace.'''
+        labels['workspace'] = name
+        samples.setdefault(metric, []).append((labels, value))
+
+    # Counters, summed over every recorded timing.
+    counts = {}
+    totals = {}
+    for proj, phase, reason, count, total in store.get_timing_totals():
+        key = (proj, phase)
+        counts[key] = counts.get(key, 0) + count
+        totals[key] = totals.get(key, 0) + total
+        if phase == 'build' and reason is not None:
+            add('ws_build_rebuilds_total', count, project=proj, reason=reason)
+    for (proj, phase), count in sorted(counts.items()):
+        if phase == 'build':
+            add('ws_builds_total', count, project=proj)
+            add('ws_build_seconds_total', totals[(proj, phase)], project=proj)
+        elif phase == 'noop':
+            add('ws_build_cache_hits_total', count, project=proj)
+        elif phase == 'test':
+            add('ws_tests_total', count, project=proj)
+        elif phase == 'test-cached':
+            add('ws_test_cache_hits_total', count, project=proj)
+    for phase, metric in (('noop', 'ws_noop_seconds_total'),
+                          ('checksum', 'ws_checksum_seconds_total')):
+        add(metric, sum(total for (_, p), total in totals.items()
+                        if p == phase))
+
+    # Gauges, from the latest timings.
+    for proj, phase, duration in sorted(store.get_latest_timings()):
+        if phase == 'build':
+            add('ws_build_duration_seconds', duration, project=proj)
+        elif phase == 'test':
+            add('ws_test_duration_seconds', duration, project=proj)
+            # Test cache keys are only kept while the tests pass.
+            passed = get_cache_key(ws, proj, 'test') is not None
+            add('ws_test_passed', int(passed), project=proj)
+    for proj, status, count in sorted(store.get_test_case_counts()):
+        add('ws_test_cases', count, project=proj, status=status)
+
+
+def format_metrics(samples):
+    '''Formats the given samples, a dictionary mapping each metric name to a
+    list of (labels, value) pairs, in the text exposition format.'''
+    lines = []
+    for metric, (kind, help_text) in _METRICS.items():
+        try:
+            metric_samples = samples[metric]
+        except KeyError:
+            continue
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for labels, value in metric_samples:
+            label_str = ','.join('%s="%s"' % (k, _escape(v))
+                                 for k, v in sorted(labels.items()))
+            lines.append('%s{%s} %s' % (metric, label_str, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(path, data):
+    '''Replaces the given file with the given contents, such that readers see
+    either the old or the new contents in full.'''
+    parent = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=parent,
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        # mkstemp creates files only we can read, but the collector may run
+        # as someone else.
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _other_last_runs(path, command):
+    '''Returns the ws_last_run_* samples of commands other than the given one
+    in the metrics file we wrote before, if any, as a dictionary like the one
+    format_metrics takes.'''
+    samples = {}
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return samples
+    for line in lines:
+        m = _LAST_RUN_RE.match(line)
+        if m is None or m.group(2) == command or m.group(1) not in _METRICS:
+            continue
+        try:
+            value = float(m.group(3))
+        except ValueError:
+            continue
+        samples.setdefault(m.group(1), []).append(
+            ({'command': m.group(2)}, value))
+    return samples
+
+
+def write_metrics(root, names, command, ok, duration):
+    '''Writes metrics for the given workspaces of a root, after a run of the
+    given command that took the given time, if the user asked for them. Errors
+    are logged rather than failing the command.'''
+    path = get_metrics_path()
+    if path is None or dry_run():
+        return
+
+    labels = {'command': command}
+    try:
+        # Each run only knows about its own command, so carry over what the
+        # other commands last reported, or their series would disappear.
+        samples = _other_last_runs(path, command)
+        for metric, value in (
+                ('ws_last_run_success', int(ok)),
+                ('ws_last_run_duration_seconds', duration),
+                ('ws_last_run_timestamp_seconds', time.time())):
+            samples.setdefault(metric, []).append((labels, value))
+            samples[metric].sort(key=lambda sample: sample[0]['command'])
+        # The names may be paths, such as that of the default workspace link.
+        for ws in sorted(set(os.path.realpath(get_ws_dir(root, name))
+                             for name in names)):
+            _workspace_samples(samples, os.path.basename(ws), ws)
+        _write_atomically(path, format_metrics(samples))
+    except (OSError, sqlite3.Error) as e:
+        log('cannot write metrics to %s: %s' % (path, e), logging.WARNING)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+# Reading of ninja build logs.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# ninja appends a line to .ninja_log in the build directory for every edge it
+# runs, giving the edge's start and end time in milliseconds since that ninja
+# run started, the mtime of the output, the output itself and a hash of the
+# command. Both CMake and Meson projects build with ninja, so these logs say
+# where the time inside each build goes. The logs only grow between cleans, so
+# we remember how far we have read each one and only parse what's new, storing
+# the entries in the workspace state. ws build does this after each build, and
+# ws ninja-report before reporting.
+
+import os
+import time
+
+from wst import dry_run
+from wst.conf import (
+    get_build_dir,
+    get_build_type,
+    get_state
+)
+
+
+NINJA_LOG = '.ninja_log'
+
+# Output suffixes of compile edges.
+_COMPILE_SUFFIXES = ('.o', '.obj')
+
+# Output suffixes of link edges, apart from executables, which usually have no
+# suffix at all.
+_LINK_SUFFIXES = ('.a', '.so', '.dll', '.dylib', '.lib', '.exe')
+
+
+def edge_kind(target):
+    '''Guesses whether the edge producing the given target is a compile, a link
+    or something else, from the target's name.'''
+    name = os.path.basename(target)
+    if name.endswith(_COMPILE_SUFFIXES):
+        return 'compile'
+    if name.endswith(_LINK_SUFFIXES) or '.so.' in name or '.' not in name:
+        return 'link'
+    return 'other'
+
+
+def parse_ninja_log(data):
+    '''Parses the given complete lines of a .ninja_log, returning a list of
+    (target, start_ms, end_ms, mtime, hash) tuples. Comments, including the
+    version header, and lines in formats we don't know are skipped.'''
+    entries = []
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+        try:
+            start = int(fields[0])
+            end = int(fields[1])
+        except ValueError:
+            continue
+        entries.append((fields[3], start, end, fields[2], fields[4]))
+    return entries
+
+
+def update_ninja_log(ws, proj, build_type=None):
+    '''Records the entries added to the .ninja_log of a project's build of the
+    given type (the current one by default) since we last looked, returning
+    how many there were.'''
+    if dry_run():
+        return 0
+    if build_type is None:
+        build_type = get_build_type(ws)
+    path = os.path.join(get_build_dir(ws, proj, build_type), NINJA_LOG)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return 0
+
+    store = get_state(ws)
+    offset = 0
+    position = store.get_ninja_log_position(proj, build_type)
+    if position is not None:
+        inode, offset = position
+        if inode != st.st_ino or offset > st.st_size:
+            # ninja rewrote the log, or the build tree was recreated.
+            offset = 0
+    if offset == st.st_size:
+        return 0
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    # ninja may be in the middle of writing a line, so leave any partial line
+    # for next time.
+    end = data.rfind(b'\n') + 1
+    entries = parse_ninja_log(data[:end])
+    store.add_ninja_edges(proj,
+                          build_type,
+                          time.time(),
+                          entries,
+                          st.st_ino,
+                          offset + end)
+    return len(entries)
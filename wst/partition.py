@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+#
+# Splitting a build into shards that can run on different machines.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# A CI system with several machines can split building a workspace between
+# them. "ws plan --partition N" divides the projects into N shards of roughly
+# equal work, based on how long each project took to build before, and "ws
+# build --shard i/N" builds the i-th shard. A shard can depend on projects in
+# other shards, which must finish first and hand their install trees over as
+# bundles (see wst.bundle). Only the first shard is ever needed by the others,
+# so the machines can always make progress.
+
+import json
+import logging
+
+from wst import (
+    WSError,
+    log
+)
+from wst.conf import (
+    dependency_closure,
+    get_build_estimate
+)
+
+
+def parse_shard(val):
+    '''Parses a shard given as "i/N", returning (i, N). Shards are numbered
+    from 1. Raises ValueError if the shard is malformed.'''
+    try:
+        i, n = val.split('/')
+        i = int(i)
+        n = int(n)
+    except ValueError:
+        raise ValueError('%s is not of the form i/N' % val)
+    if n < 1:
+        raise ValueError('the number of shards must be at least 1')
+    if i < 1 or i > n:
+        raise ValueError('shard %d is not between 1 and %d' % (i, n))
+    return i, n
+
+
+def get_costs(estimates):
+    '''Returns how long building each project should take given estimates that
+    may be None for projects without history, which are assumed to take as long
+    as the average project with a nonzero estimate. Without any estimates,
+    every project counts the same.'''
+    known = [e for e in estimates.values() if e]
+    default = sum(known) / len(known) if len(known) > 0 else 1
+    return dict((proj, default if e is None else e)
+                for proj, e in estimates.items())
+
+
+def _groups(d, projects):
+    '''Splits the given projects, in build order, into groups that don't
+    depend on each other, directly or through other given projects. Each group
+    is in build order too.'''
+    parent = dict((proj, proj) for proj in projects)
+
+    def find(proj):
+        '''Returns the project standing for the group of a project.'''
+        while parent[proj] != proj:
+            parent[proj] = parent[parent[proj]]
+            proj = parent[proj]
+        return proj
+
+    for proj in projects:
+        for dep in d[proj]['deps']:
+            if dep in parent:
+                parent[find(proj)] = find(dep)
+    groups = {}
+    for proj in projects:
+        groups.setdefault(find(proj), []).append(proj)
+    return list(groups.values())
+
+
+def _makespan(d, shards, costs):
+    '''Returns how long building the given shards takes if each one is built
+    on its own machine once every shard it depends on is done.'''
+    where = {}
+    for k, shard in enumerate(shards):
+        for proj in shard:
+            where[proj] = k
+    finish = {}
+
+    def get_finish(k):
+        '''Returns when the given shard is done.'''
+        try:
+            return finish[k]
+        except KeyError:
+            pass
+        needs = set(where[dep]
+                    for proj in shards[k] for dep in d[proj]['deps'])
+        needs.discard(k)
+        start = max((get_finish(j) for j in needs), default=0)
+        finish[k] = start + sum(costs[proj] for proj in shards[k])
+        return finish[k]
+
+    return max(get_finish(k) for k in range(len(shards)))
+
+
+def _pack(d, order, costs, n, base, share):
+    '''Puts the given base projects in the first shard and spreads the groups
+    of the other projects (see _groups) over the shards, biggest first, each
+    going wherever it should finish soonest. Unless share is True, the first
+    shard holds only the base, so that the shards waiting for it can start
+    sooner.'''
+    rest = [proj for proj in order if proj not in base]
+    groups = _groups(d, rest)
+    weights = [sum(costs[proj] for proj in group) for group in groups]
+
+    base_load = sum(costs[proj] for proj in base)
+    loads = [base_load] + [0] * (n - 1)
+    where = dict((proj, 0) for proj in base)
+    if share or base_load == 0 or n == 1:
+        allowed = range(n)
+    else:
+        allowed = range(1, n)
+    for i in sorted(range(len(groups)), key=lambda i: (-weights[i], i)):
+        def finish(k):
+            '''Returns roughly when shard k would be done with the group.'''
+            if k == 0:
+                return loads[0] + weights[i]
+            return base_load + loads[k] + weights[i]
+        k = min(allowed, key=lambda k: (finish(k), k))
+        loads[k] += weights[i]
+        for proj in groups[i]:
+            where[proj] = k
+
+    shards = [[] for _ in range(n)]
+    for proj in order:
+        shards[where[proj]].append(proj)
+    return shards
+
+
+def partition(d, order, costs, n):
+    '''Splits the projects in the given build order into n lists of projects,
+    each in build order, such that building them on n machines takes as little
+    time as we can manage. Since a shard can only start once the shards it
+    depends on are done, the first shard gets a base of projects that much of
+    the rest depends on, and the remaining groups of projects that don't depend
+    on each other are spread over the shards. The base starts out empty and
+    grows by the projects at the bottom of each group too big for one shard,
+    and we keep whichever base works out best.'''
+    # Groups bigger than this can't be spread well.
+    cap = sum(costs[proj] for proj in order) / n
+    base = set()
+    best = None
+    while True:
+        for share in (True, False):
+            shards = _pack(d, order, costs, n, base, share)
+            makespan = _makespan(d, shards, costs)
+            if best is None or makespan < best[0]:
+                best = (makespan, shards)
+
+        rest = [proj for proj in order if proj not in base]
+        bottom = []
+        for group in _groups(d, rest):
+            if sum(costs[proj] for proj in group) > cap:
+                bottom.extend(proj for proj in group
+                              if all(dep in base for dep in d[proj]['deps']))
+        if len(bottom) == 0:
+            break
+        base.update(bottom)
+    return best[1]
+
+
+def partition_projects(ws, d, projects, n):
+    '''Partitions the given projects and everything they depend on into n
+    shards, using the build history of the given workspace. Returns the
+    partition as a dictionary, which is what "ws plan --partition" writes
+    out. Without any build history, every project counts the same, and the
+    shards have no estimate.'''
+    order = dependency_closure(d, projects)
+    estimates = dict((proj, get_build_estimate(ws, proj)) for proj in order)
+    timed = any(estimates.values())
+    if not timed:
+        log('no build history to go by, so every project is assumed to take '
+            'as long to build; build the workspace once first for a better '
+            'partition', logging.WARNING)
+    costs = get_costs(estimates)
+    shards = partition(d, order, costs, n)
+
+    where = {}
+    for k, shard in enumerate(shards):
+        for proj in shard:
+            where[proj] = k
+    result = []
+    for k, shard in enumerate(shards):
+        needs = set(where[proj] for proj in dependency_closure(d, shard))
+        needs.discard(k)
+        result.append({
+            'shard': k + 1,
+            'projects': shard,
+            'estimate': (sum(costs[proj] for proj in shard)
+                         if timed else None),
+            'needs': sorted(j + 1 for j in needs)
+        })
+    return {
+        'partitions': n,
+        'shards': result
+    }
+
+
+def load_partition(path, d):
+    '''Loads a partition written by "ws plan --partition", checking that it
+    matches the given manifest.'''
+    try:
+        with open(path, 'r') as f:
+            plan = json.load(f)
+    except IOError as e:
+        raise WSError('cannot read partition %s: %s' % (path, e))
+    except ValueError as e:
+        raise WSError('partition %s is not valid JSON: %s' % (path, e))
+
+    try:
+        n = plan['partitions']
+        shards = plan['shards']
+        if len(shards) != n:
+            raise WSError('partition %s has %d shards instead of %d'
+                          % (path, len(shards), n))
+        for shard in shards:
+            for proj in shard['projects']:
+                if proj not in d:
+                    raise WSError('partition %s has project %s, which is not '
+                                  'in the manifest' % (path, proj))
+    except (KeyError, TypeError):
+        raise WSError('partition %s is malformed' % path)
+    return plan
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# Profiling of ws itself.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# These back the --profile and --time-phases options of bin/ws, which measure
+# the time and memory ws itself spends on a command, as opposed to the build
+# tools it runs. Everything here is imported only when one of them is given.
+
+import sys
+import threading
+
+from wst.trace import (
+    start_phase_timing,
+    stop_phase_timing
+)
+
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# How many entries to print in profile summaries.
+_TOP = 25
+
+# How many frames of each allocation tracemalloc keeps.
+_TRACEMALLOC_FRAMES = 25
+
+
+def default_profile_path(profiler):
+    '''Returns the file to which the given profiler writes by default.'''
+    if profiler == 'cprofile':
+        return 'ws.pstats'
+    return 'ws.tracemalloc'
+
+
+class _CProfile(object):
+    '''Profiles ws with cProfile. cProfile only follows the thread that enabled
+    it before Python 3.12, so each thread started afterwards, such as the
+    scheduler's workers, gets a profiler of its own, and the results are
+    merged at the end.'''
+    def __init__(self):
+        import cProfile
+        self._new = cProfile.Profile
+        self._lock = threading.Lock()
+        self._profilers = []
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+        self._add().enable()
+
+    def _add(self):
+        '''Returns a new profiler, which is included in the results.'''
+        profiler = self._new()
+        with self._lock:
+            self._profilers.append(profiler)
+        return profiler
+
+    def _start_thread(self, *_):
+        '''Starts profiling a new thread. This is installed as the profile
+        function of new threads, and replaces itself on the first event.'''
+        sys.setprofile(None)
+        self._add().enable()
+
+    def stop(self, path):
+        '''Stops profiling, writing pstats data to the given path and a
+        summary to stderr.'''
+        import pstats
+        threading.setprofile(None)
+        with self._lock:
+            profilers = list(self._profilers)
+        for profiler in profilers:
+            profiler.create_stats()
+        stats = pstats.Stats(*profilers, stream=sys.stderr)
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(_TOP)
+        print('wrote profile to %s; view it with python3 -m pstats %s'
+              % (path, path), file=sys.stderr)
+
+
+class _Tracemalloc(object):
+    '''Traces memory allocations of every thread with tracemalloc.'''
+    def __init__(self):
+        import tracemalloc
+        self._tracemalloc = tracemalloc
+        tracemalloc.start(_TRACEMALLOC_FRAMES)
+
+    def stop(self, path):
+        '''Stops tracing, writing a snapshot of the allocations still live to
+        the given path and a summary to stderr.'''
+        tracemalloc = self._tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(path)
+        print('peak traced memory: %.1f KiB' % (peak / 1024), file=sys.stderr)
+        print('top %d allocation sites still live:' % _TOP, file=sys.stderr)
+        for stat in snapshot.statistics('lineno')[:_TOP]:
+            print(stat, file=sys.stderr)
+        print('wrote allocation snapshot to %s; load it with '
+              'tracemalloc.Snapshot.load' % path, file=sys.stderr)
+
+
+_PROFILE = None
+def start_profiling(profiler):  # noqa: E302
+    '''Starts profiling ws with the given profiler, including any threads it
+    starts later.'''
+    global _PROFILE
+    if profiler == 'cprofile':
+        _PROFILE = _CProfile()
+    else:
+        _PROFILE = _Tracemalloc()
+
+
+def stop_profiling(profiler, path=None):
+    '''Stops the profiling started by start_profiling. The profile is written
+    to the given path, or a default one in the current directory, and
+    summarized on stderr.'''
+    global _PROFILE
+    if path is None:
+        path = default_profile_path(profiler)
+    try:
+        _PROFILE.stop(path)
+    finally:
+        _PROFILE = None
+
+
+def profiling():
+    '''Returns True if ws is being profiled. Work that would otherwise run in
+    other processes should then stay in this one, where the profiler can see
+    it.'''
+    return _PROFILE is not None
+
+
+def run_timed(func):
+    '''Runs func, returning its result, and then prints on stderr how much
+    time was spent in each phase of ws (see wst.trace).'''
+    start_phase_timing()
+    try:
+        return func()
+    finally:
+        phases = stop_phase_timing()
+        print_phases(phases)
+
+
+def print_phases(phases):
+    '''Prints phase timings as returned by wst.trace.stop_phase_timing.'''
+    if len(phases) == 0:
+        return
+    width = max(len('phase'), max(len(name) for name, _, _, _ in phases))
+    print('%s  %6s  %10s  %10s' % ('phase'.ljust(width), 'count', 'wall',
+                                   'total'),
+          file=sys.stderr)
+    for name, count, total, wall in phases:
+        print('%s  %6d  %7.1f ms  %7.1f ms'
+              % (name.ljust(width), count, wall * 1000, total * 1000),
+              file=sys.stderr)
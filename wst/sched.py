@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# A job scheduler for running ws work in parallel.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Commands that work on several projects at once hand the scheduler a list of
+# jobs, each of which may depend on others, and a job budget. The scheduler
+# runs jobs on worker threads (the real work happens in subprocesses, so the
+# threads mostly wait) as soon as their dependencies have succeeded and enough
+# of the budget is free. Jobs whose dependencies failed are skipped rather than
+# run. Completion callbacks run on the calling thread, one at a time, so they
+# can print output and update state without further locking.
+#
+# Jobs can also say how much memory they are expected to need, in which case
+# the scheduler only starts them while the memory of all the running jobs
+# stays within a limit. A job that needs more than the limit on its own still
+# runs, but only once nothing else is running.
+
+import concurrent.futures
+
+from wst import log
+
+
+class Job(object):
+    '''A unit of work for the scheduler. func is called with the number of
+    slots the job was given and returns True if the job succeeded. deps are the
+    names of jobs that must succeed before this one can start. slots is the
+    most of the job budget the job can make use of; it is given as much of
+    that as is free when it starts, but at least weight slots (capped at the
+    whole budget). An exclusive job runs only when nothing else does, and gets
+    the whole budget. memory is how many bytes the job is expected to need, if
+    known.'''
+    def __init__(self,
+                 name,
+                 func,
+                 deps=(),
+                 slots=1,
+                 exclusive=False,
+                 weight=1,
+                 memory=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.slots = max(slots, weight)
+        self.exclusive = exclusive
+        self.weight = weight
+        self.memory = memory
+        # One of 'pending', 'running', 'succeeded', 'failed' or 'skipped'.
+        self.status = 'pending'
+
+
+def available_memory():
+    '''Returns how much memory in bytes the system can give to new work
+    without swapping, or None if we can't tell.'''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # This is always in kB.
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def run_jobs(jobs, max_jobs, done=None, max_memory=None):
+    '''Runs the given jobs, using at most max_jobs slots and, if given,
+    max_memory bytes of predicted memory at once. Jobs are started in the order
+    given whenever they are able to run, so callers should put the jobs they
+    want to finish first at the front. done, if given, is called with each job
+    as it finishes or is skipped. Returns True if every job succeeded.
+
+    If a job raises an exception, no further jobs are started, and the
+    exception is re-raised once the running jobs have finished.'''
+    max_jobs = max(1, max_jobs)
+    by_name = dict((job.name, job) for job in jobs)
+    pending = list(jobs)
+    running = {}
+    used = 0
+    used_memory = 0
+    error = None
+
+    def finish(job, status):
+        '''Marks the given job as finished.'''
+        job.status = status
+        if done is not None:
+            done(job)
+
+    workers = min(max_jobs, max(1, len(jobs)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            # Start everything that can run.
+            exclusive = any(job.exclusive for job, _ in running.values())
+            for job in list(pending):
+                if error is not None or exclusive:
+                    break
+                statuses = [by_name[dep].status for dep in job.deps
+                            if dep in by_name]
+                if any(s in ('failed', 'skipped') for s in statuses):
+                    pending.remove(job)
+                    log('skipping %s because a dependency failed' %
+                        (job.name,))
+                    finish(job, 'skipped')
+                    continue
+                if any(s != 'succeeded' for s in statuses):
+                    continue
+                if job.exclusive:
+                    if len(running) > 0:
+                        # Let the running jobs drain, and don't start anything
+                        # else meanwhile, so the exclusive job gets its turn.
+                        break
+                    slots = max_jobs
+                    exclusive = True
+                elif used + min(job.weight, max_jobs) > max_jobs:
+                    break
+                else:
+                    slots = min(job.slots, max_jobs - used)
+                memory = job.memory or 0
+                if (max_memory is not None and len(running) > 0 and
+                        used_memory + memory > max_memory):
+                    # Wait for enough memory to free up, without starting
+                    # anything behind this job, so it isn't starved.
+                    break
+                pending.remove(job)
+                job.status = 'running'
+                used += slots
+                used_memory += memory
+                running[pool.submit(job.func, slots)] = (job, slots)
+
+            if len(running) == 0:
+                # Either everything left is waiting on something that will
+                # never finish, or we are stopping because of an error.
+                for job in pending:
+                    finish(job, 'skipped')
+                break
+
+            finished, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                job, slots = running.pop(future)
+                used -= slots
+                used_memory -= job.memory or 0
+                try:
+                    success = future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+                    success = False
+                finish(job, 'succeeded' if success else 'failed')
+
+    if error is not None:
+        raise error
+    return all(job.status == 'succeeded' for job in jobs)
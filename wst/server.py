@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+#
+# The ws daemon server.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# See wst.daemon for an overview. This module is only imported by the daemon
+# process itself, and by commands that are asked to serve a request.
+
+import concurrent.futures
+import contextlib
+import importlib
+import io
+import json
+import logging
+import os
+import selectors
+import socket
+import time
+import traceback
+
+from wst import (
+    WSError,
+    log
+)
+from wst.conf import (
+    calculate_checksum,
+    clear_caches,
+    clear_config_cache,
+    get_daemon_socket,
+    get_manifest_files,
+    get_source_dir,
+    parse_manifest
+)
+from wst.daemon import (
+    CLIENT_TIMEOUT,
+    recv_all,
+    sock_op
+)
+from wst.watch import create_watcher
+
+
+_SERVER = None
+def cached_checksums(source_dirs):  # noqa: E302
+    '''Returns the checksums for the given source directories, reusing the
+    ones the daemon already computed for trees that haven't changed. Outside of
+    the daemon, this just calculates them.'''
+    if _SERVER is None:
+        return [calculate_checksum(source_dir) for source_dir in source_dirs]
+    return _SERVER.checksums(source_dirs)
+
+
+class _Server(object):
+    '''The daemon itself.'''
+    def __init__(self, root, idle_timeout):
+        self._root = root
+        self._idle_timeout = idle_timeout
+        self._start_time = time.time()
+        self._checksums = {}
+        self._watcher = None
+        self._watched_ws = set()
+        self._listener = None
+        self._sel = selectors.DefaultSelector()
+        self._stop = False
+
+    def _reset(self):
+        '''Drops all cached state and re-establishes the filesystem
+        watches.'''
+        clear_caches()
+        self._checksums.clear()
+        self._watched_ws.clear()
+        if self._watcher is not None:
+            self._sel.unregister(self._watcher.fileno())
+            self._watcher.close()
+
+        self._watcher = create_watcher()
+        if self._watcher is None:
+            return
+        self._sel.register(self._watcher.fileno(),
+                           selectors.EVENT_READ,
+                           'watch')
+
+        for path in get_manifest_files(self._root):
+            self._watcher.watch_file(('manifest',), path)
+            # Editors often replace files rather than rewrite them, which
+            # removes the watch on the file itself, so watch the directory
+            # too.
+            self._watcher.watch_file(('manifest',), os.path.dirname(path))
+        d = parse_manifest(self._root)
+        for proj in d:
+            source_dir = get_source_dir(self._root, d, proj)
+            self._watcher.watch_tree(('source', source_dir), source_dir)
+
+    def _refresh(self):
+        '''Processes pending filesystem events, dropping any state they made
+        stale.'''
+        if self._watcher is None:
+            # Without inotify, we can't trust anything we cached.
+            self._reset()
+            return
+
+        changed = self._watcher.read()
+        if changed is None or ('manifest',) in changed:
+            self._reset()
+            return
+
+        for key in changed:
+            if key[0] == 'source':
+                self._checksums.pop(key[1], None)
+            elif key[0] == 'config':
+                clear_config_cache(key[1])
+
+    def _watch_ws(self, ws):
+        '''Makes sure changes to the given workspace's state made by other ws
+        processes drop our cached copy of its config.'''
+        if ws is not None and ws not in self._watched_ws:
+            self._watched_ws.add(ws)
+            if self._watcher is not None:
+                self._watcher.watch_file(('config', ws), ws)
+
+    def checksums(self, source_dirs):
+        '''Returns the checksums for the given source directories, computing
+        any that aren't cached.'''
+        missing = [s for s in source_dirs if s not in self._checksums]
+        if len(missing) > 0:
+            workers = min(len(missing), os.cpu_count() or 1)
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                results = pool.map(calculate_checksum, missing)
+                for source_dir, checksum in zip(missing, results):
+                    self._checksums[source_dir] = checksum
+        return [self._checksums[s] for s in source_dirs]
+
+    def _run(self, msg):
+        '''Runs a command on behalf of a client.'''
+        module = msg['module']
+        if not module.startswith('wst.cmd.'):
+            raise WSError('refusing to load module %s' % module)
+        cls = getattr(importlib.import_module(module), msg['cmd'])
+        args = _Args(msg['args'])
+        ws = msg['ws']
+        self._watch_ws(ws)
+
+        out = io.StringIO()
+        log_out = io.StringIO()
+        handler = logging.StreamHandler(log_out)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger()
+        old_handlers = logger.handlers[:]
+        old_level = logger.level
+        logger.handlers = [handler]
+        logger.setLevel(msg['level'])
+        try:
+            with contextlib.redirect_stdout(out):
+                try:
+                    status = cls.serve(ws, args)
+                except WSError as e:
+                    log(e, logging.ERROR)
+                    status = 1
+        finally:
+            logger.handlers = old_handlers
+            logger.setLevel(old_level)
+
+        if status is None:
+            # The command needs to run in the client, which will redo whatever
+            # we did, so don't send back any output.
+            return {'status': None}
+        return {
+            'status': status,
+            'stdout': out.getvalue(),
+            'log': log_out.getvalue()
+        }
+
+    def _handle(self, msg):
+        '''Handles a single request.'''
+        op = msg.get('op')
+        if op == 'ping':
+            return {
+                'pid': os.getpid(),
+                'uptime': time.time() - self._start_time,
+                'checksums': len(self._checksums),
+                'inotify': self._watcher is not None
+            }
+        elif op == 'stop':
+            self._stop = True
+            return {'stopped': True}
+        elif op == 'run':
+            self._refresh()
+            try:
+                return self._run(msg)
+            except Exception:
+                # Anything unexpected is the daemon's problem, not the
+                # user's; let the client run the command itself.
+                traceback.print_exc()
+                clear_caches()
+                return {'status': None}
+        return {'error': 'unknown op %s' % op}
+
+    def _accept(self):
+        '''Accepts and serves one connection.'''
+        conn, _ = self._listener.accept()
+        with conn:
+            conn.settimeout(CLIENT_TIMEOUT)
+            try:
+                msg = json.loads(recv_all(conn).decode('utf-8'))
+                response = self._handle(msg)
+                conn.sendall(json.dumps(response).encode('utf-8'))
+            except (OSError, ValueError):
+                traceback.print_exc()
+
+    def run(self):
+        '''Serves requests until we are idle for too long or asked to stop.'''
+        global _SERVER
+        _SERVER = self
+        self._reset()
+
+        path = get_daemon_socket(self._root)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            sock_op(self._listener, 'bind', path)
+        finally:
+            os.umask(old_umask)
+        self._listener.listen(16)
+
+        self._sel.register(self._listener, selectors.EVENT_READ, 'accept')
+
+        deadline = time.monotonic() + self._idle_timeout
+        try:
+            while not self._stop:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not os.path.isdir(self._root):
+                    # Someone removed the root out from under us.
+                    break
+                # Handle at most one event per pass, since either kind can
+                # replace the watcher and invalidate the other's key.
+                for key, _ in self._sel.select(min(remaining, 60))[:1]:
+                    if key.data == 'accept':
+                        self._accept()
+                        deadline = time.monotonic() + self._idle_timeout
+                    else:
+                        # Drain events as they come so the kernel queue does
+                        # not overflow while we're idle.
+                        self._refresh()
+        finally:
+            self._sel.close()
+            self._listener.close()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            _SERVER = None
+
+
+class _Args(object):
+    '''Command arguments reconstituted from a client request.'''
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+def serve(root, idle_timeout):
+    '''Runs the daemon for the given root in the current process until it
+    goes idle or is stopped.'''
+    _Server(root, idle_timeout).run()
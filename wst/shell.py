@@ -26,12 +26,14 @@
 import os
 import shutil
 import subprocess
+import time
 
 
 from wst import (
     dry_run,
     log,
-    log_cmd
+    log_cmd,
+    span
 )
 
 
@@ -87,12 +89,54 @@ def get_shell():
         return '/bin/sh'
 
 
+def _cmd_span(cmd):
+    '''Returns a trace span (see wst.trace) for running the given command.'''
+    return span(os.path.basename(cmd[0]), 'cmd', cmd=' '.join(cmd))
+
+
+def _exit_status(status):
+    '''Converts a status returned by wait() into an exit status in the style
+    of subprocess, which is negative if the process was killed by a
+    signal.'''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _run(cmd, stdout=None, **kwargs):
+    '''Runs a command to completion, returning its exit status and, if stdout
+    is subprocess.PIPE, its output. Other arguments are passed on to
+    subprocess.Popen. We reap the process ourselves so that we can record the
+    resources it used in the event log (see wst.events).'''
+    start = time.time()
+    with _cmd_span(cmd):
+        p = subprocess.Popen(cmd, stdout=stdout, **kwargs)
+        try:
+            out = None
+            if stdout == subprocess.PIPE:
+                with p.stdout:
+                    out = p.stdout.read()
+            _, status, rusage = os.wait4(p.pid, 0)
+        except BaseException:
+            p.kill()
+            p.wait()
+            raise
+    # Let subprocess know that the process is gone.
+    p.returncode = _exit_status(status)
+    from wst.events import record_event
+    record_event(cmd, kwargs.get('cwd'), start, time.time(), p.returncode,
+                 rusage)
+    return p.returncode, out
+
+
 def call(cmd, **kwargs):
     '''Calls a given command with the given environment, swallowing the
     output.'''
     log_cmd(cmd)
     if not dry_run():
-        subprocess.check_call(cmd, **kwargs)
+        returncode, _ = _run(cmd, **kwargs)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
 
 
 def call_output(cmd, env=None, text=True, override=False):
@@ -100,7 +144,9 @@ def call_output(cmd, env=None, text=True, override=False):
     output. Note that we assume the output is UTF-8.'''
     log_cmd(cmd)
     if (not dry_run()) or override:
-        out = subprocess.check_output(cmd, env=env)
+        returncode, out = _run(cmd, stdout=subprocess.PIPE, env=env)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, out)
         if text:
             out = out.decode('utf-8')
         return out
@@ -140,3 +186,22 @@ def call_test(cmd, **kwargs):
 def call_clean(cmd, **kwargs):
     '''Executes a clean command.'''
     return call_noexcept('clean', cmd, **kwargs)
+
+
+def call_test_output(cmd, **kwargs):
+    '''Executes a test command, capturing its output. Returns whether the
+    command succeeded and its combined stdout and stderr.'''
+    log_cmd(cmd)
+    if dry_run():
+        return True, ''
+    try:
+        returncode, out = _run(cmd,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               **kwargs)
+    except OSError as e:
+        # Most likely the command doesn't exist, which is a test failure like
+        # any other.
+        return False, '%s: %s\n' % (cmd[0], e.strerror)
+    return returncode == 0, out.decode('utf-8', 'replace')
@@ -0,0 +1,510 @@
+#!/usr/bin/python3
+#
+# Persistent workspace state, kept in an SQLite database.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Each workspace keeps all of its mutable state (the build type, per-project
+# config, checksums, timings, cache keys and test results) in a single SQLite
+# database. This lets us update just the rows that changed, batch many updates
+# into one transaction, and stay consistent even if ws is interrupted. The rest
+# of ws should go through the accessors in wst.conf rather than using this
+# module directly.
+
+import contextlib
+import json
+import sqlite3
+
+
+# Each entry upgrades the schema by one version. The index into this list is
+# the version being upgraded from, which SQLite tracks as the user_version.
+_MIGRATIONS = (
+    '''
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE projects (
+        name TEXT PRIMARY KEY,
+        enable INTEGER NOT NULL,
+        taint INTEGER NOT NULL,
+        args TEXT NOT NULL
+    );
+    CREATE TABLE checksums (
+        project TEXT PRIMARY KEY,
+        checksum TEXT NOT NULL
+    );
+    CREATE TABLE timings (
+        id INTEGER PRIMARY KEY,
+        project TEXT NOT NULL,
+        phase TEXT NOT NULL,
+        start REAL NOT NULL,
+        duration REAL NOT NULL
+    );
+    CREATE INDEX timings_project ON timings (project, phase);
+    CREATE TABLE cache_keys (
+        project TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        PRIMARY KEY (project, kind)
+    );
+    ''',
+    '''
+    CREATE TABLE test_cases (
+        project TEXT NOT NULL,
+        name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        duration REAL NOT NULL,
+        PRIMARY KEY (project, name)
+    );
+    ''',
+    # Checksums are now kept per build type, each of which has its own build
+    # tree. The old checksums describe the single build tree that older
+    # versions used, which is discarded, so don't carry them over.
+    '''
+    DROP TABLE checksums;
+    CREATE TABLE checksums (
+        project TEXT NOT NULL,
+        type TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        PRIMARY KEY (project, type)
+    );
+    ''',
+    # The peak memory use in bytes of the biggest process run during a phase,
+    # if known.
+    '''
+    ALTER TABLE timings ADD COLUMN maxrss INTEGER;
+    ''',
+    # Why a project was built, for builds.
+    '''
+    ALTER TABLE timings ADD COLUMN reason TEXT;
+    ''',
+    # The edges recorded in the .ninja_log of each build tree, and how far
+    # into each log we have read. Entries are never recorded twice, since
+    # ninja sometimes rewrites its log without the older entries of each
+    # target. batch is when the entries were read, so each batch is roughly
+    # one build.
+    '''
+    CREATE TABLE ninja_logs (
+        project TEXT NOT NULL,
+        type TEXT NOT NULL,
+        inode INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        PRIMARY KEY (project, type)
+    );
+    CREATE TABLE ninja_edges (
+        id INTEGER PRIMARY KEY,
+        project TEXT NOT NULL,
+        type TEXT NOT NULL,
+        batch REAL NOT NULL,
+        target TEXT NOT NULL,
+        start_ms INTEGER NOT NULL,
+        end_ms INTEGER NOT NULL,
+        mtime TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        UNIQUE (project, type, target, mtime, start_ms, end_ms)
+    );
+    CREATE INDEX ninja_edges_target ON ninja_edges (project, type, target);
+    ''',
+    # Only the most recent timings of each phase of each project are kept, so
+    # keep running totals of every timing ever recorded, for the counters in
+    # wst.metrics.
+    '''
+    CREATE TABLE timing_totals (
+        project TEXT NOT NULL,
+        phase TEXT NOT NULL,
+        reason TEXT,
+        count INTEGER NOT NULL,
+        total REAL NOT NULL
+    );
+    CREATE INDEX timing_totals_project ON timing_totals (project, phase);
+    INSERT INTO timing_totals (project, phase, reason, count, total)
+        SELECT project, phase, reason, COUNT(*), SUM(duration)
+        FROM timings GROUP BY project, phase, reason;
+    ''',
+    # The build type each timing was recorded for, if known, since builds of
+    # different types can take very different times.
+    '''
+    ALTER TABLE timings ADD COLUMN type TEXT;
+    ''',
+)
+
+# How many timings of each phase of each project we keep. This is far more
+# than anything looks at, but keeps the database from growing forever.
+_KEEP_TIMINGS = 100
+
+# How many runs of each ninja edge we keep. A big project has many thousands
+# of edges, so this is kept much lower than for timings.
+_KEEP_NINJA_RUNS = 20
+
+# How long to wait for another ws process to finish writing before giving up.
+_BUSY_TIMEOUT = 60
+
+
+def _type_clause(keyword, build_type):
+    '''Returns the SQL clause, starting with the given keyword, and its
+    parameters restricting timings to the given build type, or nothing if
+    build_type is None.'''
+    if build_type is None:
+        return '', ()
+    return '%s type = ?' % keyword, (build_type,)
+
+
+class StateStore(object):
+    '''The state database for a single workspace.'''
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path,
+                                     timeout=_BUSY_TIMEOUT,
+                                     isolation_level=None)
+        self._depth = 0
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks losing the last transactions on power
+        # loss, not corruption. Losing a checksum just causes a rebuild.
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._upgrade()
+
+    def close(self):
+        '''Closes the underlying database connection.'''
+        self._conn.close()
+
+    def _upgrade(self):
+        '''Brings the schema up to date.'''
+        with self.transaction():
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            for i in range(version, len(_MIGRATIONS)):
+                for statement in _MIGRATIONS[i].split(';'):
+                    if statement.strip():
+                        self._conn.execute(statement)
+            if version != len(_MIGRATIONS):
+                # PRAGMA doesn't accept bound parameters.
+                self._conn.execute('PRAGMA user_version=%d'
+                                   % len(_MIGRATIONS))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Groups all updates made inside the block into a single transaction.
+        Transactions can be nested, in which case only the outermost one
+        commits.'''
+        if self._depth == 0:
+            # Take the write lock up front so that concurrent ws processes
+            # queue up rather than failing on lock upgrade.
+            self._conn.execute('BEGIN IMMEDIATE')
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('ROLLBACK')
+            raise
+        else:
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('COMMIT')
+
+    def is_empty(self):
+        '''Returns True if no config has ever been written to the store.'''
+        row = self._conn.execute(
+            "SELECT 1 FROM meta WHERE key = 'type'").fetchone()
+        return row is None
+
+    def load_config(self):
+        '''Returns the workspace config as a dictionary.'''
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'type'").fetchone()
+        projects = {}
+        for name, enable, taint, args in self._conn.execute(
+                'SELECT name, enable, taint, args FROM projects'):
+            projects[name] = {
+                'enable': bool(enable),
+                'taint': bool(taint),
+                'args': json.loads(args)
+            }
+        return {
+            'type': None if row is None else row[0],
+            'projects': projects
+        }
+
+    def set_type(self, build_type):
+        '''Sets the workspace build type.'''
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('type', ?)",
+            (build_type,))
+
+    def set_projects(self, projects):
+        '''Inserts or replaces the config for the given projects, given as a
+        dictionary mapping project name to project config.'''
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO projects (name, enable, taint, args) '
+            'VALUES (?, ?, ?, ?)',
+            ((name, int(c['enable']), int(c['taint']), json.dumps(c['args']))
+             for name, c in projects.items()))
+
+    def add_projects(self, projects):
+        '''Adds config for the given projects, given as a dictionary mapping
+        project name to project config, unless they already exist.'''
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO projects (name, enable, taint, args) '
+            'VALUES (?, ?, ?, ?)',
+            ((name, int(c['enable']), int(c['taint']), json.dumps(c['args']))
+             for name, c in projects.items()))
+
+    def update_project(self, proj, fields):
+        '''Updates only the given config fields of an existing project. This
+        leaves alone any other fields, which another ws process may have
+        changed in the meantime.'''
+        values = {
+            'enable': lambda v: int(v),
+            'taint': lambda v: int(v),
+            'args': json.dumps
+        }
+        for field, value in fields.items():
+            # Field names come from a fixed set, so this is safe.
+            self._conn.execute(
+                'UPDATE projects SET %s = ? WHERE name = ?' % field,
+                (values[field](value), proj))
+
+    def delete_projects(self, names):
+        '''Removes all state for the given projects.'''
+        names = [(name,) for name in names]
+        with self.transaction():
+            for table, column in (('projects', 'name'),
+                                  ('checksums', 'project'),
+                                  ('timings', 'project'),
+                                  ('timing_totals', 'project'),
+                                  ('cache_keys', 'project'),
+                                  ('test_cases', 'project'),
+                                  ('ninja_logs', 'project'),
+                                  ('ninja_edges', 'project')):
+                self._conn.executemany(
+                    'DELETE FROM %s WHERE %s = ?' % (table, column), names)
+
+    def get_checksum(self, proj, build_type):
+        '''Returns the stored checksum for a project's build of the given type,
+        or None if there isn't one.'''
+        row = self._conn.execute(
+            'SELECT checksum FROM checksums WHERE project = ? AND type = ?',
+            (proj, build_type)).fetchone()
+        return None if row is None else row[0]
+
+    def get_checksums(self, build_type):
+        '''Returns a dictionary of every stored checksum for builds of the
+        given type, keyed by project.'''
+        return dict(self._conn.execute(
+            'SELECT project, checksum FROM checksums WHERE type = ?',
+            (build_type,)))
+
+    def set_checksum(self, proj, build_type, checksum):
+        '''Stores the checksum for a project's build of the given type.'''
+        self._conn.execute(
+            'INSERT OR REPLACE INTO checksums (project, type, checksum) '
+            'VALUES (?, ?, ?)',
+            (proj, build_type, checksum))
+
+    def invalidate_checksums(self, projects, build_type):
+        '''Removes the stored checksums for the given projects' builds of the
+        given type.'''
+        self._conn.executemany(
+            'DELETE FROM checksums WHERE project = ? AND type = ?',
+            ((proj, build_type) for proj in projects))
+
+    def add_timing(self, proj, phase, start, duration, maxrss=None,
+                   reason=None, build_type=None):
+        '''Records how long a phase (configure, build, etc.) of a project
+        took, and optionally the most memory any one process used in it, why
+        it ran and for which build type. Older timings of the same phase of
+        the project are dropped beyond the most recent _KEEP_TIMINGS.'''
+        with self.transaction():
+            self._conn.execute(
+                'INSERT INTO timings '
+                '(project, phase, start, duration, maxrss, reason, type) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (proj, phase, start, duration, maxrss, reason, build_type))
+            self._conn.execute(
+                'DELETE FROM timings WHERE project = ? AND phase = ? AND '
+                'id <= (SELECT id FROM timings '
+                'WHERE project = ? AND phase = ? '
+                'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (proj, phase, proj, phase, _KEEP_TIMINGS))
+            cursor = self._conn.execute(
+                'UPDATE timing_totals '
+                'SET count = count + 1, total = total + ? '
+                'WHERE project = ? AND phase = ? AND reason IS ?',
+                (duration, proj, phase, reason))
+            if cursor.rowcount == 0:
+                self._conn.execute(
+                    'INSERT INTO timing_totals '
+                    '(project, phase, reason, count, total) '
+                    'VALUES (?, ?, ?, 1, ?)',
+                    (proj, phase, reason, duration))
+
+    def get_history(self):
+        '''Returns every kept timing as a (project, phase, start, duration,
+        maxrss, reason) tuple, oldest first.'''
+        return self._conn.execute(
+            'SELECT project, phase, start, duration, maxrss, reason '
+            'FROM timings ORDER BY id').fetchall()
+
+    def get_timing_totals(self):
+        '''Returns how many timings were ever recorded and how long they took
+        in total, as (project, phase, reason, count, total) tuples.'''
+        return self._conn.execute(
+            'SELECT project, phase, reason, count, total '
+            'FROM timing_totals').fetchall()
+
+    def get_latest_timings(self, build_type=None):
+        '''Returns the most recent timing of each phase of each project, as
+        (project, phase, duration) tuples, looking only at those of the given
+        build type if one is given.'''
+        where, params = _type_clause('WHERE', build_type)
+        return self._conn.execute(
+            'SELECT project, phase, duration FROM timings WHERE id IN ('
+            'SELECT MAX(id) FROM timings %s GROUP BY project, phase)' % where,
+            params).fetchall()
+
+    def get_peak_memory(self, proj, phase, count, build_type=None):
+        '''Returns the most memory used by a phase of a project in the last
+        count times it was recorded, optionally for the given build type only,
+        or None if it never was.'''
+        where, params = _type_clause('AND', build_type)
+        row = self._conn.execute(
+            'SELECT MAX(maxrss) FROM ('
+            'SELECT maxrss FROM timings '
+            'WHERE project = ? AND phase = ? AND maxrss IS NOT NULL %s '
+            'ORDER BY id DESC LIMIT ?)' % where,
+            (proj, phase) + params + (count,)).fetchone()
+        return row[0]
+
+    def get_longest_duration(self, proj, phase, count, build_type=None):
+        '''Returns the longest a phase of a project took in the last count
+        times it was recorded, optionally for the given build type only, or
+        None if it never was.'''
+        where, params = _type_clause('AND', build_type)
+        row = self._conn.execute(
+            'SELECT MAX(duration) FROM ('
+            'SELECT duration FROM timings '
+            'WHERE project = ? AND phase = ? %s '
+            'ORDER BY id DESC LIMIT ?)' % where,
+            (proj, phase) + params + (count,)).fetchone()
+        return row[0]
+
+    def get_cache_key(self, proj, kind):
+        '''Returns the cache key of the given kind for a project, or None if
+        there isn't one.'''
+        row = self._conn.execute(
+            'SELECT key FROM cache_keys WHERE project = ? AND kind = ?',
+            (proj, kind)).fetchone()
+        return None if row is None else row[0]
+
+    def set_cache_key(self, proj, kind, key):
+        '''Sets the cache key of the given kind for a project. A key of None
+        removes it.'''
+        if key is None:
+            self._conn.execute(
+                'DELETE FROM cache_keys WHERE project = ? AND kind = ?',
+                (proj, kind))
+        else:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache_keys (project, kind, key) '
+                'VALUES (?, ?, ?)',
+                (proj, kind, key))
+
+    def get_test_case_counts(self):
+        '''Returns how many individual tests of each project had each status
+        the last time they ran, as (project, status, count) tuples.'''
+        return self._conn.execute(
+            'SELECT project, status, COUNT(*) FROM test_cases '
+            'GROUP BY project, status').fetchall()
+
+    def get_test_durations(self, proj):
+        '''Returns a dictionary mapping each individual test of a project to
+        how long it took the last time it ran.'''
+        return dict(self._conn.execute(
+            'SELECT name, duration FROM test_cases WHERE project = ?',
+            (proj,)))
+
+    def set_test_cases(self, proj, cases):
+        '''Records the latest results of individual tests of a project, given
+        as (name, status, duration) tuples.'''
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO test_cases (project, name, status, '
+            'duration) VALUES (?, ?, ?, ?)',
+            ((proj, name, status, duration)
+             for name, status, duration in cases))
+
+    def get_ninja_log_position(self, proj, build_type):
+        '''Returns the inode of the .ninja_log of a project's build of the
+        given type and how many bytes of it we have read, or None if we never
+        read it.'''
+        return self._conn.execute(
+            'SELECT inode, offset FROM ninja_logs '
+            'WHERE project = ? AND type = ?',
+            (proj, build_type)).fetchone()
+
+    def add_ninja_edges(self, proj, build_type, batch, edges, inode, offset):
+        '''Records the given (target, start_ms, end_ms, mtime, hash) entries
+        of a project's .ninja_log as one batch, along with the position up to
+        which the log has now been read. Older runs of the same targets are
+        dropped beyond the most recent _KEEP_NINJA_RUNS.'''
+        edges = list(edges)
+        with self.transaction():
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO ninja_edges (project, type, batch, '
+                'target, start_ms, end_ms, mtime, hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((proj, build_type, batch) + tuple(edge) for edge in edges))
+            targets = set(edge[0] for edge in edges)
+            self._conn.executemany(
+                'DELETE FROM ninja_edges '
+                'WHERE project = ? AND type = ? AND target = ? AND '
+                'id <= (SELECT id FROM ninja_edges '
+                'WHERE project = ? AND type = ? AND target = ? '
+                'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                ((proj, build_type, target, proj, build_type, target,
+                  _KEEP_NINJA_RUNS) for target in targets))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO ninja_logs (project, type, inode, '
+                'offset) VALUES (?, ?, ?, ?)',
+                (proj, build_type, inode, offset))
+
+    def get_ninja_edges(self, build_type):
+        '''Returns every recorded .ninja_log entry of the given build type as
+        a (project, target, batch, start_ms, end_ms, hash) tuple, oldest
+        first.'''
+        return self._conn.execute(
+            'SELECT project, target, batch, start_ms, end_ms, hash '
+            'FROM ninja_edges WHERE type = ? ORDER BY id',
+            (build_type,)).fetchall()
+
+    def get_ninja_total(self, proj, build_type):
+        '''Returns how many milliseconds it takes to run every ninja edge of
+        a project's build of the given type once, going by the latest run of
+        each, or None if none were recorded. Edges with several outputs are
+        only counted once.'''
+        row = self._conn.execute(
+            'SELECT SUM(end_ms - start_ms) FROM ('
+            'SELECT DISTINCT batch, start_ms, end_ms, hash FROM ninja_edges '
+            'WHERE id IN ('
+            'SELECT MAX(id) FROM ninja_edges WHERE project = ? AND type = ? '
+            'GROUP BY target))',
+            (proj, build_type)).fetchone()
+        return row[0]
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+#
+# Timeline tracing in the Chrome trace event format.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# While a trace is being recorded, code wraps interesting pieces of work in
+# span(), and each span becomes a "complete" event in the Chrome trace event
+# format on the row of the thread that ran it. The resulting file can be
+# loaded into chrome://tracing or https://ui.perfetto.dev to see where the time
+# went and how well the worker threads were kept busy. When no trace is being
+# recorded, span() only keeps track of which spans each thread is in, which is
+# cheap enough to leave in hot paths. That in turn lets other code, such as the
+# event log in wst.events, find out what a command is being run for.
+#
+# Separately from traces, ws --time-phases has span() collect the intervals
+# spent in each phase span by name, and summarizes them once the command is
+# done.
+
+import contextlib
+import os
+import threading
+import time
+
+
+class _Trace(object):
+    '''The events recorded so far.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        self._events = []
+        self._tids = {}
+
+    def _tid(self):
+        '''Returns a small, stable number identifying the current thread,
+        naming its row in the trace the first time the thread is seen. This
+        must be called with the lock held.'''
+        ident = threading.get_ident()
+        try:
+            return self._tids[ident]
+        except KeyError:
+            pass
+        tid = len(self._tids)
+        self._tids[ident] = tid
+        thread = threading.current_thread()
+        if thread is threading.main_thread():
+            name = 'main'
+        else:
+            name = 'worker %d' % tid
+        self._events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': self._pid,
+            'tid': tid,
+            'args': {'name': name}
+        })
+        return tid
+
+    def add(self, name, cat, start, end, args):
+        '''Records a span that started and ended at the given
+        time.perf_counter() values.'''
+        with self._lock:
+            self._events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self._start) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self._pid,
+                'tid': self._tid(),
+                'args': args
+            })
+
+    def write(self, path):
+        '''Writes the trace to the given file.'''
+        import json
+        with self._lock:
+            events = list(self._events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+            f.write('\n')
+
+
+_TRACE = None
+def start_trace():  # noqa: E302
+    '''Starts recording a trace, discarding any trace already being
+    recorded.'''
+    global _TRACE
+    _TRACE = _Trace()
+
+
+def stop_trace(path):
+    '''Stops recording the current trace and writes it to the given file.'''
+    global _TRACE
+    trace = _TRACE
+    _TRACE = None
+    if trace is not None:
+        trace.write(path)
+
+
+def tracing():
+    '''Returns True if a trace is being recorded.'''
+    return _TRACE is not None
+
+
+# While phases are being timed, the (start, end) time.perf_counter() intervals
+# spent in each span, keyed by span name, in the order the names were first
+# seen.
+_PHASES = None
+_PHASES_LOCK = threading.Lock()
+def start_phase_timing():  # noqa: E302
+    '''Starts timing the spans of every thread by name.'''
+    global _PHASES
+    _PHASES = {}
+
+
+def stop_phase_timing():
+    '''Stops timing spans, returning a list of (name, count, total, wall)
+    tuples in the order the names were first seen. total adds up the time
+    spent in every span of that name, while wall only counts time during
+    which at least one of them was running, so the two differ for spans run
+    in parallel.'''
+    global _PHASES
+    phases = _PHASES
+    _PHASES = None
+    if phases is None:
+        return []
+
+    summary = []
+    with _PHASES_LOCK:
+        items = list(phases.items())
+    for name, intervals in items:
+        total = sum(end - start for start, end in intervals)
+        wall = 0
+        covered = None
+        for start, end in sorted(intervals):
+            if covered is None or start > covered:
+                wall += end - start
+                covered = end
+            elif end > covered:
+                wall += end - covered
+                covered = end
+        summary.append((name, len(intervals), total, wall))
+    return summary
+
+
+# Categories of spans that are not phases of ws: "project" spans only name the
+# unit of work, and "cmd" spans cover the commands ws runs.
+_NOT_PHASES = ('project', 'cmd')
+
+# The spans each thread is currently in, innermost last, as (name, category,
+# arguments) tuples.
+_ACTIVE = threading.local()
+def _active():  # noqa: E302
+    '''Returns the current thread's stack of active spans.'''
+    try:
+        return _ACTIVE.stack
+    except AttributeError:
+        _ACTIVE.stack = []
+        return _ACTIVE.stack
+
+
+def current_context():
+    '''Returns what the current thread is doing, as a dictionary merging the
+    arguments of all the spans it is in (such as the project) and, as "phase",
+    the name of the innermost one. Spans of the "project" category, which only
+    name the unit of work, and "cmd" spans for the commands themselves, are
+    not phases.'''
+    context = {}
+    for name, cat, args in _active():
+        context.update(args)
+        if cat not in _NOT_PHASES:
+            context['phase'] = name
+    return context
+
+
+@contextlib.contextmanager
+def span(name, cat='ws', **args):
+    '''Records the block as a span with the given name, category and
+    arguments, if a trace is being recorded, and times it if phases are being
+    timed.'''
+    stack = _active()
+    stack.append((name, cat, args))
+    trace = _TRACE
+    phases = _PHASES
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stack.pop()
+        if trace is not None or phases is not None:
+            end = time.perf_counter()
+            if trace is not None:
+                trace.add(name, cat, start, end, args)
+            if phases is not None and cat not in _NOT_PHASES:
+                with _PHASES_LOCK:
+                    phases.setdefault(name, []).append((start, end))
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+#
+# Background deletion of large directories.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Build trees can hold millions of files, and deleting them can take minutes.
+# Rather than making the user wait, ws renames directories it wants gone into
+# a trash directory inside the root, which is instant, and starts a detached
+# reaper process that deletes them at low priority. Only one reaper runs per
+# root at a time. If a reaper dies before it finishes, the next ws invocation
+# starts a new one.
+
+import atexit
+import errno
+import fcntl
+import itertools
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from wst import (
+    dry_run,
+    log
+)
+from wst.conf import (
+    get_trash_dir,
+    get_trash_lock
+)
+
+
+# Distinguishes trash entries made by the same process in the same instant.
+_COUNTER = itertools.count()
+
+# The roots for which this process has already started a reaper.
+_REAPED_ROOTS = set()
+
+# The ioprio_set system call number on architectures we know about.
+_IOPRIO_SET = {
+    'x86_64': 251,
+    'aarch64': 30,
+    'i686': 289,
+    'armv7l': 314,
+    'ppc64le': 273
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+
+def trash(root, path):
+    '''Removes the given directory, deferring the actual deletion to the
+    background. Does nothing if the path doesn't exist.'''
+    log('removing %s' % path)
+    if dry_run():
+        return
+    if not os.path.lexists(path):
+        return
+
+    trash_dir = get_trash_dir(root)
+    os.makedirs(trash_dir, exist_ok=True)
+    name = '%s.%d.%d.%d' % (os.path.basename(path.rstrip(os.sep)),
+                            os.getpid(),
+                            time.time(),
+                            next(_COUNTER))
+    try:
+        os.rename(path, os.path.join(trash_dir, name))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The path is on another filesystem, so we can't move it into the
+        # trash cheaply.
+        log('%s is not on the same filesystem as %s; removing it now'
+            % (path, trash_dir), logging.INFO)
+        shutil.rmtree(path)
+        return
+
+    # A clean of many projects trashes many directories, so start the reaper
+    # only the first time. It keeps going until the trash is empty, but it may
+    # finish before we trash the next directory, so start it once more when we
+    # exit to pick up whatever is left; if the first one is still running, the
+    # second one exits right away.
+    if root not in _REAPED_ROOTS:
+        _REAPED_ROOTS.add(root)
+        start_reaper(root)
+        atexit.register(start_reaper, root)
+
+
+def start_reaper(root):
+    '''Starts a detached process to empty the trash of the given root, unless
+    one is already running.'''
+    # Let the reaper import wst the same way we did, even if we weren't
+    # installed.
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = os.environ.copy()
+    try:
+        env['PYTHONPATH'] = top + os.pathsep + env['PYTHONPATH']
+    except KeyError:
+        env['PYTHONPATH'] = top
+    subprocess.Popen((sys.executable, '-m', 'wst.trash', root),
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     cwd='/',
+                     env=env,
+                     start_new_session=True)
+
+
+def _lower_priority():
+    '''Makes the current process yield CPU and I/O to everything else.'''
+    os.nice(19)
+    syscall = _IOPRIO_SET.get(os.uname().machine)
+    if syscall is None:
+        return
+    import ctypes
+    import ctypes.util
+    path = ctypes.util.find_library('c')
+    if path is None:
+        return
+    libc = ctypes.CDLL(path, use_errno=True)
+    prio = _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT
+    # Failure just means we delete at normal priority.
+    libc.syscall(syscall, _IOPRIO_WHO_PROCESS, 0, prio)
+
+
+def _delete(path):
+    '''Deletes a single trash entry, spreading the work over several
+    threads.'''
+    import concurrent.futures
+
+    try:
+        children = [os.path.join(path, name) for name in os.listdir(path)]
+    except NotADirectoryError:
+        os.unlink(path)
+        return
+    except FileNotFoundError:
+        return
+
+    workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for child in children:
+            if os.path.isdir(child) and not os.path.islink(child):
+                pool.submit(shutil.rmtree, child, True)
+            else:
+                pool.submit(os.unlink, child)
+    shutil.rmtree(path, True)
+
+
+def reap(root):
+    '''Empties the trash of the given root, unless another process is already
+    doing so.'''
+    fd = os.open(get_trash_lock(root),
+                 os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+                 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                # Someone else is on it.
+                return
+            raise
+
+        _lower_priority()
+        trash_dir = get_trash_dir(root)
+        # Keep going until the trash is empty, since more may be added while
+        # we work.
+        previous = None
+        while True:
+            try:
+                names = set(os.listdir(trash_dir))
+            except FileNotFoundError:
+                break
+            if len(names) == 0 or names == previous:
+                # Either we're done, or what's left can't be deleted, in which
+                # case trying again won't help.
+                break
+            previous = names
+            for name in names:
+                _delete(os.path.join(trash_dir, name))
+    finally:
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    reap(sys.argv[1])
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+#
+# Filesystem change notification using inotify.
+#
+# Copyright (c) 2018-2019 Xevo Inc. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+from wst import log
+
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF)
+
+# struct inotify_event, minus the trailing variable-length name.
+_EVENT = struct.Struct('iIII')
+
+# Directories inside a git directory that change often but never affect a
+# checksum.
+_GIT_SKIP_DIRS = {'objects', 'logs', 'lfs'}
+
+
+_LIBC = None
+def _get_libc():  # noqa: E302
+    '''Returns libc if it supports inotify, or None otherwise.'''
+    global _LIBC
+    if _LIBC is None:
+        path = ctypes.util.find_library('c')
+        if path is None:
+            _LIBC = False
+        else:
+            libc = ctypes.CDLL(path, use_errno=True)
+            if hasattr(libc, 'inotify_init1'):
+                _LIBC = libc
+            else:
+                _LIBC = False
+    return _LIBC if _LIBC else None
+
+
+def _git_dir(path):
+    '''Returns the git directory of the repository whose top level is path, or
+    None if it's not a repository. This follows the "gitdir:" indirection used
+    by submodules and worktrees.'''
+    git = os.path.join(path, '.git')
+    if os.path.isdir(git):
+        return git
+    try:
+        with open(git, 'r') as f:
+            line = f.readline().strip()
+    except IOError:
+        return None
+    prefix = 'gitdir:'
+    if not line.startswith(prefix):
+        return None
+    return os.path.realpath(os.path.join(path, line[len(prefix):].strip()))
+
+
+class Watcher(object):
+    '''Watches a set of files and directory trees, each associated with a key,
+    and reports which keys have changed. Use create_watcher() rather than
+    instantiating this directly, since inotify is not available
+    everywhere.'''
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # Maps a watch descriptor to (key, path, skip), where skip is the set
+        # of directory names to ignore for recursive watches, or None for
+        # non-recursive ones.
+        self._watches = {}
+        # Keys we could not fully watch, which must always be treated as
+        # changed.
+        self._unwatched = set()
+
+    def fileno(self):
+        '''Returns the inotify file descriptor, for use with select.'''
+        return self._fd
+
+    def close(self):
+        '''Releases the inotify instance.'''
+        os.close(self._fd)
+
+    def unwatched(self):
+        '''Returns the keys that could not be watched, usually because we ran
+        out of inotify watches.'''
+        return set(self._unwatched)
+
+    def _add(self, key, path, skip):
+        '''Adds a single inotify watch.'''
+        wd = self._libc.inotify_add_watch(self._fd,
+                                          os.fsencode(path),
+                                          _WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                # The path disappeared from under us, so there's nothing to
+                # watch.
+                return
+            log('cannot watch %s: %s' % (path, os.strerror(e)))
+            self._unwatched.add(key)
+            return
+        self._watches[wd] = (key, path, skip)
+
+    def _add_tree(self, key, path, skip):
+        '''Recursively watches every directory under the given path, skipping
+        directory names in the given set.'''
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d not in skip]
+            self._add(key, dirpath, skip)
+
+    def watch_file(self, key, path):
+        '''Watches a single file or directory (but not its children).'''
+        self._add(key, path, None)
+
+    def watch_tree(self, key, path):
+        '''Watches a source tree. For git repositories, this also watches the
+        parts of the git directory that can change what HEAD points to.'''
+        self._add_tree(key, path, {'.git'})
+        git_dir = _git_dir(path)
+        if git_dir is not None:
+            self._add_tree(key, git_dir, _GIT_SKIP_DIRS)
+
+    def read(self):
+        '''Reads all pending events, returning the set of changed keys. If the
+        kernel event queue overflowed, returns None, meaning everything must be
+        treated as changed.'''
+        changed = set(self._unwatched)
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+                name_start = offset + _EVENT.size
+                name = buf[name_start:name_start+length].rstrip(b'\0')
+                offset = name_start + length
+
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                try:
+                    key, path, skip = self._watches[wd]
+                except KeyError:
+                    continue
+                if mask & _IN_IGNORED:
+                    del self._watches[wd]
+                    continue
+                changed.add(key)
+                created = mask & (_IN_CREATE | _IN_MOVED_TO)
+                if skip is not None and mask & _IN_ISDIR and created:
+                    # Newly created directories need watches of their own.
+                    name = os.fsdecode(name)
+                    if name not in skip:
+                        subdir = os.path.join(path, name)
+                        self._add_tree(key, subdir, skip)
+        return changed
+
+
+def create_watcher():
+    '''Returns a new Watcher, or None if inotify is not available on this
+    system.'''
+    libc = _get_libc()
+    if libc is None:
+        return None
+    try:
+        return Watcher(libc)
+    except OSError as e:
+        log('cannot create inotify instance: %s' % e)
+        return None